@@ -1,6 +1,6 @@
 import numpy as np
 from .mbr import MBR
-from .spatial_func import LAT_PER_METER, LNG_PER_METER
+from .spatial_func import LAT_PER_METER, LNG_PER_METER, haversine_distances
 
 
 class Grid:
@@ -42,6 +42,44 @@ class Grid:
     def get_matrix_idx(self, lat, lng):
         return self.row_num - 1 - self.get_row_idx(lat), self.get_col_idx(lng)
 
+    def get_row_idxs(self, lats):
+        """
+        the vectorized get_row_idx()
+        :param lats: array of the lats
+        :return: the row indices (-1 if out of mbr), the validity mask
+        """
+        row_idxs = np.floor_divide(np.asarray(lats, dtype=np.float64) - self.mbr.min_lat, self.lat_interval)
+        mask = (row_idxs >= 0) & (row_idxs < self.row_num)
+        return np.where(mask, row_idxs, -1).astype(np.int64), mask
+
+    def get_col_idxs(self, lngs):
+        """
+        the vectorized get_col_idx()
+        :param lngs: array of the lngs
+        :return: the col indices (-1 if out of mbr), the validity mask
+        """
+        col_idxs = np.floor_divide(np.asarray(lngs, dtype=np.float64) - self.mbr.min_lng, self.lng_interval)
+        mask = (col_idxs >= 0) & (col_idxs < self.col_num)
+        return np.where(mask, col_idxs, -1).astype(np.int64), mask
+
+    def get_idxs(self, lats, lngs):
+        """
+        the vectorized get_idx()
+        :return: the row indices, the col indices (-1 if out of mbr), the validity mask
+        """
+        row_idxs, row_mask = self.get_row_idxs(lats)
+        col_idxs, col_mask = self.get_col_idxs(lngs)
+        mask = row_mask & col_mask
+        return np.where(mask, row_idxs, -1), np.where(mask, col_idxs, -1), mask
+
+    def get_matrix_idxs(self, lats, lngs):
+        """
+        the vectorized get_matrix_idx()
+        :return: the matrix row indices, the matrix col indices (-1 if out of mbr), the validity mask
+        """
+        row_idxs, col_idxs, mask = self.get_idxs(lats, lngs)
+        return np.where(mask, self.row_num - 1 - row_idxs, -1), col_idxs, mask
+
     def get_min_lng(self, col_idx):
         return self.mbr.min_lng + col_idx * self.lng_interval
 
@@ -91,6 +129,90 @@ class Grid:
         return target_idx
 
 
+class GridRasterizer:
+    """
+    Accumulates the point counts, the dwell time and the speed of trajectories per grid cell into matrices
+    (in the matrix index order of Grid). The dwell time (second) and the speed (meter per second) of a point are
+    measured from the point to the next point of the trajectory, thus the last point only adds to the count.
+    """
+    def __init__(self, grid):
+        self.grid = grid
+        shape = (grid.row_num, grid.col_num)
+        self.count = np.zeros(shape, dtype=np.int64)
+        self.dwell_time = np.zeros(shape, dtype=np.float64)
+        self.speed_sum = np.zeros(shape, dtype=np.float64)
+        self.speed_count = np.zeros(shape, dtype=np.int64)
+        self.nb_pts = 0
+        self.nb_out_pts = 0
+
+    def add_trajs(self, trajs):
+        """
+        the points of all the trajectories are mapped and accumulated at once
+        """
+        lats = []
+        lngs = []
+        seconds = []
+        # the point is followed by a point of the same trajectory
+        has_next = []
+        for traj in trajs:
+            pt_list = traj.pt_list
+            if len(pt_list) == 0:
+                continue
+            start_time = pt_list[0].time
+            lats.extend([pt.lat for pt in pt_list])
+            lngs.extend([pt.lng for pt in pt_list])
+            seconds.extend([(pt.time - start_time).total_seconds() for pt in pt_list])
+            has_next.extend([True] * (len(pt_list) - 1) + [False])
+        if len(lats) == 0:
+            return
+        lats = np.array(lats, dtype=np.float64)
+        lngs = np.array(lngs, dtype=np.float64)
+        seconds = np.array(seconds, dtype=np.float64)
+        has_next = np.array(has_next, dtype=bool)
+        # the dwell time and the distance to the next point
+        dwell_times = np.zeros(len(lats))
+        dists = np.zeros(len(lats))
+        dwell_times[:-1] = seconds[1:] - seconds[:-1]
+        dists[:-1] = haversine_distances(lats[:-1], lngs[:-1], lats[1:], lngs[1:])
+        dwell_times[~has_next] = 0.0
+        has_speed = has_next & (dwell_times > 0)
+        speeds = np.zeros(len(lats))
+        speeds[has_speed] = dists[has_speed] / dwell_times[has_speed]
+        mat_row_idxs, mat_col_idxs, mask = self.grid.get_matrix_idxs(lats, lngs)
+        self.nb_pts += len(lats)
+        self.nb_out_pts += len(lats) - int(mask.sum())
+        # accumulate over the linear cell indices
+        cell_idxs = mat_row_idxs[mask] * self.grid.col_num + mat_col_idxs[mask]
+        nb_cells = self.grid.row_num * self.grid.col_num
+        shape = self.count.shape
+        self.count += np.bincount(cell_idxs, minlength=nb_cells).reshape(shape)
+        self.dwell_time += np.bincount(cell_idxs, weights=dwell_times[mask], minlength=nb_cells).reshape(shape)
+        self.speed_sum += np.bincount(cell_idxs, weights=speeds[mask], minlength=nb_cells).reshape(shape)
+        self.speed_count += np.bincount(cell_idxs, weights=has_speed[mask], minlength=nb_cells).reshape(shape).astype(
+            np.int64)
+
+    def add_traj(self, traj):
+        self.add_trajs([traj])
+
+    def get_mean_speed(self):
+        """
+        :return: the mean speed (meter per second) matrix, nan if no speed
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.speed_count > 0, self.speed_sum / self.speed_count, np.nan)
+
+    def merge(self, other):
+        if self.count.shape != other.count.shape:
+            raise Exception('cannot merge the rasterizers of different grids')
+        self.count += other.count
+        self.dwell_time += other.dwell_time
+        self.speed_sum += other.speed_sum
+        self.speed_count += other.speed_count
+        self.nb_pts += other.nb_pts
+        self.nb_out_pts += other.nb_out_pts
+        return self
+
+
 def create_grid(min_lat, min_lng, km_per_cell_lat, km_per_cell_lng, km_lat, km_lng):
     nb_rows = int(km_lat / km_per_cell_lat)
     nb_cols = int(km_lng / km_per_cell_lng)
@@ -1,4 +1,8 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+import numpy as np
+
+# the origin of the epoch times of the columnar paths, the times are naive datetimes
+EPOCH = datetime(1970, 1, 1)
 
 
 class PathEntity:
@@ -15,6 +19,59 @@ class Path:
         self.path_entities = path_entities
 
 
+class ColumnarPath:
+    """
+    Columnar representation of Path: one array per attribute of the path entities instead of one object per edge.
+    """
+    def __init__(self, oid, pid, eids, enter_times, leave_times):
+        """
+        :param eids: int64 array of the eids
+        :param enter_times: float64 array of the enter times (seconds since EPOCH)
+        :param leave_times: float64 array of the leave times (seconds since EPOCH)
+        """
+        self.oid = oid
+        self.pid = pid
+        self.eids = eids
+        self.enter_times = enter_times
+        self.leave_times = leave_times
+
+    def __len__(self):
+        return len(self.eids)
+
+    def to_path(self):
+        path_entities = [PathEntity(enter_time, leave_time, eid)
+                         for enter_time, leave_time, eid in zip(to_datetimes(self.enter_times),
+                                                                to_datetimes(self.leave_times), self.eids.tolist())]
+        return Path(self.oid, self.pid, path_entities)
+
+    @staticmethod
+    def from_path(path):
+        path_entities = path.path_entities
+        return ColumnarPath(path.oid, path.pid,
+                            np.array([path_entity.eid for path_entity in path_entities], dtype=np.int64),
+                            np.array([to_epoch(path_entity.enter_time) for path_entity in path_entities],
+                                     dtype=np.float64),
+                            np.array([to_epoch(path_entity.leave_time) for path_entity in path_entities],
+                                     dtype=np.float64))
+
+
+def to_epoch(t):
+    return (t - EPOCH).total_seconds()
+
+
+def from_epoch(seconds):
+    return EPOCH + timedelta(seconds=seconds)
+
+
+def to_datetimes(seconds):
+    """
+    the vectorized from_epoch()
+    :param seconds: float64 array of the epoch times
+    :return: a list of datetimes
+    """
+    return (np.round(seconds * 1e6).astype(np.int64).astype('datetime64[us]')).tolist()
+
+
 def parse_path_file(input_path):
     time_format = '%Y-%m-%d %H:%M:%S.%f'
     paths = []
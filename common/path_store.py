@@ -0,0 +1,154 @@
+"""
+Binary columnar path store with an edge inverted index.
+The path entities of all the paths are stored back to back as int32 eids and int64 enter/leave times (millisecond
+since EPOCH), the entities of path i are in [path_offsets[i], path_offsets[i+1]).
+The inverted index groups the entities by eid and sorts them by enter time, the entities of edge index_eids[k] are
+index_entities[index_offsets[k]:index_offsets[k+1]], so that the paths using an edge in a time range are found by
+binary searches instead of a full scan. The search is bounded by the max time spent on the edge itself
+(index_max_durations[k]), so a long stay on one edge does not widen the searches of the other edges.
+All the arrays can be memory-mapped from disk.
+"""
+from .path import ColumnarPath, to_epoch
+import numpy as np
+import os
+
+
+class PathStore:
+    def __init__(self, oids, pids, path_offsets, eids, enter_times, leave_times,
+                 index_eids, index_offsets, index_entities, index_enter_times, index_max_durations):
+        """
+        :param oids: the oids of the paths
+        :param pids: the pids of the paths
+        :param path_offsets: int64 array, the entity offsets of the paths
+        :param eids: int32 array, the eids of the entities
+        :param enter_times: int64 array, the enter times of the entities (millisecond since EPOCH)
+        :param leave_times: int64 array, the leave times of the entities (millisecond since EPOCH)
+        :param index_eids: int32 array, the sorted distinct eids
+        :param index_offsets: int64 array, the posting offsets of the distinct eids
+        :param index_entities: int64 array, the entities grouped by eid and sorted by enter time
+        :param index_enter_times: int64 array, the enter times of index_entities
+        :param index_max_durations: int64 array, the max time (millisecond) spent on each of the distinct eids, which
+        bounds the time range search of the edge
+        """
+        self.oids = oids
+        self.pids = pids
+        self.path_offsets = path_offsets
+        self.eids = eids
+        self.enter_times = enter_times
+        self.leave_times = leave_times
+        self.index_eids = index_eids
+        self.index_offsets = index_offsets
+        self.index_entities = index_entities
+        self.index_enter_times = index_enter_times
+        self.index_max_durations = index_max_durations
+
+    def __len__(self):
+        return len(self.path_offsets) - 1
+
+    def get_columnar_path(self, path_idx):
+        start, end = self.path_offsets[path_idx], self.path_offsets[path_idx + 1]
+        return ColumnarPath(str(self.oids[path_idx]), str(self.pids[path_idx]),
+                            np.array(self.eids[start:end], dtype=np.int64),
+                            self.enter_times[start:end] / 1000.0, self.leave_times[start:end] / 1000.0)
+
+    def get_path(self, path_idx):
+        return self.get_columnar_path(path_idx).to_path()
+
+    def query_edge(self, eid, start_time, end_time):
+        """
+        the entities on the edge overlapping [start_time, end_time)
+        :param eid: the edge id
+        :param start_time: datetime
+        :param end_time: datetime
+        :return: (path indices, entity indices), ordered by enter time
+        """
+        k = np.searchsorted(self.index_eids, eid)
+        if k == len(self.index_eids) or self.index_eids[k] != eid:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        lo, hi = self.index_offsets[k], self.index_offsets[k + 1]
+        start_ms, end_ms = to_ms(start_time), to_ms(end_time)
+        enter_times = self.index_enter_times[lo:hi]
+        # the entities entering before start_ms - max duration of the edge left before start_ms
+        lo, hi = lo + np.searchsorted(enter_times, start_ms - self.index_max_durations[k], side='left'), \
+            lo + np.searchsorted(enter_times, end_ms, side='left')
+        entities = np.asarray(self.index_entities[lo:hi])
+        entities = entities[np.asarray(self.leave_times[entities]) > start_ms]
+        return np.searchsorted(self.path_offsets, entities, side='right') - 1, entities
+
+    def query_paths(self, eid, start_time, end_time):
+        """
+        :return: the pids of the paths using the edge in [start_time, end_time)
+        """
+        path_idxs, _ = self.query_edge(eid, start_time, end_time)
+        return [str(self.pids[path_idx]) for path_idx in np.unique(path_idxs)]
+
+
+def to_ms(t):
+    return int(round(to_epoch(t) * 1000))
+
+
+def build_path_store(paths):
+    """
+    :param paths: a list of Path or ColumnarPath
+    :return: PathStore
+    """
+    columnar_paths = [path if isinstance(path, ColumnarPath) else ColumnarPath.from_path(path) for path in paths]
+    path_offsets = np.zeros(len(columnar_paths) + 1, dtype=np.int64)
+    np.cumsum([len(columnar_path) for columnar_path in columnar_paths], out=path_offsets[1:])
+    if len(columnar_paths) > 0:
+        eids = np.concatenate([columnar_path.eids for columnar_path in columnar_paths]).astype(np.int32)
+        enter_times = np.round(np.concatenate([columnar_path.enter_times for columnar_path in columnar_paths]) *
+                               1000).astype(np.int64)
+        leave_times = np.round(np.concatenate([columnar_path.leave_times for columnar_path in columnar_paths]) *
+                               1000).astype(np.int64)
+    else:
+        eids = np.zeros(0, dtype=np.int32)
+        enter_times = np.zeros(0, dtype=np.int64)
+        leave_times = np.zeros(0, dtype=np.int64)
+    # group by eid, then sort by enter time
+    index_entities = np.lexsort((enter_times, eids))
+    index_eids, counts = np.unique(eids[index_entities], return_counts=True)
+    index_offsets = np.zeros(len(index_eids) + 1, dtype=np.int64)
+    np.cumsum(counts, out=index_offsets[1:])
+    if len(index_eids) > 0:
+        index_max_durations = np.maximum.reduceat((leave_times - enter_times)[index_entities], index_offsets[:-1])
+    else:
+        index_max_durations = np.zeros(0, dtype=np.int64)
+    print('# of paths:{}, # of path entities:{}, # of indexed edges:{}'.format(
+        len(columnar_paths), len(eids), len(index_eids)))
+    return PathStore(np.array([columnar_path.oid for columnar_path in columnar_paths], dtype=str),
+                     np.array([columnar_path.pid for columnar_path in columnar_paths], dtype=str),
+                     path_offsets, eids, enter_times, leave_times, index_eids.astype(np.int32), index_offsets,
+                     index_entities.astype(np.int64), enter_times[index_entities],
+                     index_max_durations.astype(np.int64))
+
+
+def store_path_store(path_store, target_dir):
+    os.makedirs(target_dir, exist_ok=True)
+    np.save(os.path.join(target_dir, 'oids.npy'), path_store.oids)
+    np.save(os.path.join(target_dir, 'pids.npy'), path_store.pids)
+    np.save(os.path.join(target_dir, 'path_offsets.npy'), path_store.path_offsets)
+    np.save(os.path.join(target_dir, 'eids.npy'), path_store.eids)
+    np.save(os.path.join(target_dir, 'enter_times.npy'), path_store.enter_times)
+    np.save(os.path.join(target_dir, 'leave_times.npy'), path_store.leave_times)
+    np.save(os.path.join(target_dir, 'index_eids.npy'), path_store.index_eids)
+    np.save(os.path.join(target_dir, 'index_offsets.npy'), path_store.index_offsets)
+    np.save(os.path.join(target_dir, 'index_entities.npy'), path_store.index_entities)
+    np.save(os.path.join(target_dir, 'index_enter_times.npy'), path_store.index_enter_times)
+    np.save(os.path.join(target_dir, 'index_max_durations.npy'), path_store.index_max_durations)
+
+
+def load_path_store(input_dir, mmap=True):
+    """
+    :param input_dir: the directory generated by store_path_store
+    :param mmap: memory-map the entities and the index instead of reading them into memory
+    :return: PathStore
+    """
+    mmap_mode = 'r' if mmap else None
+    oids = np.load(os.path.join(input_dir, 'oids.npy'))
+    pids = np.load(os.path.join(input_dir, 'pids.npy'))
+    arrays = [np.load(os.path.join(input_dir, name + '.npy'), mmap_mode=mmap_mode)
+              for name in ['path_offsets', 'eids', 'enter_times', 'leave_times',
+                           'index_eids', 'index_offsets', 'index_entities', 'index_enter_times',
+                           'index_max_durations']]
+    return PathStore(oids, pids, *arrays)
@@ -1,7 +1,8 @@
 import networkx as nx
+import numpy as np
 from rtree import Rtree
 from osgeo import ogr
-from .spatial_func import SPoint, distance
+from .spatial_func import SPoint, distance, SEG_POS_BITS, cal_edge_geometry
 from .mbr import MBR
 import copy
 
@@ -13,6 +14,8 @@ class UndirRoadNetwork(nx.Graph):
         self.edge_spatial_idx = edge_spatial_idx
         # eid -> edge key (start_coord, end_coord)
         self.edge_idx = edge_idx
+        # optional, entry: segment id, see build_segment_index()
+        self.seg_spatial_idx = None
 
     def to_directed(self, as_view=False):
         """
@@ -41,6 +44,8 @@ class UndirRoadNetwork(nx.Graph):
             backward_data['eid'] = avail_eid
             avail_eid += 1
             backward_data['coords'].reverse()
+            if 'seg_lengths' in forward_data:
+                backward_data.update(cal_edge_geometry(backward_data['coords'], forward_data['seg_lengths'][::-1]))
             g.add_edge(v, u, **backward_data)
             edge_spatial_idx.insert(backward_data['eid'], (mbr.min_lng, mbr.min_lat, mbr.max_lng, mbr.max_lat))
             edge_idx[backward_data['eid']] = (v, u)
@@ -57,6 +62,44 @@ class UndirRoadNetwork(nx.Graph):
         eids = self.edge_spatial_idx.intersection((mbr.min_lng, mbr.min_lat, mbr.max_lng, mbr.max_lat))
         return [self.edge_idx[eid] for eid in eids]
 
+    def range_query_batch(self, mins, maxs):
+        """
+        bulk spatial range query, one index call for all the query boxes
+        :param mins: (n, 2) array of the (min_lng, min_lat) of the query boxes
+        :param maxs: (n, 2) array of the (max_lng, max_lat) of the query boxes
+        :return: (eids, counts), the eids of the i-th box follow those of the (i-1)-th box, counts[i] in total
+        """
+        return bulk_intersection(self.edge_spatial_idx, mins, maxs)
+
+    def build_segment_index(self):
+        """
+        build the spatial index over individual polyline segments, each segment maps to its eid and position
+        """
+        entries = [entry for _, _, data in self.edges(data=True) for entry in seg_entries(data['eid'], data['coords'])]
+        # bulk loading does not accept an empty stream
+        self.seg_spatial_idx = Rtree(entries) if len(entries) > 0 else Rtree()
+
+    def segment_range_query(self, mbr):
+        """
+        spatial range query over segments, requires build_segment_index()
+        :param mbr: query mbr
+        :return: qualified edge key -> sorted positions of the qualified segments
+        """
+        results = {}
+        for seg_id in self.seg_spatial_idx.intersection((mbr.min_lng, mbr.min_lat, mbr.max_lng, mbr.max_lat)):
+            eid, pos = seg_id >> SEG_POS_BITS, seg_id & ((1 << SEG_POS_BITS) - 1)
+            results.setdefault(self.edge_idx[eid], []).append(pos)
+        for positions in results.values():
+            positions.sort()
+        return results
+
+    def segment_range_query_batch(self, mins, maxs):
+        """
+        bulk spatial range query over segments, requires build_segment_index()
+        :return: (segment ids, counts), see range_query_batch()
+        """
+        return bulk_intersection(self.seg_spatial_idx, mins, maxs)
+
     def remove_edge(self, u, v):
         edge_data = self[u][v]
         coords = edge_data['coords']
@@ -65,6 +108,9 @@ class UndirRoadNetwork(nx.Graph):
         del self.edge_idx[edge_data['eid']]
         # delete from spatial index
         self.edge_spatial_idx.delete(edge_data['eid'], (mbr.min_lng, mbr.min_lat, mbr.max_lng, mbr.max_lat))
+        if self.seg_spatial_idx is not None:
+            for seg_id, bbox, _ in seg_entries(edge_data['eid'], coords):
+                self.seg_spatial_idx.delete(seg_id, bbox)
         # delete from graph
         super(UndirRoadNetwork, self).remove_edge(u, v)
 
@@ -72,10 +118,14 @@ class UndirRoadNetwork(nx.Graph):
         coords = attr['coords']
         mbr = MBR.cal_mbr(coords)
         attr['length'] = sum([distance(coords[i], coords[i + 1]) for i in range(len(coords) - 1)])
+        attr.update(cal_edge_geometry(coords))
         # add edge to edge index
         self.edge_idx[attr['eid']] = (u_of_edge, v_of_edge)
         # add edge to spatial index
         self.edge_spatial_idx.insert(attr['eid'], (mbr.min_lng, mbr.min_lat, mbr.max_lng, mbr.max_lat))
+        if self.seg_spatial_idx is not None:
+            for seg_id, bbox, _ in seg_entries(attr['eid'], coords):
+                self.seg_spatial_idx.insert(seg_id, bbox)
         # add edge to graph
         super(UndirRoadNetwork, self).add_edge(u_of_edge, v_of_edge, **attr)
 
@@ -87,6 +137,8 @@ class RoadNetwork(nx.DiGraph):
         self.edge_spatial_idx = edge_spatial_idx
         # eid -> edge key (start_coord, end_coord)
         self.edge_idx = edge_idx
+        # optional, entry: segment id, see build_segment_index()
+        self.seg_spatial_idx = None
 
     def range_query(self, mbr):
         """
@@ -97,6 +149,44 @@ class RoadNetwork(nx.DiGraph):
         eids = self.edge_spatial_idx.intersection((mbr.min_lng, mbr.min_lat, mbr.max_lng, mbr.max_lat))
         return [self.edge_idx[eid] for eid in eids]
 
+    def range_query_batch(self, mins, maxs):
+        """
+        bulk spatial range query, one index call for all the query boxes
+        :param mins: (n, 2) array of the (min_lng, min_lat) of the query boxes
+        :param maxs: (n, 2) array of the (max_lng, max_lat) of the query boxes
+        :return: (eids, counts), the eids of the i-th box follow those of the (i-1)-th box, counts[i] in total
+        """
+        return bulk_intersection(self.edge_spatial_idx, mins, maxs)
+
+    def build_segment_index(self):
+        """
+        build the spatial index over individual polyline segments, each segment maps to its eid and position
+        """
+        entries = [entry for _, _, data in self.edges(data=True) for entry in seg_entries(data['eid'], data['coords'])]
+        # bulk loading does not accept an empty stream
+        self.seg_spatial_idx = Rtree(entries) if len(entries) > 0 else Rtree()
+
+    def segment_range_query(self, mbr):
+        """
+        spatial range query over segments, requires build_segment_index()
+        :param mbr: query mbr
+        :return: qualified edge key -> sorted positions of the qualified segments
+        """
+        results = {}
+        for seg_id in self.seg_spatial_idx.intersection((mbr.min_lng, mbr.min_lat, mbr.max_lng, mbr.max_lat)):
+            eid, pos = seg_id >> SEG_POS_BITS, seg_id & ((1 << SEG_POS_BITS) - 1)
+            results.setdefault(self.edge_idx[eid], []).append(pos)
+        for positions in results.values():
+            positions.sort()
+        return results
+
+    def segment_range_query_batch(self, mins, maxs):
+        """
+        bulk spatial range query over segments, requires build_segment_index()
+        :return: (segment ids, counts), see range_query_batch()
+        """
+        return bulk_intersection(self.seg_spatial_idx, mins, maxs)
+
     def remove_edge(self, u, v):
         edge_data = self[u][v]
         coords = edge_data['coords']
@@ -105,6 +195,9 @@ class RoadNetwork(nx.DiGraph):
         del self.edge_idx[edge_data['eid']]
         # delete from spatial index
         self.edge_spatial_idx.delete(edge_data['eid'], (mbr.min_lng, mbr.min_lat, mbr.max_lng, mbr.max_lat))
+        if self.seg_spatial_idx is not None:
+            for seg_id, bbox, _ in seg_entries(edge_data['eid'], coords):
+                self.seg_spatial_idx.delete(seg_id, bbox)
         # delete from graph
         super(RoadNetwork, self).remove_edge(u, v)
 
@@ -112,14 +205,41 @@ class RoadNetwork(nx.DiGraph):
         coords = attr['coords']
         mbr = MBR.cal_mbr(coords)
         attr['length'] = sum([distance(coords[i], coords[i + 1]) for i in range(len(coords) - 1)])
+        attr.update(cal_edge_geometry(coords))
         # add edge to edge index
         self.edge_idx[attr['eid']] = (u_of_edge, v_of_edge)
         # add edge to spatial index
         self.edge_spatial_idx.insert(attr['eid'], (mbr.min_lng, mbr.min_lat, mbr.max_lng, mbr.max_lat))
+        if self.seg_spatial_idx is not None:
+            for seg_id, bbox, _ in seg_entries(attr['eid'], coords):
+                self.seg_spatial_idx.insert(seg_id, bbox)
         # add edge to graph
         super(RoadNetwork, self).add_edge(u_of_edge, v_of_edge, **attr)
 
 
+def bulk_intersection(spatial_idx, mins, maxs):
+    """
+    intersection_v is only available since rtree 1.0, otherwise the boxes are queried one by one
+    :return: (ids, counts), see RoadNetwork.range_query_batch()
+    """
+    if hasattr(spatial_idx, 'intersection_v'):
+        return spatial_idx.intersection_v(mins, maxs)
+    ids = []
+    counts = []
+    for bbox in np.concatenate([mins, maxs], axis=1).tolist():
+        box_ids = list(spatial_idx.intersection(bbox))
+        ids.extend(box_ids)
+        counts.append(len(box_ids))
+    return np.array(ids, dtype=np.int64), np.array(counts, dtype=np.int64)
+
+
+def seg_entries(eid, coords):
+    assert len(coords) - 1 < (1 << SEG_POS_BITS), 'too many segments in edge {}'.format(eid)
+    for i in range(len(coords) - 1):
+        a, b = coords[i], coords[i + 1]
+        yield (eid << SEG_POS_BITS) | i, (min(a.lng, b.lng), min(a.lat, b.lat), max(a.lng, b.lng), max(a.lat, b.lat)), None
+
+
 def load_rn_shp(path, is_directed=True):
     edge_spatial_idx = Rtree()
     edge_idx = {}
@@ -142,6 +262,7 @@ def load_rn_shp(path, is_directed=True):
             coords.append(SPoint(geom_pt[1], geom_pt[0]))
         data['coords'] = coords
         data['length'] = sum([distance(coords[i], coords[i+1]) for i in range(len(coords) - 1)])
+        data.update(cal_edge_geometry(coords))
         env = geom_line.GetEnvelope()
         edge_spatial_idx.insert(data['eid'], (env[0], env[2], env[1], env[3]))
         edge_idx[data['eid']] = (u, v)
@@ -169,8 +290,9 @@ def store_rn_shp(rn, target_path):
             geo_line.AddPoint(coord.lng, coord.lat)
         data['Wkb'] = geo_line.ExportToWkb()
         del data['coords']
-        if 'length' in data:
-            del data['length']
+        for attr in ['length', 'seg_lengths', 'cum_offsets', 'xy']:
+            if attr in data:
+                del data[attr]
     if not rn.is_directed():
         rn = rn.to_directed()
     nx.write_shp(rn, target_path)
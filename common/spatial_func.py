@@ -1,3 +1,4 @@
+import numpy as np
 import math
 DEGREES_TO_RADIANS = math.pi / 180
 RADIANS_TO_DEGREES = 1 / DEGREES_TO_RADIANS
@@ -5,6 +6,8 @@ EARTH_MEAN_RADIUS_METER = 6371008.7714
 DEG_TO_KM = DEGREES_TO_RADIANS * EARTH_MEAN_RADIUS_METER
 LAT_PER_METER = 8.993203677616966e-06
 LNG_PER_METER = 1.1700193970443768e-05
+# segment id = eid << SEG_POS_BITS | segment position in the polyline
+SEG_POS_BITS = 16
 
 
 class SPoint:
@@ -94,6 +97,19 @@ def haversine_distance(a, b):
     return d
 
 
+def haversine_distances(lat_a, lng_a, lat_b, lng_b):
+    """
+    the vectorized haversine_distance over arrays of coordinates (degree)
+    """
+    delta_lat = np.radians(lat_b - lat_a)
+    delta_lng = np.radians(lng_b - lng_a)
+    h = np.sin(delta_lat / 2.0) * np.sin(delta_lat / 2.0) + np.cos(np.radians(lat_a)) * np.cos(
+        np.radians(lat_b)) * np.sin(delta_lng / 2.0) * np.sin(delta_lng / 2.0)
+    c = 2.0 * np.arctan2(np.sqrt(h), np.sqrt(1 - h))
+    d = EARTH_MEAN_RADIUS_METER * c
+    return np.where((lat_a == lat_b) & (lng_a == lng_b), 0.0, d)
+
+
 def same_coords(a, b):
     if a.lat == b.lat and a.lng == b.lng:
         return True
@@ -131,3 +147,26 @@ def angle(a, b, c, d):
         if included_angle > 180:
             included_angle = 360 - included_angle
     return included_angle
+
+
+def cal_edge_geometry(coords, seg_lengths=None):
+    """
+    per-edge arrays precomputed at load time
+    seg_lengths: the length of each segment
+    cum_offsets: the offset of each coord from the start of the edge, i.e., cum_offsets[i] = sum(seg_lengths[:i])
+    xy: the local planar coordinates (meter) of coords, by the equirectangular projection at coords[0]
+    :param coords: the coords of the edge
+    :param seg_lengths: the known segment lengths, e.g., of the reversed edge
+    :return: the dict of edge attrs
+    """
+    if seg_lengths is None:
+        seg_lengths = [distance(coords[i], coords[i + 1]) for i in range(len(coords) - 1)]
+    seg_lengths = np.array(seg_lengths, dtype=np.float64)
+    cum_offsets = np.zeros(len(coords), dtype=np.float64)
+    np.cumsum(seg_lengths, out=cum_offsets[1:])
+    lat_lng = np.array([(coord.lat, coord.lng) for coord in coords], dtype=np.float64)
+    xy = np.empty((len(coords), 2), dtype=np.float64)
+    # DEG_TO_KM is the arc length (meter) of one degree
+    xy[:, 0] = (lat_lng[:, 1] - coords[0].lng) * DEG_TO_KM * math.cos(math.radians(coords[0].lat))
+    xy[:, 1] = (lat_lng[:, 0] - coords[0].lat) * DEG_TO_KM
+    return {'seg_lengths': seg_lengths, 'cum_offsets': cum_offsets, 'xy': xy}
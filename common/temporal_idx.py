@@ -1,4 +1,5 @@
 from datetime import timedelta, datetime
+from .path import to_epoch
 import numpy as np
 
 
@@ -16,6 +17,17 @@ class DailyTemporalIdx:
             raise IndexError("cur_time {} is not in time range".format(cur_time))
         return idx
 
+    def epochs_to_ts(self, seconds):
+        """
+        the vectorized time_to_ts()
+        :param seconds: array of the epoch times (second since 1970-01-01, see common.path.to_epoch)
+        :return: the slot indices (-1 if out of range), the validity mask
+        """
+        minutes = np.floor_divide(np.mod(np.asarray(seconds, dtype=np.float64), 86400), 60)
+        idx = np.floor_divide(minutes - self.start_minutes, self.time_interval)
+        mask = (idx >= 0) & (idx < self.ts_num)
+        return np.where(mask, idx, -1).astype(np.int64), mask
+
 
 class TemporalIdx:
     """
@@ -27,6 +39,14 @@ class TemporalIdx:
         self.time_interval = time_interval_in_minutes
         self.ts_num = int((end_time - start_time).total_seconds() // (time_interval_in_minutes * 60))
         self.nb_ts_per_day = 1440 // self.time_interval
+        self.start_epoch = to_epoch(start_time)
+        # the day of week (Monday is 0) and the hour of day of the start time of each slot, see query_mask()
+        slot_start_epochs = self.start_epoch + np.arange(self.ts_num, dtype=np.float64) * (self.time_interval * 60)
+        # 1970-01-01 is a Thursday
+        self.slot_weekdays = (np.floor_divide(slot_start_epochs, 86400).astype(np.int64) + 3) % 7
+        self.slot_hours = np.floor_divide(np.mod(slot_start_epochs, 86400), 3600).astype(np.int64)
+        # the cached slot masks
+        self.masks = {}
 
     def ts_to_datetime(self, ts):
         return self.start_time + timedelta(minutes=self.time_interval * ts)
@@ -37,6 +57,51 @@ class TemporalIdx:
             raise IndexError("cur_time {} is not in time range".format(cur_time))
         return ts
 
+    def epochs_to_ts(self, seconds):
+        """
+        the vectorized datetime_to_ts()
+        :param seconds: array of the epoch times (second since 1970-01-01, see common.path.to_epoch)
+        :return: the slot indices (-1 if out of range), the validity mask
+        """
+        ts = np.floor_divide(np.asarray(seconds, dtype=np.float64) - self.start_epoch, self.time_interval * 60)
+        mask = (ts >= 0) & (ts < self.ts_num)
+        return np.where(mask, ts, -1).astype(np.int64), mask
+
+    def datetimes_to_ts(self, times):
+        """
+        :param times: a list of datetimes
+        :return: see epochs_to_ts()
+        """
+        return self.epochs_to_ts([to_epoch(t) for t in times])
+
+    def query_mask(self, name, value=None):
+        """
+        the boolean mask of the slots by the start time of each slot, e.g.,
+        tensor[temporal_idx.query_mask('weekend')], computed once and cached
+        :param name: weekend, workday, weekday (value is the day of week, Monday is 0), day ([6,18)),
+        night ([18,24) and [0,6)) or hour (value is the hour of day)
+        :return: bool array of shape (ts_num,), read-only
+        """
+        key = (name, value)
+        if key not in self.masks:
+            if name == 'weekend':
+                mask = self.slot_weekdays >= 5
+            elif name == 'workday':
+                mask = self.slot_weekdays < 5
+            elif name == 'weekday':
+                mask = self.slot_weekdays == value
+            elif name == 'day':
+                mask = (self.slot_hours >= 6) & (self.slot_hours < 18)
+            elif name == 'night':
+                mask = (self.slot_hours >= 18) | (self.slot_hours < 6)
+            elif name == 'hour':
+                mask = self.slot_hours == value
+            else:
+                raise Exception('unrecognized slot mask')
+            mask.flags.writeable = False
+            self.masks[key] = mask
+        return self.masks[key]
+
     def safe_datetime_to_ts(self, time):
         try:
             ts = self.datetime_to_ts(time)
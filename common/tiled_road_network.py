@@ -0,0 +1,347 @@
+"""
+Tiled road network for country-scale maps.
+Vertices and edges are partitioned into square spatial tiles stored on disk. A tile is only loaded when a range
+query or a routing algorithm touches it, and the least recently used tiles are evicted once the loaded edges
+exceed the memory budget. The graph interface is the same as RoadNetwork/UndirRoadNetwork (read-only), since the
+node and adjacency dicts of networkx are replaced by lazy mappings backed by the tiles.
+"""
+import networkx as nx
+from rtree import Rtree
+from collections import OrderedDict
+from collections.abc import Mapping
+import numpy as np
+import threading
+import pickle
+import json
+import math
+import os
+from .spatial_func import LAT_PER_METER, LNG_PER_METER
+from .mbr import MBR
+
+
+class Tile:
+    def __init__(self, data):
+        # node -> node attrs
+        self.nodes = data['nodes']
+        # node -> {successor: edge attrs}, it is the adjacency of undirected road networks
+        self.succ = data['succ']
+        # node -> {predecessor: edge attrs}, empty for undirected road networks
+        self.pred = data['pred']
+        # eid -> edge key (start_coord, end_coord), for edges starting in this tile
+        self.edge_keys = data['edge_keys']
+        # [(eid, (min_lng, min_lat, max_lng, max_lat), edge key)] of edges whose mbr intersects this tile
+        self.spatial_entries = data['spatial_entries']
+        self.spatial_edge_keys = {eid: edge_key for eid, _, edge_key in self.spatial_entries}
+        self.edge_spatial_idx = None
+        self.nb_edges = sum([len(nbrs) for nbrs in self.succ.values()])
+
+    def range_query(self, bbox):
+        if self.edge_spatial_idx is None:
+            if len(self.spatial_entries) == 0:
+                return []
+            self.edge_spatial_idx = Rtree((eid, entry_bbox, None) for eid, entry_bbox, _ in self.spatial_entries)
+        return self.edge_spatial_idx.intersection(bbox)
+
+
+class TileStore:
+    """
+    loads tiles on demand and evicts the least recently used tiles under the memory budget
+    """
+    def __init__(self, tile_dir, max_nb_edges):
+        self.tile_dir = tile_dir
+        with open(os.path.join(tile_dir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        self.tile_lat = meta['tile_lat']
+        self.tile_lng = meta['tile_lng']
+        self.directed = meta['directed']
+        self.nb_nodes = meta['nb_nodes']
+        self.nb_edges = meta['nb_edges']
+        self.tile_keys = set(tuple(tile_key) for tile_key in meta['tiles'])
+        # sorted eids and the tile of their start vertex
+        self.eids = np.load(os.path.join(tile_dir, 'eids.npy'))
+        self.eid_tiles = np.load(os.path.join(tile_dir, 'eid_tiles.npy'))
+        self.max_nb_edges = max_nb_edges
+        self.loaded_tiles = OrderedDict()
+        self.nb_loaded_edges = 0
+        self.nb_tile_loads = 0
+        self.lock = threading.RLock()
+
+    def tile_of(self, node):
+        return tile_of(node, self.tile_lat, self.tile_lng)
+
+    def get_tile(self, tile_key):
+        """
+        :return: the loaded tile, None if there is no such tile
+        """
+        with self.lock:
+            tile = self.loaded_tiles.get(tile_key)
+            if tile is not None:
+                self.loaded_tiles.move_to_end(tile_key)
+                return tile
+            if tile_key not in self.tile_keys:
+                return None
+            with open(os.path.join(self.tile_dir, tile_file_name(tile_key)), 'rb') as f:
+                tile = Tile(pickle.load(f))
+            self.nb_tile_loads += 1
+            self.loaded_tiles[tile_key] = tile
+            self.nb_loaded_edges += tile.nb_edges
+            # the tile just loaded is never evicted
+            while self.nb_loaded_edges > self.max_nb_edges and len(self.loaded_tiles) > 1:
+                _, evicted_tile = self.loaded_tiles.popitem(last=False)
+                self.nb_loaded_edges -= evicted_tile.nb_edges
+            return tile
+
+    def get_node_tile(self, node):
+        try:
+            return self.get_tile(self.tile_of(node))
+        except TypeError:
+            # not a coordinate tuple
+            return None
+
+    def get_eid_tile(self, eid):
+        i = np.searchsorted(self.eids, eid)
+        if i >= len(self.eids) or self.eids[i] != eid:
+            return None
+        return self.get_tile(tuple(self.eid_tiles[i].tolist()))
+
+    def tiles_of_mbr(self, min_lng, min_lat, max_lng, max_lat):
+        min_x, min_y = tile_of((min_lng, min_lat), self.tile_lat, self.tile_lng)
+        max_x, max_y = tile_of((max_lng, max_lat), self.tile_lat, self.tile_lng)
+        return [(x, y) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1) if (x, y) in self.tile_keys]
+
+    def range_query(self, mbr):
+        bbox = (mbr.min_lng, mbr.min_lat, mbr.max_lng, mbr.max_lat)
+        results = []
+        visited_eids = set()
+        for tile_key in self.tiles_of_mbr(*bbox):
+            tile = self.get_tile(tile_key)
+            for eid in tile.range_query(bbox):
+                if eid not in visited_eids:
+                    visited_eids.add(eid)
+                    results.append(tile.spatial_edge_keys[eid])
+        return results
+
+    def iter_tiles(self):
+        for tile_key in sorted(self.tile_keys):
+            yield self.get_tile(tile_key)
+
+
+class LazyTileDict(Mapping):
+    """
+    node -> value of the tile containing the node, kind in ['nodes', 'succ', 'pred']
+    """
+    def __init__(self, store, kind):
+        self.store = store
+        self.kind = kind
+
+    def __getitem__(self, node):
+        tile = self.store.get_node_tile(node)
+        if tile is None:
+            raise KeyError(node)
+        return getattr(tile, self.kind)[node]
+
+    def __contains__(self, node):
+        tile = self.store.get_node_tile(node)
+        return tile is not None and node in tile.nodes
+
+    def __iter__(self):
+        # iterating over all the nodes will load all the tiles one by one
+        for tile in self.store.iter_tiles():
+            for node in list(tile.nodes):
+                yield node
+
+    def __len__(self):
+        return self.store.nb_nodes
+
+
+class LazyEdgeIdx(Mapping):
+    """
+    eid -> edge key (start_coord, end_coord)
+    """
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, eid):
+        tile = self.store.get_eid_tile(eid)
+        if tile is None:
+            raise KeyError(eid)
+        return tile.edge_keys[eid]
+
+    def __contains__(self, eid):
+        return self.store.get_eid_tile(eid) is not None
+
+    def __iter__(self):
+        return iter(self.store.eids.tolist())
+
+    def __len__(self):
+        return len(self.store.eids)
+
+
+class TiledRoadNetwork(nx.DiGraph):
+    def __init__(self, store):
+        super(TiledRoadNetwork, self).__init__()
+        self.store = store
+        self._node = LazyTileDict(store, 'nodes')
+        self._adj = LazyTileDict(store, 'succ')
+        self._succ = self._adj
+        self._pred = LazyTileDict(store, 'pred')
+        # eid -> edge key (start_coord, end_coord)
+        self.edge_idx = LazyEdgeIdx(store)
+        # the segment index is not supported
+        self.seg_spatial_idx = None
+
+    def range_query(self, mbr):
+        """
+        spatial range query, only the tiles intersecting the mbr are loaded
+        :param mbr: query mbr
+        :return: qualified edge keys
+        """
+        return self.store.range_query(mbr)
+
+    def range_query_batch(self, mins, maxs):
+        """
+        bulk spatial range query, the tiles are still loaded box by box
+        :return: (eids, counts), see RoadNetwork.range_query_batch()
+        """
+        eids, counts = [], []
+        for (min_lng, min_lat), (max_lng, max_lat) in zip(mins.tolist(), maxs.tolist()):
+            edges = self.store.range_query(MBR(min_lat, min_lng, max_lat, max_lng))
+            eids.extend(self[u][v]['eid'] for u, v in edges)
+            counts.append(len(edges))
+        return np.array(eids, dtype=np.int64), np.array(counts, dtype=np.int64)
+
+    def number_of_edges(self, u=None, v=None):
+        if u is None:
+            return self.store.nb_edges
+        return super(TiledRoadNetwork, self).number_of_edges(u, v)
+
+    def remove_edge(self, u, v):
+        raise Exception('tiled road network is read-only')
+
+    def add_edge(self, u_of_edge, v_of_edge, **attr):
+        raise Exception('tiled road network is read-only')
+
+
+class TiledUndirRoadNetwork(nx.Graph):
+    def __init__(self, store):
+        super(TiledUndirRoadNetwork, self).__init__()
+        self.store = store
+        self._node = LazyTileDict(store, 'nodes')
+        self._adj = LazyTileDict(store, 'succ')
+        # eid -> edge key (start_coord, end_coord)
+        self.edge_idx = LazyEdgeIdx(store)
+        # the segment index is not supported
+        self.seg_spatial_idx = None
+
+    def range_query(self, mbr):
+        """
+        spatial range query, only the tiles intersecting the mbr are loaded
+        :param mbr: query mbr
+        :return: qualified edge keys
+        """
+        return self.store.range_query(mbr)
+
+    def range_query_batch(self, mins, maxs):
+        """
+        bulk spatial range query, the tiles are still loaded box by box
+        :return: (eids, counts), see RoadNetwork.range_query_batch()
+        """
+        eids, counts = [], []
+        for (min_lng, min_lat), (max_lng, max_lat) in zip(mins.tolist(), maxs.tolist()):
+            edges = self.store.range_query(MBR(min_lat, min_lng, max_lat, max_lng))
+            eids.extend(self[u][v]['eid'] for u, v in edges)
+            counts.append(len(edges))
+        return np.array(eids, dtype=np.int64), np.array(counts, dtype=np.int64)
+
+    def number_of_edges(self, u=None, v=None):
+        if u is None:
+            return self.store.nb_edges
+        return super(TiledUndirRoadNetwork, self).number_of_edges(u, v)
+
+    def remove_edge(self, u, v):
+        raise Exception('tiled road network is read-only')
+
+    def add_edge(self, u_of_edge, v_of_edge, **attr):
+        raise Exception('tiled road network is read-only')
+
+
+def tile_of(node, tile_lat, tile_lng):
+    # node uses coordinate (lng, lat) as key
+    return int(math.floor(node[0] / tile_lng)), int(math.floor(node[1] / tile_lat))
+
+
+def tile_file_name(tile_key):
+    return 'tile_{}_{}.pkl'.format(tile_key[0], tile_key[1])
+
+
+def store_rn_tiles(rn, target_dir, tile_size_meter=10000.0):
+    """
+    partition the road network into tiles, e.g., once on a large machine after load_rn_shp
+    :param rn: the road network
+    :param target_dir: the directory of tiles
+    :param tile_size_meter: the side length of a tile
+    :return:
+    """
+    os.makedirs(target_dir, exist_ok=True)
+    tile_lat = tile_size_meter * LAT_PER_METER
+    tile_lng = tile_size_meter * LNG_PER_METER
+    directed = rn.is_directed()
+    tiles = {}
+
+    def get_tile_data(tile_key):
+        if tile_key not in tiles:
+            tiles[tile_key] = {'nodes': {}, 'succ': {}, 'pred': {}, 'edge_keys': {}, 'spatial_entries': []}
+        return tiles[tile_key]
+
+    for n, data in rn.nodes(data=True):
+        tile_data = get_tile_data(tile_of(n, tile_lat, tile_lng))
+        tile_data['nodes'][n] = data
+        tile_data['succ'][n] = {}
+        if directed:
+            tile_data['pred'][n] = {}
+    eids = []
+    eid_tiles = []
+    for u, v, data in rn.edges(data=True):
+        u_tile_key = tile_of(u, tile_lat, tile_lng)
+        v_tile_key = tile_of(v, tile_lat, tile_lng)
+        tiles[u_tile_key]['succ'][u][v] = data
+        if directed:
+            tiles[v_tile_key]['pred'][v][u] = data
+        else:
+            tiles[v_tile_key]['succ'][v][u] = data
+        tiles[u_tile_key]['edge_keys'][data['eid']] = (u, v)
+        eids.append(data['eid'])
+        eid_tiles.append(u_tile_key)
+        mbr = MBR.cal_mbr(data['coords'])
+        bbox = (mbr.min_lng, mbr.min_lat, mbr.max_lng, mbr.max_lat)
+        min_x, min_y = tile_of((mbr.min_lng, mbr.min_lat), tile_lat, tile_lng)
+        max_x, max_y = tile_of((mbr.max_lng, mbr.max_lat), tile_lat, tile_lng)
+        for x in range(min_x, max_x + 1):
+            for y in range(min_y, max_y + 1):
+                get_tile_data((x, y))['spatial_entries'].append((data['eid'], bbox, (u, v)))
+    for tile_key, tile_data in tiles.items():
+        with open(os.path.join(target_dir, tile_file_name(tile_key)), 'wb') as f:
+            pickle.dump(tile_data, f, protocol=pickle.HIGHEST_PROTOCOL)
+    order = np.argsort(eids, kind='stable')
+    np.save(os.path.join(target_dir, 'eids.npy'), np.array(eids, dtype=np.int64)[order])
+    np.save(os.path.join(target_dir, 'eid_tiles.npy'), np.array(eid_tiles, dtype=np.int32).reshape(-1, 2)[order])
+    with open(os.path.join(target_dir, 'meta.json'), 'w') as f:
+        json.dump({'tile_lat': tile_lat, 'tile_lng': tile_lng, 'directed': directed,
+                   'nb_nodes': rn.number_of_nodes(), 'nb_edges': rn.number_of_edges(),
+                   'tiles': [list(tile_key) for tile_key in tiles]}, f)
+    print('# of tiles:{}'.format(len(tiles)))
+
+
+def load_rn_tiles(tile_dir, max_nb_edges=1000000):
+    """
+    :param tile_dir: the directory generated by store_rn_tiles
+    :param max_nb_edges: the memory budget in terms of the number of loaded edges
+    :return: TiledRoadNetwork or TiledUndirRoadNetwork
+    """
+    store = TileStore(tile_dir, max_nb_edges)
+    print('# of nodes:{}'.format(store.nb_nodes))
+    print('# of edges:{}'.format(store.nb_edges))
+    if store.directed:
+        return TiledRoadNetwork(store)
+    else:
+        return TiledUndirRoadNetwork(store)
@@ -0,0 +1,188 @@
+"""
+Spatio-temporal flow tensors over Grid x TemporalIdx.
+The points of the trajectories are assigned to the grid cells and the time slots at once (see Grid.get_matrix_idxs()),
+the points out of the grid or the time range are dropped. A transition is two consecutive remaining points of a
+trajectory in different cells, it adds to the outflow of the former cell and the inflow of the latter cell in the
+time slot of the latter point. The OD of a trajectory is from the cell of its first remaining point, in the time
+slot of that point, to the cell of its last remaining point.
+inflow/outflow are dense (ts_num, row_num, col_num) tensors in the matrix index order of Grid, while the OD tensor
+(ts_num, nb_cells, nb_cells) is mostly empty, thus kept as sparse COO arrays (linear index (ts * nb_cells + o) *
+nb_cells + d). The partial tensors of different chunks or shards are merged by merge()/merge_coo(),
+e.g., build_flow_tensors(nb_workers=...).
+"""
+from .common.trajectory import parse_traj_file
+from .common.path import to_epoch
+from .map_matching.parallel import fork_map
+import numpy as np
+import itertools
+import json
+import os
+
+
+class FlowTensorBuilder:
+    def __init__(self, grid, temporal_idx):
+        self.grid = grid
+        self.temporal_idx = temporal_idx
+        self.nb_cells = grid.row_num * grid.col_num
+        self.inflow = np.zeros((temporal_idx.ts_num, grid.row_num, grid.col_num), dtype=np.int64)
+        self.outflow = np.zeros((temporal_idx.ts_num, grid.row_num, grid.col_num), dtype=np.int64)
+        self.od_keys = np.zeros(0, dtype=np.int64)
+        self.od_counts = np.zeros(0, dtype=np.int64)
+        self.nb_trajs = 0
+        self.nb_pts = 0
+        self.nb_dropped_pts = 0
+
+    def add_trajs(self, trajs, chunk_size=10000):
+        """
+        :param trajs: iterable of trajectories, consumed lazily
+        :param chunk_size: the number of trajectories assigned and accumulated at a time
+        """
+        trajs = iter(trajs)
+        while True:
+            chunk = list(itertools.islice(trajs, chunk_size))
+            if len(chunk) == 0:
+                break
+            self.add_chunk(chunk)
+
+    def add_chunk(self, trajs):
+        lats = []
+        lngs = []
+        seconds = []
+        traj_idxs = []
+        for traj_idx, traj in enumerate(trajs):
+            pt_list = traj.pt_list
+            lats.extend([pt.lat for pt in pt_list])
+            lngs.extend([pt.lng for pt in pt_list])
+            seconds.extend([to_epoch(pt.time) for pt in pt_list])
+            traj_idxs.extend([traj_idx] * len(pt_list))
+        self.nb_trajs += len(trajs)
+        self.nb_pts += len(lats)
+        if len(lats) == 0:
+            return
+        ts, ts_mask = self.temporal_idx.epochs_to_ts(seconds)
+        mat_row_idxs, mat_col_idxs, mask = self.grid.get_matrix_idxs(lats, lngs)
+        mask &= ts_mask
+        self.nb_dropped_pts += len(lats) - int(mask.sum())
+        ts = ts[mask]
+        cells = mat_row_idxs[mask] * self.grid.col_num + mat_col_idxs[mask]
+        traj_idxs = np.array(traj_idxs, dtype=np.int64)[mask]
+        if len(cells) == 0:
+            return
+        # transitions
+        is_transition = (traj_idxs[1:] == traj_idxs[:-1]) & (cells[1:] != cells[:-1])
+        from_cells = cells[:-1][is_transition]
+        to_cells = cells[1:][is_transition]
+        transition_ts = ts[1:][is_transition]
+        nb_flow_cells = self.temporal_idx.ts_num * self.nb_cells
+        self.outflow += np.bincount(transition_ts * self.nb_cells + from_cells,
+                                    minlength=nb_flow_cells).reshape(self.outflow.shape)
+        self.inflow += np.bincount(transition_ts * self.nb_cells + to_cells,
+                                   minlength=nb_flow_cells).reshape(self.inflow.shape)
+        # od, the first and the last remaining points of the trajectories
+        is_first = np.ones(len(cells), dtype=bool)
+        is_first[1:] = traj_idxs[1:] != traj_idxs[:-1]
+        is_last = np.ones(len(cells), dtype=bool)
+        is_last[:-1] = is_first[1:]
+        od_keys = (ts[is_first] * self.nb_cells + cells[is_first]) * self.nb_cells + cells[is_last]
+        self.add_od(*np.unique(od_keys, return_counts=True))
+
+    def add_od(self, od_keys, od_counts):
+        keys, inverse = np.unique(np.concatenate([self.od_keys, od_keys]), return_inverse=True)
+        self.od_counts = np.bincount(inverse.ravel(), weights=np.concatenate([self.od_counts, od_counts]),
+                                     minlength=len(keys)).astype(np.int64)
+        self.od_keys = keys
+
+    def merge(self, other):
+        """
+        add the partial tensors of another builder of the same grid and time slots
+        """
+        if self.inflow.shape != other.inflow.shape:
+            raise Exception('cannot merge the flow tensors of different grids or time slots')
+        return self.merge_coo(*other.to_coo())
+
+    def to_coo(self):
+        """
+        the partial tensors as sparse arrays, which are cheaper to send between processes than the dense tensors
+        :return: (inflow keys, inflow counts, outflow keys, outflow counts, od keys, od counts, # of trajs, # of pts,
+        # of dropped pts), the keys are the linear indices of the tensors
+        """
+        inflow_keys = np.flatnonzero(self.inflow)
+        outflow_keys = np.flatnonzero(self.outflow)
+        return (inflow_keys, self.inflow.ravel()[inflow_keys], outflow_keys, self.outflow.ravel()[outflow_keys],
+                self.od_keys, self.od_counts, self.nb_trajs, self.nb_pts, self.nb_dropped_pts)
+
+    def merge_coo(self, inflow_keys, inflow_counts, outflow_keys, outflow_counts, od_keys, od_counts,
+                  nb_trajs=0, nb_pts=0, nb_dropped_pts=0):
+        """
+        add the partial tensors of the same grid and time slots in the form of to_coo()
+        """
+        self.inflow.reshape(-1)[inflow_keys] += inflow_counts
+        self.outflow.reshape(-1)[outflow_keys] += outflow_counts
+        self.add_od(od_keys, od_counts)
+        self.nb_trajs += nb_trajs
+        self.nb_pts += nb_pts
+        self.nb_dropped_pts += nb_dropped_pts
+        return self
+
+    def get_od(self):
+        """
+        :return: the dense od tensor (ts_num, nb_cells, nb_cells), the cells are linear matrix indices
+        (mat_row_idx * col_num + mat_col_idx)
+        """
+        od = np.zeros(self.temporal_idx.ts_num * self.nb_cells * self.nb_cells, dtype=np.int64)
+        od[self.od_keys] = self.od_counts
+        return od.reshape((self.temporal_idx.ts_num, self.nb_cells, self.nb_cells))
+
+    def report(self):
+        print('# of trajs:{}, # of pts:{}, # of dropped pts:{}, # of transitions:{}, # of od pairs:{}'.format(
+            self.nb_trajs, self.nb_pts, self.nb_dropped_pts, int(self.inflow.sum()), len(self.od_keys)))
+
+
+def store_flow_tensors(builder, target_dir):
+    os.makedirs(target_dir, exist_ok=True)
+    np.save(os.path.join(target_dir, 'inflow.npy'), builder.inflow)
+    np.save(os.path.join(target_dir, 'outflow.npy'), builder.outflow)
+    np.save(os.path.join(target_dir, 'od_keys.npy'), builder.od_keys)
+    np.save(os.path.join(target_dir, 'od_counts.npy'), builder.od_counts)
+    with open(os.path.join(target_dir, 'meta.json'), 'w') as f:
+        json.dump({'ts_num': builder.temporal_idx.ts_num, 'row_num': builder.grid.row_num,
+                   'col_num': builder.grid.col_num, 'nb_trajs': builder.nb_trajs}, f)
+
+
+def load_flow_tensors(input_dir, mmap=True):
+    """
+    :param input_dir: the directory generated by store_flow_tensors
+    :param mmap: memory-map the tensors instead of reading them into memory
+    :return: {'inflow', 'outflow', 'od_keys', 'od_counts', and the meta}
+    """
+    mmap_mode = 'r' if mmap else None
+    with open(os.path.join(input_dir, 'meta.json'), 'r') as f:
+        tensors = json.load(f)
+    for name in ['inflow', 'outflow', 'od_keys', 'od_counts']:
+        tensors[name] = np.load(os.path.join(input_dir, name + '.npy'), mmap_mode=mmap_mode)
+    return tensors
+
+
+def flow_worker(state, input_path):
+    builder, traj_type = state
+    partial = FlowTensorBuilder(builder.grid, builder.temporal_idx)
+    partial.add_trajs(parse_traj_file(input_path, traj_type))
+    return partial.to_coo()
+
+
+def build_flow_tensors(builder, input_paths, nb_workers=1, traj_type='raw'):
+    """
+    accumulate the trajectory files into the builder, each file is accumulated as a shard
+    :param builder: FlowTensorBuilder
+    :param input_paths: the trajectory files
+    :param nb_workers: the number of worker processes (see fork_map()), accumulate in the current process if <= 1
+    :param traj_type: see parse_traj_file()
+    :return: the builder
+    """
+    if nb_workers <= 1:
+        for input_path in input_paths:
+            builder.add_trajs(parse_traj_file(input_path, traj_type))
+        return builder
+    for partial in fork_map(flow_worker, (builder, traj_type), input_paths, nb_workers):
+        builder.merge_coo(*partial)
+    return builder
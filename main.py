@@ -5,6 +5,14 @@ from common.trajectory import STPoint
 from noise_filtering import STFilter, HeuristicFilter
 from segmentation import TimeIntervalSegmentation, StayPointSegmentation
 from map_matching.hmm.hmm_map_matcher import TIHMMMapMatcher
+from map_matching.nearest_edge_map_matcher import NearestEdgeMapMatcher
+from map_matching.downsampling import DownsampledMapMatcher
+from map_matching.ubodt import build_ubodt, store_ubodt, load_ubodt
+from map_matching.contraction_hierarchy import build_ch, store_ch, load_ch
+from map_matching.landmarks import build_landmarks, store_landmarks, load_landmarks
+from map_matching.benchmark import beam_report
+from map_matching.parallel import parallel_match
+from map_matching.profiler import MatchProfiler, store_profile
 from common.mbr import MBR
 from datetime import datetime
 import os
@@ -64,13 +72,86 @@ def clean_tdrive(tdrive_root_dir, clean_traj_dir):
             store_traj_file(clean_trajs, os.path.join(clean_traj_dir, filename))
 
 
-def mm_tdrive(clean_traj_dir, mm_traj_dir, rn_path):
+def mm_tdrive(clean_traj_dir, mm_traj_dir, rn_path, ubodt_path=None, ch_path=None, landmarks_path=None,
+              beam_width=None, max_nb_candidates=None, nb_workers=1, mm_mode='hmm',
+              downsample=False, profile_path=None):
     rn = load_rn_shp(rn_path, is_directed=True)
-    map_matcher = TIHMMMapMatcher(rn)
-    for filename in tqdm(os.listdir(clean_traj_dir)):
-        clean_trajs = parse_traj_file(os.path.join(clean_traj_dir, filename))
-        mm_trajs = [map_matcher.match(clean_traj) for clean_traj in clean_trajs]
-        store_traj_file(mm_trajs, os.path.join(mm_traj_dir, filename), traj_type='mm')
+    router = None
+    if ubodt_path is not None:
+        router = load_ubodt(ubodt_path)
+    elif ch_path is not None:
+        router = load_ch(ch_path)
+    landmarks = None
+    if landmarks_path is not None:
+        landmarks = load_landmarks(landmarks_path)
+    profiler = None
+    if profile_path is not None:
+        # the profilers of the worker processes are not sent back
+        if mm_mode != 'hmm' or nb_workers > 1:
+            raise Exception('profiling is only supported by the hmm mode with a single worker')
+        profiler = MatchProfiler()
+    if mm_mode == 'hmm':
+        map_matcher = TIHMMMapMatcher(rn, router=router, landmarks=landmarks, beam_width=beam_width,
+                                      max_nb_candidates=max_nb_candidates, profiler=profiler)
+    elif mm_mode == 'nearest':
+        map_matcher = NearestEdgeMapMatcher(rn, router=router, landmarks=landmarks)
+    else:
+        raise Exception('unknown map matching mode')
+    if downsample:
+        map_matcher = DownsampledMapMatcher(map_matcher)
+    filenames = os.listdir(clean_traj_dir)
+
+    def iter_tasks():
+        for file_idx, filename in enumerate(filenames):
+            for clean_traj in parse_traj_file(os.path.join(clean_traj_dir, filename)):
+                yield file_idx, clean_traj
+
+    # the results are in the input order, a file is stored once the trajectories of the next file arrive
+    cur_file_idx = 0
+    mm_trajs = []
+    for file_idx, mm_traj in tqdm(parallel_match(map_matcher, iter_tasks(), nb_workers, keep_road_paths=False)):
+        while cur_file_idx < file_idx:
+            store_traj_file(mm_trajs, os.path.join(mm_traj_dir, filenames[cur_file_idx]), traj_type='mm')
+            mm_trajs = []
+            cur_file_idx += 1
+        mm_trajs.append(mm_traj)
+    while cur_file_idx < len(filenames):
+        store_traj_file(mm_trajs, os.path.join(mm_traj_dir, filenames[cur_file_idx]), traj_type='mm')
+        mm_trajs = []
+        cur_file_idx += 1
+    # the counters are in the worker processes if matched in parallel
+    if nb_workers <= 1 and hasattr(map_matcher, 'report'):
+        map_matcher.report()
+    if profiler is not None:
+        profiler.report()
+        store_profile(profiler, profile_path)
+
+
+def mm_report(clean_traj_dir, rn_path, nb_files=50):
+    rn = load_rn_shp(rn_path, is_directed=True)
+    trajs = []
+    for filename in sorted(os.listdir(clean_traj_dir))[:nb_files]:
+        trajs.extend(parse_traj_file(os.path.join(clean_traj_dir, filename)))
+    print('# of benchmark trajectories:{}'.format(len(trajs)))
+    beam_report(rn, trajs)
+
+
+def precompute_ubodt(rn_path, ubodt_path, delta):
+    rn = load_rn_shp(rn_path, is_directed=True)
+    ubodt = build_ubodt(rn, delta)
+    store_ubodt(ubodt, ubodt_path)
+
+
+def precompute_ch(rn_path, ch_path):
+    rn = load_rn_shp(rn_path, is_directed=True)
+    ch = build_ch(rn)
+    store_ch(ch, ch_path)
+
+
+def precompute_landmarks(rn_path, landmarks_path):
+    rn = load_rn_shp(rn_path, is_directed=True)
+    landmarks = build_landmarks(rn)
+    store_landmarks(landmarks, landmarks_path)
 
 
 if __name__ == '__main__':
@@ -79,15 +160,35 @@ if __name__ == '__main__':
     parser.add_argument('--clean_traj_dir', help='the directory of the cleaned trajectories')
     parser.add_argument('--rn_path', help='the road network data path generated by osm2rn')
     parser.add_argument('--mm_traj_dir', help='the directory of the map-matched trajectories')
-    parser.add_argument('--phase', help='the preprocessing phase [clean,mm,stat]')
+    parser.add_argument('--ubodt_path', help='the directory of the precomputed upper-bounded origin-destination table')
+    parser.add_argument('--ubodt_delta', type=float, default=3000.0, help='the upper bound (meter) of the ubodt')
+    parser.add_argument('--ch_path', help='the directory of the precomputed contraction hierarchy')
+    parser.add_argument('--landmarks_path', help='the directory of the precomputed ALT landmarks')
+    parser.add_argument('--beam_width', type=int, help='the number of states kept by the beam-pruned viterbi')
+    parser.add_argument('--max_nb_candidates', type=int, help='the number of candidates kept for each point')
+    parser.add_argument('--mm_mode', default='hmm', help='the map matching mode [hmm,nearest]')
+    parser.add_argument('--downsample', action='store_true', help='only match the key points of the trajectories')
+    parser.add_argument('--profile_path', help='the path of the map matching profile (json)')
+    parser.add_argument('--nb_workers', type=int, default=1, help='the number of map matching processes')
+    parser.add_argument('--phase', help='the preprocessing phase [clean,ubodt,ch,landmarks,mm,mm_report,stat]')
 
     opt = parser.parse_args()
     print(opt)
 
     if opt.phase == 'clean':
         clean_tdrive(opt.tdrive_root_dir, opt.clean_traj_dir)
+    elif opt.phase == 'ubodt':
+        precompute_ubodt(opt.rn_path, opt.ubodt_path, opt.ubodt_delta)
+    elif opt.phase == 'ch':
+        precompute_ch(opt.rn_path, opt.ch_path)
+    elif opt.phase == 'landmarks':
+        precompute_landmarks(opt.rn_path, opt.landmarks_path)
     elif opt.phase == 'mm':
-        mm_tdrive(opt.clean_traj_dir, opt.mm_traj_dir, opt.rn_path)
+        mm_tdrive(opt.clean_traj_dir, opt.mm_traj_dir, opt.rn_path, opt.ubodt_path, opt.ch_path,
+                  opt.landmarks_path, opt.beam_width, opt.max_nb_candidates, opt.nb_workers,
+                  opt.mm_mode, opt.downsample, opt.profile_path)
+    elif opt.phase == 'mm_report':
+        mm_report(opt.clean_traj_dir, opt.rn_path)
     elif opt.phase == 'stat':
         statistics(opt.clean_traj_dir)
     else:
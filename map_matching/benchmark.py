@@ -0,0 +1,73 @@
+"""
+Accuracy/speed report of the approximate map matching modes, using the exact HMM map matching as the ground truth.
+The accuracy is the ratio of points matched to the same edge as the exact matching.
+"""
+from .hmm.hmm_map_matcher import TIHMMMapMatcher
+from .candidate_point import CandidateCache
+from .utils import ShortestPathCache
+import time
+
+
+def match_eids(map_matcher, trajs):
+    """
+    :return: (the matched eid of each point of each trajectory (None if unmatched), runtime in seconds)
+    """
+    start = time.time()
+    results = []
+    for traj in trajs:
+        mm_traj = map_matcher.match(traj)
+        results.append([pt.data['candi_pt'].eid if pt.data['candi_pt'] is not None else None
+                        for pt in mm_traj.pt_list])
+    return results, time.time() - start
+
+
+def cal_accuracy(ref_results, results):
+    nb_pts = 0
+    nb_same = 0
+    for ref_eids, eids in zip(ref_results, results):
+        nb_pts += len(ref_eids)
+        nb_same += sum([1 for ref_eid, eid in zip(ref_eids, eids) if ref_eid == eid])
+    return nb_same / nb_pts if nb_pts > 0 else 1.0
+
+
+def beam_report(rn, trajs, settings=((10, 20), (5, 10), (3, 5)), **kwargs):
+    """
+    :param rn: the road network
+    :param trajs: the benchmark trajectories
+    :param settings: list of (beam_width, max_nb_candidates)
+    :param kwargs: other arguments of TIHMMMapMatcher, e.g., router. The given sp_cache/candidate_cache only set the
+    cache sizes, each setting starts with empty caches, so that no setting runs against the caches warmed up by the
+    previous ones
+    :return: list of dict, the first one is the exact matching
+    """
+    sp_cache = kwargs.pop('sp_cache', None)
+    candidate_cache = kwargs.pop('candidate_cache', None)
+    reports = []
+    ref_results = None
+    ref_runtime = None
+    for beam_width, max_nb_candidates in [(None, None)] + list(settings):
+        if sp_cache is not None:
+            kwargs['sp_cache'] = ShortestPathCache(sp_cache.max_size)
+        if candidate_cache is not None:
+            kwargs['candidate_cache'] = CandidateCache(candidate_cache.max_size, candidate_cache.cell_size)
+        map_matcher = TIHMMMapMatcher(rn, beam_width=beam_width, max_nb_candidates=max_nb_candidates, **kwargs)
+        results, runtime = match_eids(map_matcher, trajs)
+        if ref_results is None:
+            ref_results, ref_runtime = results, runtime
+        report = {
+            'beam_width': beam_width,
+            'max_nb_candidates': max_nb_candidates,
+            'runtime': runtime,
+            'speedup': ref_runtime / runtime if runtime > 0 else float('inf'),
+            'accuracy': cal_accuracy(ref_results, results),
+            'nb_unmatched_pts': sum([eids.count(None) for eids in results]),
+            # the cache misses are routed, the hits are not
+            'nb_routing_queries': map_matcher.sp_cache.misses
+        }
+        print('beam_width:{}, max_nb_candidates:{}, runtime:{:.2f}s, speedup:{:.2f}, accuracy:{:.4f}, '
+              '# of unmatched pts:{}, # of routing queries:{}'.format(beam_width, max_nb_candidates, runtime,
+                                                                      report['speedup'], report['accuracy'],
+                                                                      report['nb_unmatched_pts'],
+                                                                      report['nb_routing_queries']))
+        reports.append(report)
+    return reports
@@ -1,5 +1,10 @@
-from ..common.spatial_func import SPoint, LAT_PER_METER, LNG_PER_METER, project_pt_to_segment, distance
+from ..common.spatial_func import SPoint, LAT_PER_METER, LNG_PER_METER, DEG_TO_KM, project_pt_to_segment, distance
+from ..common.spatial_func import cal_loc_along_line, haversine_distances, SEG_POS_BITS, cal_edge_geometry
 from ..common.mbr import MBR
+from .utils import LRUCache
+from collections import OrderedDict
+import numpy as np
+import math
 
 
 class CandidatePoint(SPoint):
@@ -19,15 +24,189 @@ class CandidatePoint(SPoint):
         return hash(self.__str__())
 
 
-def get_candidates(pt, rn, search_dist):
+class CandidateTable:
+    """
+    The candidates of all the points of a trajectory in flat arrays,
+    the candidates of the i-th point are in [step_offsets[i], step_offsets[i+1]).
+    """
+    def __init__(self, step_offsets, eid, lat, lng, error, offset):
+        self.step_offsets = step_offsets
+        self.eid = eid
+        self.lat = lat
+        self.lng = lng
+        self.error = error
+        self.offset = offset
+
+    def __len__(self):
+        return len(self.step_offsets) - 1
+
+    def nb_candidates(self, i):
+        return int(self.step_offsets[i + 1] - self.step_offsets[i])
+
+    def get_candidates(self, i):
+        """
+        :param i: the index of the point
+        :return: the candidate points of the i-th point, None if no candidate (same as get_candidates())
+        """
+        start, end = int(self.step_offsets[i]), int(self.step_offsets[i + 1])
+        if start == end:
+            return None
+        return [CandidatePoint(lat, lng, eid, error, offset) for eid, lat, lng, error, offset in
+                zip(self.eid[start:end].tolist(), self.lat[start:end].tolist(), self.lng[start:end].tolist(),
+                    self.error[start:end].tolist(), self.offset[start:end].tolist())]
+
+
+class CandidateCache(LRUCache):
+    """
+    Bounded LRU cache of the nearby edges (segments if the segment index is built) of grid cells, shared across
+    trajectories, since GPS points of different vehicles often fall close to each other.
+    key: (x, y, search_dist, use_seg_idx) of the cell,
+    value: (ids, bboxes) of the eids (segment ids) intersecting the search box of any point in the cell, i.e., a
+    superset of the range query result of each point in the cell, filtered by the bboxes for the exact result.
+    The projections are always recomputed, so the candidates are exact.
+    Note: the cache is not aware of road network updates, call clear() after modifying the road network
+    """
+    def __init__(self, max_size=100000, cell_size=10.0):
+        """
+        :param max_size: the max number of cached cells
+        :param cell_size: the size (meter) of the grid cells
+        """
+        super(CandidateCache, self).__init__(max_size)
+        self.cell_size = cell_size
+
+    def load_cells(self, rn, keys):
+        """
+        query the nearby edges (segments) of the cells by one bulk index query and cache them
+        :param rn: the road network
+        :param keys: the keys of the cells
+        :return: the values of the cells
+        """
+        use_seg_idx = rn.seg_spatial_idx is not None
+        cell_lat = self.cell_size * LAT_PER_METER
+        cell_lng = self.cell_size * LNG_PER_METER
+        cells = np.array([(x, y) for x, y, _, _ in keys], dtype=np.float64)
+        # one more meter as the margin of the rounding errors of the cell boundaries
+        margins = np.array([search_dist + 1.0 for _, _, search_dist, _ in keys], dtype=np.float64)
+        mins = np.stack([cells[:, 0] * cell_lng - margins * LNG_PER_METER,
+                         cells[:, 1] * cell_lat - margins * LAT_PER_METER], axis=1)
+        maxs = np.stack([(cells[:, 0] + 1) * cell_lng + margins * LNG_PER_METER,
+                         (cells[:, 1] + 1) * cell_lat + margins * LAT_PER_METER], axis=1)
+        if use_seg_idx:
+            ids, counts = rn.segment_range_query_batch(mins, maxs)
+        else:
+            ids, counts = rn.range_query_batch(mins, maxs)
+        ids = ids.astype(np.int64)
+        values = []
+        for key, cell_ids in zip(keys, np.split(ids, np.cumsum(counts)[:-1])):
+            value = (cell_ids, cal_entry_bboxes(rn, cell_ids, use_seg_idx))
+            self.put(key, value)
+            values.append(value)
+        return values
+
+    def range_query(self, rn, pt, search_dist):
+        """
+        :return: the ids of a single point, see range_query_batch()
+        """
+        use_seg_idx = rn.seg_spatial_idx is not None
+        key = (int(math.floor(pt.lng / (self.cell_size * LNG_PER_METER))),
+               int(math.floor(pt.lat / (self.cell_size * LAT_PER_METER))), search_dist, use_seg_idx)
+        is_cached, value = self.get(key)
+        if not is_cached:
+            value = self.load_cells(rn, [key])[0]
+        ids, bboxes = value
+        mask = (bboxes[:, 0] <= pt.lng + search_dist * LNG_PER_METER) & \
+               (bboxes[:, 2] >= pt.lng - search_dist * LNG_PER_METER) & \
+               (bboxes[:, 1] <= pt.lat + search_dist * LAT_PER_METER) & \
+               (bboxes[:, 3] >= pt.lat - search_dist * LAT_PER_METER)
+        return ids[mask]
+
+    def range_query_batch(self, rn, lats, lngs, search_dist):
+        """
+        :param rn: the road network
+        :param lats: the lat of the points
+        :param lngs: the lng of the points
+        :param search_dist: the search distance (meter)
+        :return: (ids, counts), the same as RoadNetwork.range_query_batch() (segment_range_query_batch() if the
+        segment index is built), except for the order of the ids of each point
+        """
+        use_seg_idx = rn.seg_spatial_idx is not None
+        cell_lat = self.cell_size * LAT_PER_METER
+        cell_lng = self.cell_size * LNG_PER_METER
+        xs = np.floor(lngs / cell_lng).astype(np.int64).tolist()
+        ys = np.floor(lats / cell_lat).astype(np.int64).tolist()
+        values = []
+        # key -> indices of the points
+        missed = OrderedDict()
+        for i, (x, y) in enumerate(zip(xs, ys)):
+            key = (x, y, search_dist, use_seg_idx)
+            is_cached, value = self.get(key)
+            values.append(value)
+            if not is_cached:
+                missed.setdefault(key, []).append(i)
+        if len(missed) > 0:
+            for pt_indices, value in zip(missed.values(), self.load_cells(rn, list(missed))):
+                for i in pt_indices:
+                    values[i] = value
+        # the same intersection test as the rtree, for all the points at once
+        pt_indices = np.repeat(np.arange(len(values)), [len(ids) for ids, _ in values])
+        ids = np.concatenate([ids for ids, _ in values])
+        bboxes = np.concatenate([bboxes for _, bboxes in values])
+        pt_lats = lats[pt_indices]
+        pt_lngs = lngs[pt_indices]
+        mask = (bboxes[:, 0] <= pt_lngs + search_dist * LNG_PER_METER) & \
+               (bboxes[:, 2] >= pt_lngs - search_dist * LNG_PER_METER) & \
+               (bboxes[:, 1] <= pt_lats + search_dist * LAT_PER_METER) & \
+               (bboxes[:, 3] >= pt_lats - search_dist * LAT_PER_METER)
+        return ids[mask], np.bincount(pt_indices[mask], minlength=len(values))
+
+
+def cal_entry_bboxes(rn, ids, use_seg_idx):
+    """
+    :return: (n, 4) array of the (min_lng, min_lat, max_lng, max_lat) of the edges (segments)
+    """
+    bboxes = np.zeros((len(ids), 4), dtype=np.float64)
+    for i, entry_id in enumerate(ids.tolist()):
+        if use_seg_idx:
+            eid, pos = entry_id >> SEG_POS_BITS, entry_id & ((1 << SEG_POS_BITS) - 1)
+            u, v = rn.edge_idx[eid]
+            coords = rn[u][v]['coords'][pos:pos + 2]
+        else:
+            u, v = rn.edge_idx[entry_id]
+            coords = rn[u][v]['coords']
+        mbr = MBR.cal_mbr(coords)
+        bboxes[i] = (mbr.min_lng, mbr.min_lat, mbr.max_lng, mbr.max_lat)
+    return bboxes
+
+
+def get_candidates(pt, rn, search_dist, cache=None):
+    """
+    :param cache: optional CandidateCache to reuse the nearby edges of the cell
+    """
     candidates = None
     mbr = MBR(pt.lat - search_dist * LAT_PER_METER,
               pt.lng - search_dist * LNG_PER_METER,
               pt.lat + search_dist * LAT_PER_METER,
               pt.lng + search_dist * LNG_PER_METER)
-    candidate_edges = rn.range_query(mbr)
-    if len(candidate_edges) > 0:
+    if cache is not None:
+        ids = cache.range_query(rn, pt, search_dist)
+        if rn.seg_spatial_idx is not None:
+            candidate_segs = {}
+            for seg_id in ids.tolist():
+                eid, pos = seg_id >> SEG_POS_BITS, seg_id & ((1 << SEG_POS_BITS) - 1)
+                candidate_segs.setdefault(rn.edge_idx[eid], []).append(pos)
+            candi_pt_list = [cal_candidate_point(pt, rn, candidate_edge, sorted(seg_positions))
+                             for candidate_edge, seg_positions in candidate_segs.items()]
+        else:
+            candi_pt_list = [cal_candidate_point(pt, rn, rn.edge_idx[eid]) for eid in ids.tolist()]
+    elif rn.seg_spatial_idx is not None:
+        # only project onto the segments intersecting the search box
+        candidate_segs = rn.segment_range_query(mbr)
+        candi_pt_list = [cal_candidate_point(pt, rn, candidate_edge, seg_positions)
+                         for candidate_edge, seg_positions in candidate_segs.items()]
+    else:
+        candidate_edges = rn.range_query(mbr)
         candi_pt_list = [cal_candidate_point(pt, rn, candidate_edge) for candidate_edge in candidate_edges]
+    if len(candi_pt_list) > 0:
         # refinement
         candi_pt_list = [candi_pt for candi_pt in candi_pt_list if candi_pt.error <= search_dist]
         if len(candi_pt_list) > 0:
@@ -35,13 +214,179 @@ def get_candidates(pt, rn, search_dist):
     return candidates
 
 
-def cal_candidate_point(raw_pt, rn, edge):
+def cal_candidate_point(raw_pt, rn, edge, seg_positions=None):
+    """
+    :param seg_positions: the sorted positions of the segments to project onto, all the segments if None
+    """
     u, v = edge
-    coords = rn[u][v]['coords']
-    candidates = [project_pt_to_segment(coords[i], coords[i + 1], raw_pt) for i in range(len(coords) - 1)]
-    idx, (projection, rate, dist) = min(enumerate(candidates), key=lambda v: v[1][2])
+    edge_data = rn[u][v]
+    if 'xy' in edge_data:
+        return cal_candidate_point_planar(raw_pt, edge_data, seg_positions)
+    coords = edge_data['coords']
+    if seg_positions is None:
+        seg_positions = range(len(coords) - 1)
+    candidates = [(i, project_pt_to_segment(coords[i], coords[i + 1], raw_pt)) for i in seg_positions]
+    idx, (projection, rate, dist) = min(candidates, key=lambda v: v[1][2])
     offset = 0.0
     for i in range(idx):
         offset += distance(coords[i], coords[i + 1])
     offset += distance(coords[idx], projection)
     return CandidatePoint(projection.lat, projection.lng, rn[u][v]['eid'], dist, offset)
+
+
+def cal_candidate_point_planar(raw_pt, edge_data, seg_positions=None):
+    """
+    project the point onto the segments in the local planar coordinates precomputed at load time (see
+    cal_edge_geometry), the offset reuses the cumulative offsets instead of summing up the preceding segments
+    """
+    coords = edge_data['coords']
+    xy = edge_data['xy'].tolist()
+    if seg_positions is None:
+        seg_positions = range(len(coords) - 1)
+    tx = (raw_pt.lng - coords[0].lng) * DEG_TO_KM * math.cos(math.radians(coords[0].lat))
+    ty = (raw_pt.lat - coords[0].lat) * DEG_TO_KM
+    # no trigonometric functions are needed in the planar coordinates
+    idx, rate, min_sq_dist = None, 0.0, float('inf')
+    for i in seg_positions:
+        (ax, ay), (bx, by) = xy[i], xy[i + 1]
+        dx, dy = bx - ax, by - ay
+        sq_length = dx * dx + dy * dy
+        r = ((tx - ax) * dx + (ty - ay) * dy) / sq_length if sq_length > 0.0 else 0.0
+        r = min(max(r, 0.0), 1.0)
+        ex, ey = ax + r * dx - tx, ay + r * dy - ty
+        sq_dist = ex * ex + ey * ey
+        if sq_dist < min_sq_dist:
+            idx, rate, min_sq_dist = i, r, sq_dist
+    if rate >= 1:
+        projection = SPoint(coords[idx + 1].lat, coords[idx + 1].lng)
+    elif rate <= 0:
+        projection = SPoint(coords[idx].lat, coords[idx].lng)
+    else:
+        projection = cal_loc_along_line(coords[idx], coords[idx + 1], rate)
+    offset = edge_data['cum_offsets'][idx] + distance(coords[idx], projection)
+    return CandidatePoint(projection.lat, projection.lng, edge_data['eid'], distance(raw_pt, projection), float(offset))
+
+
+def get_candidates_batch(pt_list, rn, search_dist, cache=None):
+    """
+    the candidates of all the points at once: one bulk index query over all the search boxes, and the projections of
+    all the (point, segment) pairs are vectorized. The candidates are the same as calling get_candidates() point by point.
+    :param pt_list: the points of the trajectory
+    :param rn: the road network
+    :param search_dist: the search distance (meter)
+    :param cache: optional CandidateCache to reuse the nearby edges of the cells instead of the bulk index query
+    :return: CandidateTable
+    """
+    nb_pts = len(pt_list)
+    lats = np.array([pt.lat for pt in pt_list], dtype=np.float64)
+    lngs = np.array([pt.lng for pt in pt_list], dtype=np.float64)
+    if nb_pts == 0:
+        return empty_candidate_table(nb_pts)
+    mins = np.stack([lngs - search_dist * LNG_PER_METER, lats - search_dist * LAT_PER_METER], axis=1)
+    maxs = np.stack([lngs + search_dist * LNG_PER_METER, lats + search_dist * LAT_PER_METER], axis=1)
+    if rn.seg_spatial_idx is not None:
+        if cache is not None:
+            seg_ids, counts = cache.range_query_batch(rn, lats, lngs, search_dist)
+        else:
+            seg_ids, counts = rn.segment_range_query_batch(mins, maxs)
+        seg_ids = seg_ids.astype(np.int64)
+        pair_eids = seg_ids >> SEG_POS_BITS
+        pair_positions = seg_ids & ((1 << SEG_POS_BITS) - 1)
+    else:
+        if cache is not None:
+            pair_eids, counts = cache.range_query_batch(rn, lats, lngs, search_dist)
+        else:
+            pair_eids, counts = rn.range_query_batch(mins, maxs)
+        pair_eids = pair_eids.astype(np.int64)
+        pair_positions = None
+    if len(pair_eids) == 0:
+        return empty_candidate_table(nb_pts)
+    pair_pts = np.repeat(np.arange(nb_pts), counts.astype(np.int64))
+    # gather the geometry of each edge once for the whole trajectory
+    edge_eids = np.unique(pair_eids)
+    xy_list, cum_offsets_list, lat_lng_list = [], [], []
+    for eid in edge_eids.tolist():
+        u, v = rn.edge_idx[eid]
+        edge_data = rn[u][v]
+        coords = edge_data['coords']
+        geometry = edge_data if 'xy' in edge_data else cal_edge_geometry(coords)
+        xy_list.append(geometry['xy'])
+        cum_offsets_list.append(geometry['cum_offsets'])
+        lat_lng_list.extend((coord.lat, coord.lng) for coord in coords)
+    nb_coords = np.array([len(xy) for xy in xy_list], dtype=np.int64)
+    bases = np.zeros(len(edge_eids), dtype=np.int64)
+    np.cumsum(nb_coords[:-1], out=bases[1:])
+    flat_xy = np.concatenate(xy_list)
+    flat_cum_offsets = np.concatenate(cum_offsets_list)
+    flat_lat_lng = np.array(lat_lng_list, dtype=np.float64)
+    origin_lats = flat_lat_lng[bases, 0]
+    origin_lngs = flat_lat_lng[bases, 1]
+    origin_cos = np.array([math.cos(math.radians(lat)) for lat in origin_lats.tolist()], dtype=np.float64)
+    pair_edges = np.searchsorted(edge_eids, pair_eids)
+    # pairs of the same (point, edge) form a contiguous group, ordered as the edges are returned by the index
+    if pair_positions is None:
+        nb_segs = nb_coords[pair_edges] - 1
+        groups = np.repeat(np.arange(len(pair_edges)), nb_segs)
+        group_bases = np.zeros(len(pair_edges), dtype=np.int64)
+        np.cumsum(nb_segs[:-1], out=group_bases[1:])
+        pair_positions = np.arange(len(groups)) - group_bases[groups]
+        pair_pts = pair_pts[groups]
+        pair_edges = pair_edges[groups]
+    else:
+        keys = pair_pts * (len(edge_eids) + 1) + pair_edges
+        _, first_seen, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        ranks = np.empty(len(first_seen), dtype=np.int64)
+        ranks[np.argsort(first_seen, kind='stable')] = np.arange(len(first_seen))
+        groups = ranks[inverse.reshape(-1)]
+        order = np.lexsort((pair_positions, groups))
+        groups, pair_pts, pair_edges, pair_positions = groups[order], pair_pts[order], pair_edges[order], \
+            pair_positions[order]
+    start_idx = bases[pair_edges] + pair_positions
+    tx = (lngs[pair_pts] - origin_lngs[pair_edges]) * DEG_TO_KM * origin_cos[pair_edges]
+    ty = (lats[pair_pts] - origin_lats[pair_edges]) * DEG_TO_KM
+    rates, sq_dists = project_pt_to_segments(flat_xy[start_idx], flat_xy[start_idx + 1], tx, ty)
+    # the first segment with the min distance in each group
+    group_starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    group_min_sq_dists = np.minimum.reduceat(sq_dists, group_starts)
+    min_pairs = np.flatnonzero(sq_dists == group_min_sq_dists[groups])
+    _, first_min = np.unique(groups[min_pairs], return_index=True)
+    chosen = min_pairs[first_min]
+    pts, a_idx, rates = pair_pts[chosen], start_idx[chosen], rates[chosen]
+    a_lats, a_lngs = flat_lat_lng[a_idx, 0], flat_lat_lng[a_idx, 1]
+    b_lats, b_lngs = flat_lat_lng[a_idx + 1, 0], flat_lat_lng[a_idx + 1, 1]
+    proj_lats = np.where(rates >= 1, b_lats, np.where(rates <= 0, a_lats, a_lats + rates * (b_lats - a_lats)))
+    proj_lngs = np.where(rates >= 1, b_lngs, np.where(rates <= 0, a_lngs, a_lngs + rates * (b_lngs - a_lngs)))
+    offsets = flat_cum_offsets[a_idx] + haversine_distances(a_lats, a_lngs, proj_lats, proj_lngs)
+    errors = haversine_distances(lats[pts], lngs[pts], proj_lats, proj_lngs)
+    # refinement
+    keep = errors <= search_dist
+    step_offsets = np.zeros(nb_pts + 1, dtype=np.int64)
+    np.cumsum(np.bincount(pts[keep], minlength=nb_pts), out=step_offsets[1:])
+    return CandidateTable(step_offsets, edge_eids[pair_edges[chosen]][keep], proj_lats[keep], proj_lngs[keep],
+                          errors[keep], offsets[keep])
+
+
+def empty_candidate_table(nb_pts):
+    empty = np.zeros(0, dtype=np.float64)
+    return CandidateTable(np.zeros(nb_pts + 1, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                          empty, empty, empty, empty)
+
+
+def project_pt_to_segments(starts, ends, tx, ty):
+    """
+    the vectorized projection in the planar coordinates, same as cal_candidate_point_planar()
+    :param starts: (n, 2) array of the start points of the segments
+    :param ends: (n, 2) array of the end points of the segments
+    :param tx: (n,) array of the x of the points
+    :param ty: (n,) array of the y of the points
+    :return: (rates, sq_dists), the rate of each projection along its segment and the squared distance
+    """
+    dx = ends[:, 0] - starts[:, 0]
+    dy = ends[:, 1] - starts[:, 1]
+    sq_lengths = dx * dx + dy * dy
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rates = ((tx - starts[:, 0]) * dx + (ty - starts[:, 1]) * dy) / sq_lengths
+    rates = np.clip(np.where(sq_lengths > 0.0, rates, 0.0), 0.0, 1.0)
+    ex = starts[:, 0] + rates * dx - tx
+    ey = starts[:, 1] + rates * dy - ty
+    return rates, ex * ex + ey * ey
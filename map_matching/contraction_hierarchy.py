@@ -0,0 +1,288 @@
+"""
+Based on Geisberger, Robert, et al. "Contraction hierarchies: Faster and simpler hierarchical routing in road
+networks." International Workshop on Experimental and Efficient Algorithms. Springer, 2008.
+Vertices are contracted one by one in the order of edge difference, shortcuts are added if no witness path exists.
+A query is a bidirectional Dijkstra on the upward graph, and the path is recovered by unpacking the shortcuts
+through their middle vertices.
+"""
+import networkx as nx
+import numpy as np
+import heapq
+import json
+import os
+
+
+class ContractionHierarchy:
+    def __init__(self, nodes, ranks, fwd_offsets, fwd_targets, fwd_costs, fwd_middles,
+                 bwd_offsets, bwd_targets, bwd_costs, bwd_middles, weight):
+        # node id -> node key (coordinate tuple)
+        self.nodes = [tuple(node) for node in nodes.tolist()]
+        # node key -> node id
+        self.node_ids = {node: i for i, node in enumerate(self.nodes)}
+        self.ranks = ranks
+        self.weight = weight
+        # upward graph: node id -> [(higher node id, cost, middle node id)], middle node id is -1 for original edges
+        self.fwd_up = to_adj_list(fwd_offsets, fwd_targets, fwd_costs, fwd_middles)
+        # reversed upward graph: node id -> [(higher node id, cost, middle node id)] for edges higher -> node
+        self.bwd_up = to_adj_list(bwd_offsets, bwd_targets, bwd_costs, bwd_middles)
+
+    def cheapest_path(self, src, dest):
+        """
+        :param src: the source vertex
+        :param dest: the target vertex
+        :return: (cost, vertex path), None if the vertices are not in the hierarchy
+        :raise NetworkXNoPath if dest is not reachable from src
+        """
+        if src == dest:
+            return 0.0, [src]
+        s = self.node_ids.get(src)
+        t = self.node_ids.get(dest)
+        if s is None or t is None:
+            return None
+        cost, meeting, fwd_parents, bwd_parents = self.bidirectional_search(s, t)
+        if meeting is None:
+            raise nx.NetworkXNoPath('No path between {} and {}.'.format(src, dest))
+        path = [s]
+        for u, v, middle in self.chain(fwd_parents, meeting, reverse=True):
+            self.unpack(u, v, middle, path)
+        for u, v, middle in self.chain(bwd_parents, meeting, reverse=False):
+            self.unpack(u, v, middle, path)
+        return cost, [self.nodes[n] for n in path]
+
+    def bidirectional_search(self, s, t):
+        # node id -> (parent node id, middle node id)
+        fwd_parents = {s: None}
+        bwd_parents = {t: None}
+        fwd_dists = {s: 0.0}
+        bwd_dists = {t: 0.0}
+        fwd_queue = [(0.0, s)]
+        bwd_queue = [(0.0, t)]
+        best_cost = float('inf')
+        meeting = None
+        while fwd_queue or bwd_queue:
+            # search the direction with the smaller tentative distance first
+            if fwd_queue and (not bwd_queue or fwd_queue[0][0] <= bwd_queue[0][0]):
+                queue, dists, parents, adj, other_dists = fwd_queue, fwd_dists, fwd_parents, self.fwd_up, bwd_dists
+            else:
+                queue, dists, parents, adj, other_dists = bwd_queue, bwd_dists, bwd_parents, self.bwd_up, fwd_dists
+            d, u = heapq.heappop(queue)
+            if d > dists[u]:
+                continue
+            if d >= best_cost:
+                # both directions cannot improve anymore once the other direction is exhausted or also bounded
+                queue.clear()
+                continue
+            if u in other_dists and d + other_dists[u] < best_cost:
+                best_cost = d + other_dists[u]
+                meeting = u
+            for v, cost, middle in adj[u]:
+                new_d = d + cost
+                if new_d < dists.get(v, float('inf')):
+                    dists[v] = new_d
+                    parents[v] = (u, middle)
+                    heapq.heappush(queue, (new_d, v))
+        return best_cost, meeting, fwd_parents, bwd_parents
+
+    @staticmethod
+    def chain(parents, meeting, reverse):
+        """
+        :return: the edges (u, v, middle) from the search root to the meeting vertex (forward search),
+        or from the meeting vertex to the search root (backward search), in travel order
+        """
+        edges = []
+        n = meeting
+        while parents[n] is not None:
+            p, middle = parents[n]
+            edges.append((p, n, middle) if reverse else (n, p, middle))
+            n = p
+        if reverse:
+            edges.reverse()
+        return edges
+
+    def unpack(self, u, v, middle, path):
+        """
+        append the original vertices of edge u -> v (excluding u) to the path
+        """
+        stack = [(u, v, middle)]
+        while stack:
+            a, b, m = stack.pop()
+            if m < 0:
+                path.append(b)
+            else:
+                # the middle vertex is lower than both a and b
+                stack.append((m, b, self.edge_middle(self.fwd_up[m], b)))
+                stack.append((a, m, self.edge_middle(self.bwd_up[m], a)))
+
+    @staticmethod
+    def edge_middle(adj, target):
+        for v, _, middle in adj:
+            if v == target:
+                return middle
+        raise Exception('edge is missing in the hierarchy')
+
+
+def to_adj_list(offsets, targets, costs, middles):
+    offsets = offsets.tolist()
+    targets = targets.tolist()
+    costs = costs.tolist()
+    middles = middles.tolist()
+    return [list(zip(targets[offsets[i]:offsets[i + 1]], costs[offsets[i]:offsets[i + 1]],
+                     middles[offsets[i]:offsets[i + 1]])) for i in range(len(offsets) - 1)]
+
+
+def to_csr(adj, nb_nodes):
+    offsets = np.zeros(nb_nodes + 1, dtype=np.int64)
+    np.cumsum([len(adj[i]) for i in range(nb_nodes)], out=offsets[1:])
+    targets = np.array([v for i in range(nb_nodes) for v, _, _ in adj[i]], dtype=np.int32)
+    costs = np.array([c for i in range(nb_nodes) for _, c, _ in adj[i]], dtype=np.float64)
+    middles = np.array([m for i in range(nb_nodes) for _, _, m in adj[i]], dtype=np.int32)
+    return offsets, targets, costs, middles
+
+
+class Contractor:
+    """
+    node ordering and contraction over the remaining (uncontracted) graph
+    """
+    def __init__(self, out_edges, in_edges, max_settled_nodes):
+        # node id -> {node id: (cost, middle node id)}
+        self.out_edges = out_edges
+        self.in_edges = in_edges
+        self.max_settled_nodes = max_settled_nodes
+        self.nb_contracted_nbrs = [0] * len(out_edges)
+
+    def witness_dists(self, src, excluded, targets, max_cost):
+        """
+        bounded Dijkstra from src in the remaining graph without the excluded vertex
+        """
+        dists = {src: 0.0}
+        queue = [(0.0, src)]
+        remaining = set(targets)
+        nb_settled = 0
+        while queue and remaining and nb_settled < self.max_settled_nodes:
+            d, u = heapq.heappop(queue)
+            if d > dists[u]:
+                continue
+            if d > max_cost:
+                break
+            remaining.discard(u)
+            nb_settled += 1
+            for v, (cost, _) in self.out_edges[u].items():
+                if v == excluded:
+                    continue
+                new_d = d + cost
+                if new_d < dists.get(v, float('inf')):
+                    dists[v] = new_d
+                    heapq.heappush(queue, (new_d, v))
+        return dists
+
+    def shortcuts(self, v):
+        """
+        :return: the shortcuts [(u, w, cost)] needed if v is contracted
+        """
+        results = []
+        for u, (in_cost, _) in self.in_edges[v].items():
+            targets = {w: in_cost + out_cost for w, (out_cost, _) in self.out_edges[v].items() if w != u}
+            if len(targets) == 0:
+                continue
+            dists = self.witness_dists(u, v, targets, max(targets.values()))
+            for w, via_cost in targets.items():
+                if dists.get(w, float('inf')) > via_cost:
+                    results.append((u, w, via_cost))
+        return results
+
+    def priority(self, v, shortcuts):
+        edge_difference = len(shortcuts) - len(self.in_edges[v]) - len(self.out_edges[v])
+        return edge_difference + self.nb_contracted_nbrs[v]
+
+    def contract(self, v, shortcuts):
+        for u, w, cost in shortcuts:
+            if w not in self.out_edges[u] or self.out_edges[u][w][0] > cost:
+                self.out_edges[u][w] = (cost, v)
+                self.in_edges[w][u] = (cost, v)
+        for u in self.in_edges[v]:
+            del self.out_edges[u][v]
+            self.nb_contracted_nbrs[u] += 1
+        for w in self.out_edges[v]:
+            del self.in_edges[w][v]
+            self.nb_contracted_nbrs[w] += 1
+
+
+def build_ch(rn, weight='length', max_settled_nodes=500):
+    """
+    contraction hierarchy preprocessing
+    :param rn: the road network
+    :param weight: the attribute name to find the routing weight
+    :param max_settled_nodes: the limit of the witness search, a smaller value is faster but adds more shortcuts
+    :return: ContractionHierarchy
+    """
+    nodes = list(rn.nodes)
+    node_ids = {node: i for i, node in enumerate(nodes)}
+    nb_nodes = len(nodes)
+    out_edges = [{} for _ in range(nb_nodes)]
+    in_edges = [{} for _ in range(nb_nodes)]
+    edges = rn.edges(data=weight)
+    if not rn.is_directed():
+        edges = list(edges) + [(v, u, cost) for u, v, cost in edges]
+    for u, v, cost in edges:
+        u, v = node_ids[u], node_ids[v]
+        if u == v:
+            continue
+        if v not in out_edges[u] or out_edges[u][v][0] > cost:
+            out_edges[u][v] = (cost, -1)
+            in_edges[v][u] = (cost, -1)
+    # all the edges of the hierarchy, (u, v) -> (cost, middle node id)
+    ch_edges = {(u, v): out_edges[u][v] for u in range(nb_nodes) for v in out_edges[u]}
+    contractor = Contractor(out_edges, in_edges, max_settled_nodes)
+    queue = [(contractor.priority(v, contractor.shortcuts(v)), v) for v in range(nb_nodes)]
+    heapq.heapify(queue)
+    ranks = np.zeros(nb_nodes, dtype=np.int32)
+    rank = 0
+    while queue:
+        _, v = heapq.heappop(queue)
+        shortcuts = contractor.shortcuts(v)
+        # lazy update
+        new_priority = contractor.priority(v, shortcuts)
+        if queue and new_priority > queue[0][0]:
+            heapq.heappush(queue, (new_priority, v))
+            continue
+        for u, w, cost in shortcuts:
+            if (u, w) not in ch_edges or ch_edges[(u, w)][0] > cost:
+                ch_edges[(u, w)] = (cost, v)
+        contractor.contract(v, shortcuts)
+        ranks[v] = rank
+        rank += 1
+    fwd_up = [[] for _ in range(nb_nodes)]
+    bwd_up = [[] for _ in range(nb_nodes)]
+    for (u, v), (cost, middle) in ch_edges.items():
+        if ranks[u] < ranks[v]:
+            fwd_up[u].append((v, cost, middle))
+        else:
+            bwd_up[v].append((u, cost, middle))
+    print('# of ch edges:{}'.format(len(ch_edges)))
+    return ContractionHierarchy(np.array(nodes, dtype=np.float64), ranks, *to_csr(fwd_up, nb_nodes),
+                                *to_csr(bwd_up, nb_nodes), weight=weight)
+
+
+def store_ch(ch, target_dir):
+    os.makedirs(target_dir, exist_ok=True)
+    nb_nodes = len(ch.nodes)
+    np.save(os.path.join(target_dir, 'nodes.npy'), np.array(ch.nodes, dtype=np.float64))
+    np.save(os.path.join(target_dir, 'ranks.npy'), ch.ranks)
+    for name, adj in [('fwd', ch.fwd_up), ('bwd', ch.bwd_up)]:
+        offsets, targets, costs, middles = to_csr(adj, nb_nodes)
+        np.save(os.path.join(target_dir, name + '_offsets.npy'), offsets)
+        np.save(os.path.join(target_dir, name + '_targets.npy'), targets)
+        np.save(os.path.join(target_dir, name + '_costs.npy'), costs)
+        np.save(os.path.join(target_dir, name + '_middles.npy'), middles)
+    with open(os.path.join(target_dir, 'meta.json'), 'w') as f:
+        json.dump({'weight': ch.weight}, f)
+
+
+def load_ch(input_dir):
+    with open(os.path.join(input_dir, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    arrays = [np.load(os.path.join(input_dir, name + '.npy'))
+              for name in ['nodes', 'ranks',
+                           'fwd_offsets', 'fwd_targets', 'fwd_costs', 'fwd_middles',
+                           'bwd_offsets', 'bwd_targets', 'bwd_costs', 'bwd_middles']]
+    return ContractionHierarchy(*arrays, weight=meta['weight'])
@@ -0,0 +1,172 @@
+"""
+Adaptive downsampling before map matching.
+Only the key points, chosen by the distance, the time interval and the heading change since the last key point, are
+matched by the underlying map matcher. The skipped points are projected onto the matched route between the key
+points around them, so that the matching cost depends on the route complexity rather than the sampling rate.
+"""
+from .map_matcher import MapMatcher
+from .candidate_point import cal_candidate_point
+from .route_constructor import construct_path
+from .utils import find_shortest_path
+from ..common.spatial_func import distance, bearing
+from ..common.trajectory import STPoint, Trajectory
+
+
+def select_key_pts(pt_list, max_dist=200.0, max_interval=60.0, max_heading_change=30.0, min_move_dist=5.0):
+    """
+    :param pt_list: the points of the trajectory
+    :param max_dist: a new key point is selected once the point is max_dist (meter) away from the last key point
+    :param max_interval: a new key point is selected once max_interval (second) passed since the last key point
+    :param max_heading_change: a new key point is selected once the heading changes max_heading_change (degree)
+    from the heading after the last key point
+    :param min_move_dist: the heading is only measured for moves longer than min_move_dist (meter)
+    :return: the indices of the key points, including the first and the last points
+    """
+    if len(pt_list) <= 2:
+        return list(range(len(pt_list)))
+    key_idx = [0]
+    ref_heading = None
+    # the last point used to measure the heading
+    heading_pt = pt_list[0]
+    for i in range(1, len(pt_list) - 1):
+        last_key_pt = pt_list[key_idx[-1]]
+        pt = pt_list[i]
+        heading_change = 0.0
+        if distance(heading_pt, pt) >= min_move_dist:
+            heading = bearing(heading_pt, pt)
+            heading_pt = pt
+            if ref_heading is None:
+                ref_heading = heading
+            else:
+                heading_change = abs(heading - ref_heading) % 360.0
+                heading_change = min(heading_change, 360.0 - heading_change)
+        if distance(last_key_pt, pt) >= max_dist or (pt.time - last_key_pt.time).total_seconds() >= max_interval \
+                or heading_change >= max_heading_change:
+            key_idx.append(i)
+            ref_heading = None
+            heading_pt = pt
+    key_idx.append(len(pt_list) - 1)
+    return key_idx
+
+
+class DownsampledMapMatcher(MapMatcher):
+    def __init__(self, map_matcher, max_dist=200.0, max_interval=60.0, max_heading_change=30.0, min_move_dist=5.0):
+        """
+        :param map_matcher: the map matcher of the key points, its matched points must have the road paths
+        (e.g., TIHMMMapMatcher)
+        :param max_dist, max_interval, max_heading_change, min_move_dist: see select_key_pts()
+        """
+        super(DownsampledMapMatcher, self).__init__(map_matcher.rn, map_matcher.routing_weight, map_matcher.sp_cache,
+                                                    map_matcher.router, map_matcher.landmarks)
+        self.map_matcher = map_matcher
+        self.max_dist = max_dist
+        self.max_interval = max_interval
+        self.max_heading_change = max_heading_change
+        self.min_move_dist = min_move_dist
+        self.nb_key_pts = 0
+        self.nb_pts = 0
+
+    def match(self, traj):
+        pt_list = traj.pt_list
+        key_idx = select_key_pts(pt_list, self.max_dist, self.max_interval, self.max_heading_change,
+                                 self.min_move_dist)
+        key_mm_traj = self.map_matcher.match(Trajectory(traj.oid, traj.tid, [pt_list[i] for i in key_idx]))
+        mm_pt_list = [None] * len(pt_list)
+        for i, mm_pt in zip(key_idx, key_mm_traj.pt_list):
+            mm_pt_list[i] = mm_pt
+        for k in range(1, len(key_idx)):
+            start, end = key_idx[k - 1], key_idx[k]
+            if end - start > 1:
+                self.fill(pt_list, mm_pt_list, start, end)
+        self.nb_key_pts += len(key_idx)
+        self.nb_pts += len(pt_list)
+        return Trajectory(traj.oid, traj.tid, mm_pt_list)
+
+    def match_to_path(self, traj):
+        mm_traj = self.match(traj)
+        path = construct_path(self.rn, mm_traj, self.routing_weight, self.sp_cache, self.router,
+                              self.landmarks)
+        return path
+
+    def fill(self, pt_list, mm_pt_list, start, end):
+        """
+        project the skipped points between the key points onto the route between their matched candidates,
+        and split the road path of the route accordingly
+        """
+        start_candi_pt = mm_pt_list[start].data['candi_pt']
+        end_candi_pt = mm_pt_list[end].data['candi_pt']
+        road_path = None
+        if start_candi_pt is not None and end_candi_pt is not None and start_candi_pt.eid != end_candi_pt.eid:
+            road_path = mm_pt_list[end].data.get('road_path')
+            if road_path is None:
+                # e.g., the transition is left to construct_path() by the map matcher
+                road_path = find_shortest_path(self.rn, start_candi_pt, end_candi_pt, self.routing_weight,
+                                               self.sp_cache, self.router, self.landmarks)
+        if start_candi_pt is None or end_candi_pt is None or \
+                (start_candi_pt.eid != end_candi_pt.eid and road_path[1] is None):
+            # the route is broken, the skipped points are not matched
+            for i in range(start + 1, end):
+                mm_pt_list[i] = STPoint(pt_list[i].lat, pt_list[i].lng, pt_list[i].time,
+                                        {'candi_pt': None, 'road_path': None})
+            return
+        # the route edges, the vertex path p connects the exit of edges[r] and the entrance of edges[r+1] by p[r]
+        if start_candi_pt.eid == end_candi_pt.eid:
+            vertex_path = []
+            edges = [self.rn.edge_idx[start_candi_pt.eid]]
+        else:
+            vertex_path = road_path[1]
+            edges = [self.rn.edge_idx[start_candi_pt.eid]] + \
+                    [(vertex_path[r], vertex_path[r + 1]) for r in range(len(vertex_path) - 1)] + \
+                    [self.rn.edge_idx[end_candi_pt.eid]]
+            # the route passes the start (end) edge again if the start (end) candidate is at its end vertex,
+            # the candidate is then at the end vertex of the passed edge
+            if len(vertex_path) > 1 and self.rn[edges[1][0]][edges[1][1]]['eid'] == start_candi_pt.eid:
+                edges, vertex_path = edges[1:], vertex_path[1:]
+            if len(vertex_path) > 1 and self.rn[edges[-2][0]][edges[-2][1]]['eid'] == end_candi_pt.eid:
+                edges, vertex_path = edges[:-1], vertex_path[:-1]
+        prev_r = 0
+        prev_candi_pt = start_candi_pt
+        for i in range(start + 1, end):
+            # the points move forward along the route, the later edge wins the tie (projected onto the shared vertex)
+            r, candi_pt = min([(r, cal_candidate_point(pt_list[i], self.rn, edges[r]))
+                               for r in range(len(edges) - 1, prev_r - 1, -1)], key=lambda t: t[1].error)
+            mm_pt_list[i] = STPoint(pt_list[i].lat, pt_list[i].lng, pt_list[i].time,
+                                    {'candi_pt': candi_pt,
+                                     'road_path': self.sub_road_path(edges, vertex_path, prev_r, prev_candi_pt,
+                                                                     r, candi_pt)})
+            prev_r, prev_candi_pt = r, candi_pt
+        if start_candi_pt.eid != end_candi_pt.eid:
+            mm_pt_list[end].data['road_path'] = self.sub_road_path(edges, vertex_path, prev_r, prev_candi_pt,
+                                                                   len(edges) - 1, end_candi_pt)
+
+    def sub_road_path(self, edges, vertex_path, r1, candi_pt1, r2, candi_pt2):
+        """
+        :return: (path dist, vertex path) between the candidates on the r1-th and r2-th route edges,
+        the same as find_shortest_path() along the route
+        """
+        if r1 == r2:
+            return abs(candi_pt2.offset - candi_pt1.offset), []
+        sub_path = vertex_path[r1:r2]
+        path_dist = self.dist_to_vertex(edges[r1], candi_pt1, sub_path[0])
+        for a, b in zip(sub_path[:-1], sub_path[1:]):
+            path_dist += self.rn[a][b][self.routing_weight]
+        path_dist += self.dist_to_vertex(edges[r2], candi_pt2, sub_path[-1])
+        return path_dist, sub_path
+
+    def dist_to_vertex(self, edge, candi_pt, vertex):
+        """
+        :return: the distance between the candidate and the end vertex of its edge
+        """
+        edge_data = self.rn[edge[0]][edge[1]]
+        first_coord = edge_data['coords'][0]
+        if (first_coord.lng, first_coord.lat) == vertex:
+            return candi_pt.offset
+        return edge_data['length'] - candi_pt.offset
+
+    def report(self):
+        """
+        :return: the numbers of key points and all points since the creation of the matcher
+        """
+        key_ratio = self.nb_key_pts / self.nb_pts if self.nb_pts > 0 else 0.0
+        print('# of key pts:{}, # of pts:{}, key pt ratio:{:.4f}'.format(self.nb_key_pts, self.nb_pts, key_ratio))
+        return {'nb_key_pts': self.nb_key_pts, 'nb_pts': self.nb_pts, 'key_ratio': key_ratio}
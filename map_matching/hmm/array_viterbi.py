@@ -0,0 +1,218 @@
+"""
+Array-backed variant of ti_viterbi.ViterbiAlgorithm.
+The candidates of each time step are addressed by their index, the emission log probabilities are given as a vector
+and the transition log probabilities as a (#prev candidates, #cur candidates) matrix with -inf for missing transitions,
+so that each forward step is a vectorized max/argmax and the back pointers are integer arrays.
+Only the transition descriptors of the back pointers are kept, i.e., one per candidate instead of one per transition,
+and the back pointers use the smallest integer type for the number of candidates.
+The most likely sequence is identical to ViterbiAlgorithm, including the tie-breaking (the first state with the maximum
+probability wins) and the HMM break handling.
+"""
+from ..hmm.ti_viterbi import SequenceState
+from collections import deque
+import numpy as np
+
+
+class ArrayStep:
+    """
+    Everything needed to retrieve the most likely sequence for a time step.
+    """
+    __slots__ = ('observation', 'candidates', 'back_pointers', 'transition_descriptors')
+
+    def __init__(self, observation, candidates, back_pointers, transition_descriptors):
+        # a reference to the observation owned by the caller (the trajectory, or the pushed point of the online
+        # matcher), not a copy, i.e., the same size as an index into the points
+        self.observation = observation
+        self.candidates = candidates
+        # cur candidate idx -> prev candidate idx, -1 if the candidate cannot be reached
+        self.back_pointers = back_pointers
+        # cur candidate idx -> transition descriptor from the prev candidate of its back pointer
+        self.transition_descriptors = transition_descriptors
+
+
+class ArrayViterbiAlgorithm:
+    def __init__(self, keep_message_history=False, message_history_depth=None):
+        """
+        :param message_history_depth: only the latest messages are kept in the history if given (ring buffer)
+        """
+        # the time steps since the start, used to retrieve the most likely sequence by back pointers
+        self.steps = []
+        # message[i] is the log probability of the most likely sequence ending in the i-th candidate
+        self.message = None
+        self.is_broken = False
+        # deque of message
+        self.message_history = None
+        if keep_message_history:
+            self.message_history = deque(maxlen=message_history_depth)
+
+    def start_with_initial_observation(self, observation, candidates, emission_log_probabilities):
+        """
+        :param observation: the first observation
+        :param candidates: the candidates of the observation
+        :param emission_log_probabilities: the vector of the emission log probabilities of the candidates
+        """
+        if self.message is not None:
+            raise Exception('Initial probabilities have already been set.')
+        initial_message = np.asarray(emission_log_probabilities, dtype=np.float64)
+        if len(initial_message) != len(candidates):
+            raise Exception('No initial probability for some candidates')
+        self.is_broken = self.hmm_break(initial_message)
+        if self.is_broken:
+            return
+        self.message = initial_message
+        if self.message_history is not None:
+            self.message_history.append(self.message)
+        self.steps.append(ArrayStep(observation, list(candidates), None, None))
+
+    @staticmethod
+    def hmm_break(message):
+        """
+        Returns whether the message is empty or only contains candidates with zero probability.
+        """
+        return len(message) == 0 or not np.any(message != float('-inf'))
+
+    def forward_step(self, message, emission_log_probabilities, transition_log_probabilities):
+        """
+        :return: (new message, back pointers)
+        """
+        assert len(message) != 0
+        # (nb_prev, nb_cur)
+        log_probabilities = message[:, np.newaxis] + transition_log_probabilities
+        # the first max, same as the strict comparison of ViterbiAlgorithm
+        back_pointers = np.argmax(log_probabilities, axis=0)
+        max_log_probabilities = log_probabilities[back_pointers, np.arange(log_probabilities.shape[1])]
+        new_message = max_log_probabilities + emission_log_probabilities
+        # no transition with non-zero probability
+        back_pointers[max_log_probabilities == float('-inf')] = -1
+        if len(message) <= np.iinfo(np.int16).max:
+            back_pointers = back_pointers.astype(np.int16)
+        else:
+            back_pointers = back_pointers.astype(np.int32)
+        return new_message, back_pointers
+
+    def next_step(self, observation, candidates, emission_log_probabilities, transition_log_probabilities,
+                  transition_descriptors=None):
+        """
+        :param observation: the observation
+        :param candidates: the candidates of the observation
+        :param emission_log_probabilities: the vector of the emission log probabilities of the candidates
+        :param transition_log_probabilities: the (#prev candidates, #cur candidates) matrix of the transition log
+        probabilities, -inf if there is no transition
+        :param transition_descriptors: (prev candidate idx, cur candidate idx) -> transition descriptor
+        """
+        if self.message is None:
+            raise Exception('start_with_initial_observation() must be called first.')
+        if self.is_broken:
+            raise Exception('Method must not be called after an HMM break.')
+        emission_log_probabilities = np.asarray(emission_log_probabilities, dtype=np.float64)
+        transition_log_probabilities = np.asarray(transition_log_probabilities, dtype=np.float64).reshape(
+            len(self.message), len(candidates))
+        new_message, back_pointers = self.forward_step(self.message, emission_log_probabilities,
+                                                       transition_log_probabilities)
+        self.is_broken = self.hmm_break(new_message)
+        if self.is_broken:
+            return
+        if self.message_history is not None:
+            self.message_history.append(new_message)
+        self.message = new_message
+        if transition_descriptors is not None:
+            # the transitions not chosen by any back pointer cannot be part of the most likely sequence
+            transition_descriptors = [transition_descriptors[(prev_idx, cur_idx)] if prev_idx >= 0 else None
+                                      for cur_idx, prev_idx in enumerate(back_pointers.tolist())]
+        self.steps.append(ArrayStep(observation, list(candidates), back_pointers, transition_descriptors))
+
+    def most_likely_state(self):
+        """
+        :return: the index of the first candidate of the current message with the maximum probability
+        """
+        assert len(self.message) != 0
+        return int(np.argmax(self.message))
+
+    def retrieve_most_likely_sequence(self):
+        assert len(self.message) != 0
+        return self.retrieve_sequence(self.most_likely_state(), len(self.steps))
+
+    def retrieve_sequence(self, idx, nb_steps):
+        """
+        :param idx: the candidate index at the (nb_steps-1)-th step
+        :param nb_steps: the number of the oldest steps to retrieve
+        :return: the sequence of the oldest nb_steps steps ended at the candidate
+        """
+        # Retrieve most likely state sequence in reverse order
+        result = []
+        for t in range(nb_steps - 1, -1, -1):
+            step = self.steps[t]
+            transition_descriptor = None
+            prev_idx = -1
+            if step.back_pointers is not None:
+                prev_idx = int(step.back_pointers[idx])
+                if step.transition_descriptors is not None:
+                    transition_descriptor = step.transition_descriptors[idx]
+            result.append(SequenceState(step.candidates[idx], step.observation, transition_descriptor))
+            idx = prev_idx
+        result.reverse()
+        return result
+
+    def ancestors(self, states, t):
+        """
+        :param states: the candidate indices at the last step
+        :param t: the step
+        :return: the candidate indices at the t-th step they come from
+        """
+        for step in self.steps[len(self.steps) - 1:t:-1]:
+            states = step.back_pointers[states]
+        return states
+
+    def nb_converged_steps(self):
+        """
+        The back pointers of all the states with non-zero probability converge to a single state after a few steps,
+        so the most likely sequence up to the converged state is final regardless of the future observations.
+        :return: the number of the oldest steps in the history that are final
+        """
+        states = np.flatnonzero(self.message != float('-inf'))
+        for t in range(len(self.steps) - 1, -1, -1):
+            if np.all(states == states[0]):
+                return t + 1
+            if t > 0:
+                states = self.steps[t].back_pointers[states]
+        return 0
+
+    def pop_sequence(self, nb_steps):
+        """
+        Removes the oldest nb_steps steps from the history and returns their part of the most likely sequence.
+        If the steps are not final yet (see nb_converged_steps()), they are decided by the current most likely
+        state, and the states inconsistent with the decision are dropped.
+        :param nb_steps: the number of the oldest steps to pop
+        :return: the sequence of the popped steps
+        """
+        if nb_steps <= 0:
+            return []
+        alive = np.flatnonzero(self.message != float('-inf'))
+        decided = int(self.ancestors(np.array([self.most_likely_state()]), nb_steps - 1)[0])
+        inconsistent = alive[self.ancestors(alive, nb_steps - 1) != decided]
+        if len(inconsistent) > 0:
+            self.message = self.message.copy()
+            self.message[inconsistent] = float('-inf')
+        result = self.retrieve_sequence(decided, nb_steps)
+        del self.steps[:nb_steps]
+        return result
+
+    def pop_converged_sequence(self):
+        """
+        Removes the final steps (see nb_converged_steps()) from the history, so that only the steps after the
+        convergence are kept in memory.
+        :return: the sequence of the removed steps, the same as the beginning of compute_most_likely_sequence()
+        """
+        if self.message is None:
+            return []
+        return self.pop_sequence(self.nb_converged_steps())
+
+    def compute_most_likely_sequence(self):
+        """
+        Returns the most likely sequence of states for all time steps, see ViterbiAlgorithm.
+        """
+        if self.message is None:
+            # Return empty most likely sequence if there are no time steps or if initial observations caused an HMM break.
+            return []
+        else:
+            return self.retrieve_most_likely_sequence()
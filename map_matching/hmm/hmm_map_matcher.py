@@ -7,17 +7,22 @@ This is a Python translation from https://github.com/graphhopper/map-matching/tr
 
 from ..hmm.hmm_probabilities import HMMProbabilities
 from ..hmm.ti_viterbi import ViterbiAlgorithm, SequenceState
+from ..hmm.array_viterbi import ArrayViterbiAlgorithm
 from ..map_matcher import MapMatcher
-from ..candidate_point import get_candidates
+from ..candidate_point import get_candidates, get_candidates_batch
 from ...common.spatial_func import distance
 from ...common.trajectory import STPoint, Trajectory
-from ..utils import find_shortest_path
+from ..utils import find_shortest_path, ShortestPathCache
 from ..route_constructor import construct_path
+import numpy as np
+import pickle
+import time
 
 
 class TimeStep:
     """
     Contains everything the hmm-lib needs to process a new time step including emission and observation probabilities.
+    For ArrayViterbiAlgorithm, the probabilities are arrays and the transitions are keyed by candidate indices instead.
     """
     def __init__(self, observation, candidates):
         if observation is None or candidates is None:
@@ -26,7 +31,7 @@ class TimeStep:
         self.candidates = candidates
         self.emission_log_probabilities = {}
         self.transition_log_probabilities = {}
-        # transition -> dist
+        # transition -> (path dist, vertex path)
         self.road_paths = {}
 
     def add_emission_log_probability(self, candidate, emission_log_probability):
@@ -47,88 +52,342 @@ class TimeStep:
         self.road_paths[transition] = road_path
 
 
+class MatchState:
+    """
+    The tail state of an incremental matching (see TIHMMMapMatcher.match_incremental()): the viterbi algorithm with
+    the forward message and the steps not final yet, and the last time step to compute the next transitions.
+    """
+    def __init__(self, viterbi, prev_time_step):
+        self.viterbi = viterbi
+        self.prev_time_step = prev_time_step
+
+
+def store_match_state(state, target_path):
+    with open(target_path, 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_match_state(input_path):
+    with open(input_path, 'rb') as f:
+        return pickle.load(f)
+
+
+def to_mm_pt(ss):
+    """
+    the matched point of a sequence state, road_path is the (path dist, vertex path) from the matched candidate of
+    the previous point, None if the previous point is not in the same matching (unmatched or HMM break)
+    """
+    data = {'candi_pt': ss.state, 'road_path': ss.transition_descriptor}
+    return STPoint(ss.observation.lat, ss.observation.lng, ss.observation.time, data)
+
+
 class TIHMMMapMatcher(MapMatcher):
-    def __init__(self, rn, routing_weight='length', debug=False):
+    def __init__(self, rn, routing_weight='length', debug=False, sp_cache=None, router=None, landmarks=None,
+                 array_viterbi=True, beam_width=None, max_nb_candidates=None, candidate_cache=None, profiler=None,
+                 debug_history_depth=None):
+        """
+        :param debug: keep the messages of the viterbi algorithm
+        :param array_viterbi: use ArrayViterbiAlgorithm, otherwise the dict-based ViterbiAlgorithm
+        :param beam_width: beam mode, only the top-K states by forward message are expanded to the next step,
+        all the states if None
+        :param max_nb_candidates: only the top-K candidates by emission probability are kept for each point,
+        all the candidates if None
+        :param candidate_cache: optional CandidateCache shared by the trajectories
+        :param profiler: optional MatchProfiler to collect the timers and counters of each phase
+        :param debug_history_depth: only the latest messages are kept in debug mode if given
+        """
         self.measurement_error_sigma = 50.0
         self.transition_probability_beta = 2.0
         self.debug = debug
-        super(TIHMMMapMatcher, self).__init__(rn, routing_weight)
+        self.debug_history_depth = debug_history_depth
+        # the array viterbi history is checked for converged steps once it grows to this size (doubled after each check)
+        self.min_history_size = 64
+        self.array_viterbi = array_viterbi
+        self.beam_width = beam_width
+        self.max_nb_candidates = max_nb_candidates
+        self.candidate_cache = candidate_cache
+        self.profiler = profiler
+        if sp_cache is None:
+            sp_cache = ShortestPathCache()
+        super(TIHMMMapMatcher, self).__init__(rn, routing_weight, sp_cache, router, landmarks)
 
     # our implementation, no candidates or no transition will be set to None, and start a new matching
     def match(self, traj):
+        if self.profiler is not None:
+            self.profiler.start_traj(traj.tid)
         seq = self.compute_viterbi_sequence(traj.pt_list)
         assert len(traj.pt_list) == len(seq), 'pt_list and seq must have the same size'
-        mm_pt_list = []
-        for ss in seq:
-            candi_pt = None
-            if ss.state is not None:
-                candi_pt = ss.state
-            data = {'candi_pt': candi_pt}
-            mm_pt_list.append(STPoint(ss.observation.lat, ss.observation.lng, ss.observation.time, data))
+        mm_pt_list = [to_mm_pt(ss) for ss in seq]
         mm_traj = Trajectory(traj.oid, traj.tid, mm_pt_list)
+        if self.profiler is not None:
+            self.profiler.end_traj()
         return mm_traj
 
     def match_to_path(self, traj):
+        if self.profiler is not None:
+            self.profiler.start_traj(traj.tid)
         mm_traj = self.match(traj)
-        path = construct_path(self.rn, mm_traj, self.routing_weight)
+        path = construct_path(self.rn, mm_traj, self.routing_weight, self.sp_cache, self.router,
+                              self.landmarks, profiler=self.profiler)
+        if self.profiler is not None:
+            self.profiler.end_traj()
         return path
 
+    def match_incremental(self, traj, state=None):
+        """
+        match the next chunk of a trajectory, continuing the viterbi algorithm of the previous chunks
+        :param traj: the next chunk, in time order after the previous chunks
+        :param state: the MatchState returned by the previous chunk, None for the first chunk
+        :return: (the matched points finalized by the chunk, MatchState), the matched points of all the chunks plus
+        finish_incremental() are identical to match() of the concatenated trajectory
+        """
+        if not self.array_viterbi:
+            # the final steps are only popped from the array viterbi, and the state stays compact
+            raise Exception('incremental matching requires array_viterbi')
+        if self.profiler is not None:
+            # each chunk is profiled as a trajectory
+            self.profiler.start_traj(traj.tid)
+        seq = []
+        probabilities = HMMProbabilities(self.measurement_error_sigma, self.transition_probability_beta)
+        if state is None:
+            viterbi, prev_time_step = self.new_viterbi(), None
+        else:
+            viterbi, prev_time_step = state.viterbi, state.prev_time_step
+        time_steps = self.create_time_steps(traj.pt_list)
+        for idx, pt in enumerate(traj.pt_list):
+            time_step = time_steps[idx]
+            time_steps[idx] = None
+            viterbi, prev_time_step = self.viterbi_step(viterbi, prev_time_step, pt, time_step, probabilities, seq)
+        # the final steps do not depend on the next chunks
+        seq.extend(viterbi.pop_converged_sequence())
+        if prev_time_step is not None:
+            # only the observation and the candidates are needed for the next transitions
+            prev_time_step = TimeStep(prev_time_step.observation, prev_time_step.candidates)
+        mm_pt_list = [to_mm_pt(ss) for ss in seq]
+        if self.profiler is not None:
+            self.profiler.end_traj()
+        return mm_pt_list, MatchState(viterbi, prev_time_step)
+
+    def finish_incremental(self, state):
+        """
+        the end of the trajectory
+        :param state: the MatchState returned by the last chunk
+        :return: the remaining matched points
+        """
+        if state is None:
+            return []
+        return [to_mm_pt(ss) for ss in state.viterbi.compute_most_likely_sequence()]
+
+    def cache_stats(self):
+        """
+        :return: cache name -> {'hits', 'misses', 'hit_rate', 'size'}, only the caches in use are included
+        """
+        stats = {}
+        for name, cache in [('sp_cache', self.sp_cache), ('candidate_cache', self.candidate_cache)]:
+            if cache is not None:
+                stats[name] = {'hits': cache.hits, 'misses': cache.misses, 'hit_rate': cache.hit_rate(),
+                               'size': len(cache)}
+        return stats
+
     def create_time_step(self, pt):
+        if self.profiler is not None:
+            start_time, cache_counts = time.perf_counter(), self.candidate_cache_counts()
         time_step = None
-        candidates = get_candidates(pt, self.rn, self.measurement_error_sigma)
+        candidates = get_candidates(pt, self.rn, self.measurement_error_sigma, self.candidate_cache)
         if candidates is not None:
-            time_step = TimeStep(pt, candidates)
+            time_step = TimeStep(pt, self.prune_candidates(candidates))
+        if self.profiler is not None:
+            self.profile_candidates(start_time, cache_counts, [time_step])
         return time_step
 
+    def create_time_steps(self, pt_list):
+        """
+        the time steps of all the points, the candidates are generated for the whole trajectory at once
+        """
+        if self.profiler is not None:
+            start_time, cache_counts = time.perf_counter(), self.candidate_cache_counts()
+        candidate_table = get_candidates_batch(pt_list, self.rn, self.measurement_error_sigma,
+                                               self.candidate_cache)
+        time_steps = []
+        for idx, pt in enumerate(pt_list):
+            candidates = candidate_table.get_candidates(idx)
+            time_steps.append(TimeStep(pt, self.prune_candidates(candidates)) if candidates is not None else None)
+        if self.profiler is not None:
+            self.profile_candidates(start_time, cache_counts, time_steps)
+        return time_steps
+
+    def candidate_cache_counts(self):
+        if self.candidate_cache is None:
+            return None
+        return self.candidate_cache.hits, self.candidate_cache.misses
+
+    def profile_candidates(self, start_time, cache_counts, time_steps):
+        """
+        each point is a box queried from the rtree, or only the cells missed by the candidate cache
+        """
+        profiler = self.profiler
+        profiler.add_time('candidate', time.perf_counter() - start_time)
+        profiler.count('nb_pts', len(time_steps))
+        profiler.count('nb_no_candidate_pts', sum([time_step is None for time_step in time_steps]))
+        profiler.count('nb_candidates', sum([len(time_step.candidates) for time_step in time_steps
+                                             if time_step is not None]))
+        if cache_counts is None:
+            profiler.count('rtree_queries', len(time_steps))
+        else:
+            hits, misses = cache_counts
+            profiler.count('candidate_cache_hits', self.candidate_cache.hits - hits)
+            profiler.count('candidate_cache_misses', self.candidate_cache.misses - misses)
+            profiler.count('rtree_queries', self.candidate_cache.misses - misses)
+
+    def prune_candidates(self, candidates):
+        """
+        keep the top-K candidates by emission probability, i.e., with the smallest errors, in their original order
+        """
+        if self.max_nb_candidates is None or len(candidates) <= self.max_nb_candidates:
+            return candidates
+        kept = sorted(range(len(candidates)), key=lambda i: candidates[i].error)[:self.max_nb_candidates]
+        return [candidates[i] for i in sorted(kept)]
+
+    def surviving_states(self, prev_time_step, prev_message):
+        """
+        the indices of the previous candidates to expand. States with zero probability cannot be part of the most
+        likely sequence, and in beam mode, only the top-K states by forward message survive.
+        """
+        if isinstance(prev_message, dict):
+            prev_message = [prev_message[candi_pt] for candi_pt in prev_time_step.candidates]
+        prev_message = np.asarray(prev_message, dtype=np.float64)
+        order = np.argsort(-prev_message, kind='stable')
+        order = order[prev_message[order] != float('-inf')]
+        if self.beam_width is not None:
+            order = order[:self.beam_width]
+        return set(order.tolist())
+
     def compute_viterbi_sequence(self, pt_list):
         seq = []
         probabilities = HMMProbabilities(self.measurement_error_sigma, self.transition_probability_beta)
-        viterbi = ViterbiAlgorithm(keep_message_history=self.debug)
+        viterbi = self.new_viterbi()
         prev_time_step = None
-        idx = 0
-        nb_points = len(pt_list)
-        while idx < nb_points:
-            time_step = self.create_time_step(pt_list[idx])
-            # construct the sequence ended at t-1, and skip current point (no candidate error)
-            if time_step is None:
-                seq.extend(viterbi.compute_most_likely_sequence())
-                seq.append(SequenceState(None, pt_list[idx], None))
-                viterbi = ViterbiAlgorithm(keep_message_history=self.debug)
-                prev_time_step = None
-            else:
-                self.compute_emission_probabilities(time_step, probabilities)
-                if prev_time_step is None:
-                    viterbi.start_with_initial_observation(time_step.observation, time_step.candidates,
-                                                           time_step.emission_log_probabilities)
-                else:
-                    self.compute_transition_probabilities(prev_time_step, time_step, probabilities)
-                    viterbi.next_step(time_step.observation, time_step.candidates, time_step.emission_log_probabilities,
-                                      time_step.transition_log_probabilities, time_step.road_paths)
-                if viterbi.is_broken:
-                    # construct the sequence ended at t-1, and start a new matching at t (no transition error)
-                    seq.extend(viterbi.compute_most_likely_sequence())
-                    viterbi = ViterbiAlgorithm(keep_message_history=self.debug)
-                    viterbi.start_with_initial_observation(time_step.observation, time_step.candidates,
-                                                           time_step.emission_log_probabilities)
-                prev_time_step = time_step
-            idx += 1
-        if len(seq) < nb_points:
+        time_steps = self.create_time_steps(pt_list)
+        history_size = self.min_history_size
+        for idx, pt in enumerate(pt_list):
+            time_step = time_steps[idx]
+            # the processed time steps are released, only the chosen transitions are kept by the viterbi algorithm
+            time_steps[idx] = None
+            viterbi, prev_time_step = self.viterbi_step(viterbi, prev_time_step, pt, time_step, probabilities, seq)
+            if self.array_viterbi and len(viterbi.steps) >= history_size:
+                # the final steps are moved to seq, only the steps after the convergence are kept in memory
+                seq.extend(viterbi.pop_converged_sequence())
+                history_size = max(self.min_history_size, 2 * len(viterbi.steps))
+        if len(seq) < len(pt_list):
+            if self.profiler is not None:
+                start_time = time.perf_counter()
             seq.extend(viterbi.compute_most_likely_sequence())
+            if self.profiler is not None:
+                self.profiler.add_time('viterbi', time.perf_counter() - start_time)
         return seq
 
+    def viterbi_step(self, viterbi, prev_time_step, pt, time_step, probabilities, seq):
+        """
+        process one point, the sequences finished by this point (no candidates or HMM breaks) are appended to seq
+        :return: (viterbi, prev_time_step) for the next point
+        """
+        if self.profiler is None:
+            return self.compute_viterbi_step(viterbi, prev_time_step, pt, time_step, probabilities, seq)
+        start_time = time.perf_counter()
+        routing_time = self.profiler.timers['routing']
+        result = self.compute_viterbi_step(viterbi, prev_time_step, pt, time_step, probabilities, seq)
+        # the routing time is added by compute_viterbi_step()
+        self.profiler.add_time('viterbi', time.perf_counter() - start_time -
+                               (self.profiler.timers['routing'] - routing_time))
+        return result
+
+    def compute_viterbi_step(self, viterbi, prev_time_step, pt, time_step, probabilities, seq):
+        # construct the sequence ended at t-1, and skip current point (no candidate error)
+        if time_step is None:
+            seq.extend(viterbi.compute_most_likely_sequence())
+            seq.append(SequenceState(None, pt, None))
+            return self.new_viterbi(), None
+        self.compute_emission_probabilities(time_step, probabilities)
+        if prev_time_step is None:
+            viterbi.start_with_initial_observation(time_step.observation, time_step.candidates,
+                                                   time_step.emission_log_probabilities)
+        else:
+            if self.profiler is not None:
+                start_time = time.perf_counter()
+            self.compute_transition_probabilities(prev_time_step, time_step, probabilities, viterbi.message)
+            if self.profiler is not None:
+                self.profiler.add_time('routing', time.perf_counter() - start_time)
+            viterbi.next_step(time_step.observation, time_step.candidates, time_step.emission_log_probabilities,
+                              time_step.transition_log_probabilities, time_step.road_paths)
+        if viterbi.is_broken:
+            if self.profiler is not None:
+                self.profiler.count('hmm_breaks')
+            # construct the sequence ended at t-1, and start a new matching at t (no transition error)
+            seq.extend(viterbi.compute_most_likely_sequence())
+            viterbi = self.new_viterbi()
+            viterbi.start_with_initial_observation(time_step.observation, time_step.candidates,
+                                                   time_step.emission_log_probabilities)
+        return viterbi, time_step
+
+    def new_viterbi(self):
+        if self.array_viterbi:
+            return ArrayViterbiAlgorithm(self.debug, self.debug_history_depth)
+        return ViterbiAlgorithm(self.debug, self.debug_history_depth)
+
     def compute_emission_probabilities(self, time_step, probabilities):
+        if self.array_viterbi:
+            time_step.emission_log_probabilities = np.array(
+                [probabilities.emission_log_probability(candi_pt.error) for candi_pt in time_step.candidates],
+                dtype=np.float64)
+            return
         for candi_pt in time_step.candidates:
             dist = candi_pt.error
             time_step.add_emission_log_probability(candi_pt, probabilities.emission_log_probability(dist))
 
-    def compute_transition_probabilities(self, prev_time_step, time_step, probabilities):
+    def compute_transition_probabilities(self, prev_time_step, time_step, probabilities, prev_message=None):
+        """
+        :param prev_message: the forward message of the previous time step, the routing is only computed for the
+        surviving states if given
+        """
         linear_dist = distance(prev_time_step.observation, time_step.observation)
-        for prev_candi_pt in prev_time_step.candidates:
+        surviving = None
+        if prev_message is not None:
+            surviving = self.surviving_states(prev_time_step, prev_message)
+        if self.profiler is not None:
+            nb_prev_candidates = len(prev_time_step.candidates) if surviving is None else len(surviving)
+            self.profiler.count('nb_transitions', nb_prev_candidates * len(time_step.candidates))
+        if self.array_viterbi:
+            self.compute_transition_probability_matrix(prev_time_step, time_step, probabilities, linear_dist,
+                                                       surviving)
+            return
+        for i, prev_candi_pt in enumerate(prev_time_step.candidates):
+            if surviving is not None and i not in surviving:
+                continue
             for cur_candi_pt in time_step.candidates:
-                path_dist, path = find_shortest_path(self.rn, prev_candi_pt, cur_candi_pt, self.routing_weight)
+                path_dist, path = find_shortest_path(self.rn, prev_candi_pt, cur_candi_pt, self.routing_weight,
+                                                     self.sp_cache, self.router, self.landmarks, self.profiler)
                 # invalid transition has no transition probability
                 if path is not None:
-                    time_step.add_road_path(prev_candi_pt, cur_candi_pt, path)
+                    time_step.add_road_path(prev_candi_pt, cur_candi_pt, (path_dist, path))
                     time_step.add_transition_log_probability(prev_candi_pt, cur_candi_pt,
                                                              probabilities.transition_log_probability(path_dist,
                                                                                                       linear_dist))
+
+    def compute_transition_probability_matrix(self, prev_time_step, time_step, probabilities, linear_dist,
+                                              surviving=None):
+        """
+        -inf for the invalid transitions, and the road paths are keyed by (prev candidate idx, cur candidate idx)
+        """
+        transition_log_probabilities = np.full((len(prev_time_step.candidates), len(time_step.candidates)),
+                                               float('-inf'))
+        for i, prev_candi_pt in enumerate(prev_time_step.candidates):
+            if surviving is not None and i not in surviving:
+                continue
+            for j, cur_candi_pt in enumerate(time_step.candidates):
+                path_dist, path = find_shortest_path(self.rn, prev_candi_pt, cur_candi_pt, self.routing_weight,
+                                                     self.sp_cache, self.router, self.landmarks, self.profiler)
+                if path is not None:
+                    time_step.road_paths[(i, j)] = (path_dist, path)
+                    transition_log_probabilities[i, j] = probabilities.transition_log_probability(path_dist,
+                                                                                                  linear_dist)
+        time_step.transition_log_probabilities = transition_log_probabilities
@@ -0,0 +1,60 @@
+"""
+Online (streaming) version of TIHMMMapMatcher for live vehicles.
+Observations are pushed one by one, and a matched point is emitted as soon as it is final, i.e., the back pointers of
+all the states with non-zero probability have converged to it (see ArrayViterbiAlgorithm.nb_converged_steps()).
+With max_lag, a point is emitted at the latest max_lag points after it was observed, based on the current most
+likely sequence, which bounds the latency and the memory even if the back pointers do not converge.
+"""
+from ..hmm.hmm_map_matcher import TIHMMMapMatcher, to_mm_pt
+from ..hmm.hmm_probabilities import HMMProbabilities
+
+
+class OnlineTIHMMMapMatcher(TIHMMMapMatcher):
+    """
+    One matcher per moving object, the routing cache can be shared among matchers by sp_cache.
+    """
+    def __init__(self, rn, routing_weight='length', max_lag=None, **kwargs):
+        """
+        :param max_lag: the max number of observed but not emitted points, unlimited if None
+        :param kwargs: other arguments of TIHMMMapMatcher
+        """
+        kwargs['array_viterbi'] = True
+        super(OnlineTIHMMMapMatcher, self).__init__(rn, routing_weight, **kwargs)
+        self.max_lag = max_lag
+        self.probabilities = HMMProbabilities(self.measurement_error_sigma, self.transition_probability_beta)
+        self.viterbi = None
+        self.prev_time_step = None
+        self.reset()
+
+    def reset(self):
+        self.viterbi = self.new_viterbi()
+        self.prev_time_step = None
+
+    def push(self, pt):
+        """
+        :param pt: the new observation (STPoint), in time order
+        :return: the matched points finalized by the observation, in time order
+        """
+        seq = []
+        time_step = self.create_time_step(pt)
+        self.viterbi, self.prev_time_step = self.viterbi_step(self.viterbi, self.prev_time_step, pt, time_step,
+                                                              self.probabilities, seq)
+        if self.prev_time_step is not None:
+            nb_final_steps = self.viterbi.nb_converged_steps()
+            if self.max_lag is not None:
+                nb_final_steps = max(nb_final_steps, len(self.viterbi.steps) - self.max_lag)
+            # the final steps are removed from the history
+            seq.extend(self.viterbi.pop_sequence(nb_final_steps))
+        return [to_mm_pt(ss) for ss in seq]
+
+    def flush(self):
+        """
+        the end of the trajectory, emit all the pending points
+        :return: the remaining matched points, in time order
+        """
+        seq = self.viterbi.compute_most_likely_sequence()
+        self.reset()
+        return [to_mm_pt(ss) for ss in seq]
+
+    def nb_pending_pts(self):
+        return len(self.viterbi.steps)
@@ -8,6 +8,7 @@ This implementation exploits this fact by letting the Java garbage collector
 take care of unreachable back pointers. If back pointers converge to a single path after a
 constant number of time steps, only O(t) back pointers and transition descriptors need to be stored in memory.
 """
+from collections import deque
 
 
 class ExtendedState:
@@ -39,7 +40,10 @@ class ForwardStepResult:
 
 
 class ViterbiAlgorithm:
-    def __init__(self, keep_message_history=False):
+    def __init__(self, keep_message_history=False, message_history_depth=None):
+        """
+        :param message_history_depth: only the latest messages are kept in the history if given (ring buffer)
+        """
         # Allows to retrieve the most likely sequence using back pointers.
         self.last_extended_states = None
         self.prev_candidates = []
@@ -53,10 +57,10 @@ class ViterbiAlgorithm:
         # state -> float
         self.message = None
         self.is_broken = False
-        # list of message
+        # deque of message
         self.message_history = None
         if keep_message_history:
-            self.message_history = []
+            self.message_history = deque(maxlen=message_history_depth)
 
     def initialize_state_probabilities(self, observation, candidates, initial_log_probabilities):
         """
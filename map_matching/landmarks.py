@@ -0,0 +1,115 @@
+"""
+A*, landmarks and triangle inequality (ALT) based on
+Goldberg, Andrew V., and Chris Harrelson. "Computing the shortest path: A* search meets graph theory."
+Proceedings of the 16th annual ACM-SIAM symposium on Discrete algorithms. SIAM, 2005.
+For any landmark L, d(v, t) >= d(v, L) - d(t, L) and d(v, t) >= d(L, t) - d(L, v). Since the distances are computed
+with the routing weight itself, the lower bound is admissible and consistent for any non-negative routing weight,
+while the haversine heuristic is only admissible for length.
+"""
+import networkx as nx
+import numpy as np
+import random
+import json
+import os
+
+
+class LandmarkHeuristic:
+    def __init__(self, nodes, landmarks, dists_from, dists_to, weight):
+        # node id -> node key (coordinate tuple)
+        self.nodes = [tuple(node) for node in nodes.tolist()]
+        # node key -> node id
+        self.node_ids = {node: i for i, node in enumerate(self.nodes)}
+        # node ids of the landmarks
+        self.landmarks = landmarks
+        # (nb_nodes, nb_landmarks), d(L, v)
+        self.dists_from = dists_from
+        # (nb_nodes, nb_landmarks), d(v, L)
+        self.dists_to = dists_to
+        self.weight = weight
+
+    def __call__(self, node, target):
+        """
+        the A* heuristic, i.e., the lower bound of the cost from node to target
+        """
+        v = self.node_ids[node]
+        t = self.node_ids[target]
+        with np.errstate(invalid='ignore'):
+            # inf - inf (nan) carries no information, fmax ignores it
+            bound = np.fmax.reduce(np.fmax(self.dists_to[v] - self.dists_to[t], self.dists_from[t] - self.dists_from[v]))
+        # nan > 0.0 is False
+        return float(bound) if bound > 0.0 else 0.0
+
+
+def select_landmarks(rn, nb_landmarks, weight, seed=0):
+    """
+    farthest landmark selection: each new landmark is the vertex farthest from the selected ones
+    """
+    nodes = list(rn.nodes)
+    undirected_rn = nx.Graph()
+    undirected_rn.add_weighted_edges_from(rn.edges(data=weight), weight=weight)
+    landmarks = []
+    selected = set()
+    min_dists = {}
+    start = random.Random(seed).choice(nodes)
+    for _ in range(nb_landmarks):
+        source = landmarks[-1] if len(landmarks) > 0 else start
+        dists = nx.single_source_dijkstra_path_length(undirected_rn, source, weight=weight)
+        for node, dist in dists.items():
+            min_dists[node] = min(min_dists.get(node, float('inf')), dist)
+        candidates = [node for node in min_dists if node not in selected]
+        if len(candidates) == 0:
+            break
+        landmark = max(candidates, key=lambda node: min_dists[node])
+        landmarks.append(landmark)
+        selected.add(landmark)
+    return landmarks
+
+
+def build_landmarks(rn, nb_landmarks=16, weight='length', seed=0):
+    """
+    :param rn: the road network
+    :param nb_landmarks: the number of landmarks, more landmarks give tighter bounds but slower evaluation
+    :param weight: the attribute name to find the routing weight
+    :param seed: the random seed to pick the first landmark
+    :return: LandmarkHeuristic
+    """
+    nodes = list(rn.nodes)
+    node_ids = {node: i for i, node in enumerate(nodes)}
+    landmarks = select_landmarks(rn, nb_landmarks, weight, seed)
+    dists_from = np.full((len(nodes), len(landmarks)), np.inf)
+    dists_to = np.full((len(nodes), len(landmarks)), np.inf)
+    reversed_rn = rn
+    if rn.is_directed():
+        # only the weights are needed, a view of the road network class is not constructible
+        reversed_rn = nx.DiGraph()
+        reversed_rn.add_weighted_edges_from([(v, u, cost) for u, v, cost in rn.edges(data=weight)], weight=weight)
+    for i, landmark in enumerate(landmarks):
+        for node, dist in nx.single_source_dijkstra_path_length(rn, landmark, weight=weight).items():
+            dists_from[node_ids[node], i] = dist
+        for node, dist in nx.single_source_dijkstra_path_length(reversed_rn, landmark, weight=weight).items():
+            dists_to[node_ids[node], i] = dist
+    print('# of landmarks:{}'.format(len(landmarks)))
+    return LandmarkHeuristic(np.array(nodes, dtype=np.float64),
+                             np.array([node_ids[landmark] for landmark in landmarks], dtype=np.int32),
+                             dists_from, dists_to, weight)
+
+
+def store_landmarks(lh, target_dir):
+    os.makedirs(target_dir, exist_ok=True)
+    np.save(os.path.join(target_dir, 'nodes.npy'), np.array(lh.nodes, dtype=np.float64))
+    np.save(os.path.join(target_dir, 'landmarks.npy'), lh.landmarks)
+    np.save(os.path.join(target_dir, 'dists_from.npy'), lh.dists_from)
+    np.save(os.path.join(target_dir, 'dists_to.npy'), lh.dists_to)
+    with open(os.path.join(target_dir, 'meta.json'), 'w') as f:
+        json.dump({'weight': lh.weight}, f)
+
+
+def load_landmarks(input_dir, mmap=False):
+    mmap_mode = 'r' if mmap else None
+    with open(os.path.join(input_dir, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    nodes = np.load(os.path.join(input_dir, 'nodes.npy'))
+    landmarks = np.load(os.path.join(input_dir, 'landmarks.npy'))
+    dists_from = np.load(os.path.join(input_dir, 'dists_from.npy'), mmap_mode=mmap_mode)
+    dists_to = np.load(os.path.join(input_dir, 'dists_to.npy'), mmap_mode=mmap_mode)
+    return LandmarkHeuristic(nodes, landmarks, dists_from, dists_to, meta['weight'])
@@ -1,7 +1,13 @@
 class MapMatcher:
-    def __init__(self, rn, routing_weight='length'):
+    def __init__(self, rn, routing_weight='length', sp_cache=None, router=None, landmarks=None):
         self.rn = rn
         self.routing_weight = routing_weight
+        # optional ShortestPathCache shared by all the trajectories matched by this matcher
+        self.sp_cache = sp_cache
+        # optional precomputed router (e.g., UBODT, ContractionHierarchy) to answer the shortest path queries
+        self.router = router
+        # optional LandmarkHeuristic to guide A* instead of the haversine distance
+        self.landmarks = landmarks
 
     def match(self, traj):
         pass
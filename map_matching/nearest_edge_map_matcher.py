@@ -0,0 +1,175 @@
+"""
+Fast map matching for high-frequency and high-accuracy trajectories (e.g., 1 Hz, RTK-grade GPS).
+Each point is snapped to its nearest edge, which is accepted if it is unambiguous (no other edge within
+ambiguity_dist after filtering the edges by the heading of the trajectory) and consistent with the previous snap
+(the route between them deviates no more than max_route_deviation from the straight line).
+The remaining points, plus context points around them, are matched by TIHMMMapMatcher window by window.
+"""
+from .map_matcher import MapMatcher
+from .candidate_point import get_candidates_batch
+from .hmm.hmm_map_matcher import TIHMMMapMatcher, to_mm_pt
+from .utils import find_shortest_path, ShortestPathCache
+from .route_constructor import construct_path
+from ..common.spatial_func import distance, bearing
+from ..common.trajectory import STPoint, Trajectory
+import networkx as nx
+import numpy as np
+
+
+class NearestEdgeMapMatcher(MapMatcher):
+    def __init__(self, rn, routing_weight='length', search_dist=50.0, ambiguity_dist=5.0, max_heading_diff=45.0,
+                 min_move_dist=2.0, max_route_deviation=20.0, nb_context_pts=2, sp_cache=None, router=None,
+                 landmarks=None, candidate_cache=None):
+        """
+        :param search_dist: the search distance (meter) of the candidates
+        :param ambiguity_dist: the snap is ambiguous if other edges are within ambiguity_dist (meter) of the nearest
+        :param max_heading_diff: the max difference (degree) between the headings of the trajectory and the edge
+        :param min_move_dist: the heading is unknown if the point moves less than min_move_dist (meter)
+        :param max_route_deviation: the max difference (meter) between the route length and the linear distance of
+        consecutive snaps
+        :param nb_context_pts: the number of points added before and after an ambiguous window for the HMM
+        """
+        if sp_cache is None:
+            sp_cache = ShortestPathCache()
+        super(NearestEdgeMapMatcher, self).__init__(rn, routing_weight, sp_cache, router, landmarks)
+        self.search_dist = search_dist
+        self.ambiguity_dist = ambiguity_dist
+        self.max_heading_diff = max_heading_diff
+        self.min_move_dist = min_move_dist
+        self.max_route_deviation = max_route_deviation
+        self.nb_context_pts = nb_context_pts
+        self.candidate_cache = candidate_cache
+        self.hmm_map_matcher = TIHMMMapMatcher(rn, routing_weight, sp_cache=sp_cache, router=router,
+                                               landmarks=landmarks, candidate_cache=candidate_cache)
+        self.nb_fast_pts = 0
+        self.nb_hmm_pts = 0
+        self.nb_hmm_windows = 0
+
+    def match(self, traj):
+        pt_list = traj.pt_list
+        nb_pts = len(pt_list)
+        candidate_table = get_candidates_batch(pt_list, self.rn, self.search_dist, self.candidate_cache)
+        snaps = [self.snap(self.pt_heading(pt_list, i), candidate_table.get_candidates(i)) for i in range(nb_pts)]
+        # the road path from the previous snap
+        road_paths = [None] * nb_pts
+        is_fast = [snap is not None for snap in snaps]
+        for i in range(1, nb_pts):
+            if snaps[i - 1] is None or snaps[i] is None:
+                continue
+            road_path = self.connect(pt_list[i - 1], pt_list[i], snaps[i - 1], snaps[i])
+            if road_path is None:
+                is_fast[i - 1] = False
+                is_fast[i] = False
+            else:
+                road_paths[i] = road_path
+        mm_pt_list = [STPoint(pt.lat, pt.lng, pt.time, {'candi_pt': snap, 'road_path': road_path})
+                      for pt, snap, road_path in zip(pt_list, snaps, road_paths)]
+        windows = self.hmm_windows(is_fast)
+        for start, end in windows:
+            seq = self.hmm_map_matcher.compute_viterbi_sequence(pt_list[start:end])
+            mm_pt_list[start:end] = [to_mm_pt(ss) for ss in seq]
+            # the road path of the next point is from its fast snap
+            if end < nb_pts:
+                mm_pt_list[end].data['road_path'] = None
+            self.nb_hmm_pts += end - start
+            self.nb_hmm_windows += 1
+        self.nb_fast_pts += nb_pts - sum([end - start for start, end in windows])
+        return Trajectory(traj.oid, traj.tid, mm_pt_list)
+
+    def match_to_path(self, traj):
+        mm_traj = self.match(traj)
+        path = construct_path(self.rn, mm_traj, self.routing_weight, self.sp_cache, self.router,
+                              self.landmarks)
+        return path
+
+    def hmm_windows(self, is_fast):
+        """
+        :return: [(start, end)] of the windows matched by the HMM, i.e., not fast points plus the context points
+        """
+        windows = []
+        for i, fast in enumerate(is_fast):
+            if fast:
+                continue
+            start = max(0, i - self.nb_context_pts)
+            end = min(len(is_fast), i + self.nb_context_pts + 1)
+            if len(windows) > 0 and start <= windows[-1][1]:
+                windows[-1] = (windows[-1][0], end)
+            else:
+                windows.append((start, end))
+        return windows
+
+    def pt_heading(self, pt_list, i):
+        """
+        :return: the heading (degree) of the trajectory at the i-th point, None if unknown
+        """
+        prev_pt = pt_list[max(0, i - 1)]
+        next_pt = pt_list[min(len(pt_list) - 1, i + 1)]
+        if distance(prev_pt, next_pt) < self.min_move_dist:
+            return None
+        return bearing(prev_pt, next_pt)
+
+    def edge_heading(self, candi_pt):
+        """
+        :return: the heading (degree) of the segment the candidate is projected onto
+        """
+        u, v = self.rn.edge_idx[candi_pt.eid]
+        edge_data = self.rn[u][v]
+        coords = edge_data['coords']
+        if 'cum_offsets' in edge_data:
+            cum_offsets = edge_data['cum_offsets']
+        else:
+            cum_offsets = np.cumsum([0.0] + [distance(coords[i], coords[i + 1]) for i in range(len(coords) - 1)])
+        idx = min(max(int(np.searchsorted(cum_offsets, candi_pt.offset, side='right')) - 1, 0), len(coords) - 2)
+        return bearing(coords[idx], coords[idx + 1])
+
+    def heading_diff(self, a, b):
+        diff = abs(a - b) % 360.0
+        diff = min(diff, 360.0 - diff)
+        if not nx.is_directed(self.rn):
+            # an undirected edge can be traveled in both directions
+            diff = min(diff, 180.0 - diff)
+        return diff
+
+    def snap(self, heading, candidates):
+        """
+        :return: the nearest candidate, None if there is no candidate or the snap is ambiguous
+        """
+        if candidates is None:
+            return None
+        min_error = min([candi_pt.error for candi_pt in candidates])
+        close_candidates = [candi_pt for candi_pt in candidates if candi_pt.error <= min_error + self.ambiguity_dist]
+        if heading is not None:
+            close_candidates = [candi_pt for candi_pt in close_candidates
+                                if self.heading_diff(heading, self.edge_heading(candi_pt)) <= self.max_heading_diff]
+        if len(set([candi_pt.eid for candi_pt in close_candidates])) != 1:
+            return None
+        return min(close_candidates, key=lambda candi_pt: candi_pt.error)
+
+    def connect(self, prev_pt, cur_pt, prev_candi_pt, cur_candi_pt):
+        """
+        :return: the road path (path dist, vertex path) between consecutive snaps, None if they are not consistent
+        """
+        if prev_candi_pt.eid == cur_candi_pt.eid:
+            # small backward moves on the same edge are GPS jitters
+            if nx.is_directed(self.rn) and cur_candi_pt.offset < prev_candi_pt.offset - self.ambiguity_dist:
+                return None
+            return abs(cur_candi_pt.offset - prev_candi_pt.offset), []
+        path_dist, path = find_shortest_path(self.rn, prev_candi_pt, cur_candi_pt, self.routing_weight,
+                                             self.sp_cache, self.router, self.landmarks)
+        if path is None:
+            return None
+        # the deviation is only checked if the routing weight is the length
+        if self.routing_weight == 'length' and abs(path_dist - distance(prev_pt, cur_pt)) > self.max_route_deviation:
+            return None
+        return path_dist, path
+
+    def report(self):
+        """
+        :return: the numbers of points matched by the fast path and by the HMM since the creation of the matcher
+        """
+        nb_pts = self.nb_fast_pts + self.nb_hmm_pts
+        fast_ratio = self.nb_fast_pts / nb_pts if nb_pts > 0 else 0.0
+        print('# of fast path pts:{}, # of hmm pts:{}, # of hmm windows:{}, fast path ratio:{:.4f}'.format(
+            self.nb_fast_pts, self.nb_hmm_pts, self.nb_hmm_windows, fast_ratio))
+        return {'nb_fast_pts': self.nb_fast_pts, 'nb_hmm_pts': self.nb_hmm_pts,
+                'nb_hmm_windows': self.nb_hmm_windows, 'fast_ratio': fast_ratio}
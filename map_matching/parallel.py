@@ -0,0 +1,90 @@
+"""
+Multi-process map matching.
+The map matcher, including the road network and the optional router/landmarks, is set as a module global before the
+worker processes are forked, so that the workers inherit it by copy-on-write instead of unpickling a networkx graph in
+each process. The sharing is not free: the reference count updates of the objects touched by a worker still copy their
+pages, gc.freeze() only keeps the garbage collection passes from touching them. Only the trajectories and the matched
+trajectories are sent between processes.
+Tasks are scheduled in chunks of trajectories, at most max_pending_per_worker chunks per worker are in flight, so that
+the tasks are read from the input no faster than they are matched. The results are returned in the input order.
+"""
+from collections import deque
+import multiprocessing
+import itertools
+import gc
+
+# the state inherited by the forked worker processes, see fork_map()
+worker_state = None
+
+
+def fork_map_worker(func, chunk):
+    return [func(worker_state, task) for task in chunk]
+
+
+def fork_map(func, state, tasks, nb_workers, chunksize=1, max_pending_per_worker=2):
+    """
+    apply func(state, task) to the tasks in forked worker processes, which inherit state instead of receiving it
+    :param func: a module level function (sent to the workers by name)
+    :param state: the state shared by all the tasks, e.g., the map matcher
+    :param tasks: iterable of the tasks, consumed lazily
+    :param nb_workers: the number of worker processes, run in the current process if <= 1
+    :param chunksize: the number of tasks sent to a worker at a time
+    :param max_pending_per_worker: the max number of chunks in flight per worker, which bounds the number of tasks
+    read ahead of the results to chunksize * max_pending_per_worker * nb_workers
+    :return: generator of the results in the order of tasks
+    """
+    global worker_state
+    if nb_workers <= 1:
+        for task in tasks:
+            yield func(state, task)
+        return
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        raise Exception('multi-process execution requires the fork start method')
+    worker_state = state
+    ctx = multiprocessing.get_context('fork')
+    tasks = iter(tasks)
+    # objects tracked by gc before fork are not touched by the collections of workers, which avoids copying pages
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    try:
+        with ctx.Pool(nb_workers) as pool:
+            pending = deque()
+            while True:
+                chunk = list(itertools.islice(tasks, chunksize))
+                if len(chunk) > 0:
+                    pending.append(pool.apply_async(fork_map_worker, (func, chunk)))
+                if len(pending) == 0:
+                    break
+                if len(chunk) == 0 or len(pending) >= max_pending_per_worker * nb_workers:
+                    for result in pending.popleft().get():
+                        yield result
+    finally:
+        worker_state = None
+        if hasattr(gc, 'unfreeze'):
+            gc.unfreeze()
+
+
+def match_worker(state, task):
+    map_matcher, keep_road_paths = state
+    key, traj = task
+    mm_traj = map_matcher.match(traj)
+    if not keep_road_paths:
+        for pt in mm_traj.pt_list:
+            pt.data.pop('road_path', None)
+    return key, mm_traj
+
+
+def parallel_match(map_matcher, tasks, nb_workers, chunksize=4, keep_road_paths=True, max_pending_per_worker=2):
+    """
+    :param map_matcher: the map matcher shared by all the workers
+    :param tasks: iterable of (key, traj), consumed lazily, at most chunksize * max_pending_per_worker * nb_workers
+    trajectories are read ahead of the matched ones
+    :param nb_workers: the number of worker processes, match in the current process if <= 1
+    :param chunksize: the number of trajectories sent to a worker at a time
+    :param keep_road_paths: send the road paths of the matched points back, not needed if only the matched points
+    are stored
+    :param max_pending_per_worker: see fork_map()
+    :return: generator of (key, mm_traj) in the order of tasks
+    """
+    return fork_map(match_worker, (map_matcher, keep_road_paths), tasks, nb_workers, chunksize,
+                    max_pending_per_worker)
@@ -0,0 +1,80 @@
+"""
+Opt-in per-phase instrumentation of the map matching.
+The matcher (see TIHMMMapMatcher(profiler=...)) and construct_path() only touch the profiler if it is given, so the
+overhead is a None check per phase when the profiling is disabled.
+Timers (second) and counters are aggregated per trajectory and per run:
+    timers: candidate (candidate search), routing (transition probabilities), viterbi, path (route construction)
+    counters: nb_pts, nb_candidates, nb_no_candidate_pts, rtree_queries, candidate_cache_hits/misses,
+              nb_transitions, astar_calls, astar_reached_nodes, router_queries, sp_cache_hits/misses,
+              hmm_breaks, reused_road_paths
+"""
+from collections import Counter
+import json
+import time
+
+
+class MatchProfiler:
+    def __init__(self):
+        # the records of the finished trajectories, [{'tid', 'timers', 'counters'}]
+        self.traj_stats = []
+        self.timers = Counter()
+        self.counters = Counter()
+        self.total_timers = Counter()
+        self.total_counters = Counter()
+        self.tid = None
+        self.traj_start_time = None
+        # start_traj() may be nested, e.g., match() inside match_to_path()
+        self.depth = 0
+
+    def start_traj(self, tid):
+        self.depth += 1
+        if self.depth == 1:
+            self.tid = tid
+            self.traj_start_time = time.perf_counter()
+
+    def end_traj(self):
+        self.depth -= 1
+        if self.depth > 0:
+            return
+        self.timers['total'] += time.perf_counter() - self.traj_start_time
+        self.traj_stats.append({'tid': self.tid, 'timers': dict(self.timers), 'counters': dict(self.counters)})
+        self.total_timers.update(self.timers)
+        self.total_counters.update(self.counters)
+        self.timers = Counter()
+        self.counters = Counter()
+        self.tid = None
+
+    def add_time(self, name, seconds):
+        self.timers[name] += seconds
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def to_dict(self):
+        """
+        :return: {'run': {'nb_trajs', 'timers', 'counters'}, 'trajs': [{'tid', 'timers', 'counters'}]}
+        """
+        return {'run': {'nb_trajs': len(self.traj_stats), 'timers': dict(self.total_timers),
+                        'counters': dict(self.total_counters)},
+                'trajs': self.traj_stats}
+
+    def report(self):
+        nb_pts = self.total_counters['nb_pts']
+        print('# of profiled trajs:{}, # of pts:{}, # of candidates per pt:{:.2f}, # of hmm breaks:{}'.format(
+            len(self.traj_stats), nb_pts, self.total_counters['nb_candidates'] / nb_pts if nb_pts > 0 else 0.0,
+            self.total_counters['hmm_breaks']))
+        print('# of rtree queries:{}, # of astar calls:{}, # of reached nodes:{}, # of router queries:{}'.format(
+            self.total_counters['rtree_queries'], self.total_counters['astar_calls'],
+            self.total_counters['astar_reached_nodes'], self.total_counters['router_queries']))
+        print('time (s): ' + ', '.join(['{}:{:.3f}'.format(name, seconds)
+                                        for name, seconds in sorted(self.total_timers.items())]))
+
+
+def store_profile(profiler, target_path):
+    with open(target_path, 'w') as f:
+        json.dump(profiler.to_dict(), f, indent=2)
+
+
+def load_profile(input_path):
+    with open(input_path, 'r') as f:
+        return json.load(f)
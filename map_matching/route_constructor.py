@@ -1,20 +1,44 @@
 from .utils import find_shortest_path
-from datetime import timedelta
 import networkx as nx
-from ..common.path import PathEntity, Path
+import numpy as np
+import time
+from ..common.path import PathEntity, ColumnarPath, to_epoch, from_epoch
 
 
-def construct_path(rn, mm_traj, routing_weight):
+def construct_path(rn, mm_traj, routing_weight, cache=None, router=None, landmarks=None, reuse_road_paths=True,
+                   profiler=None):
     """
     construct the path of the map matched trajectory
     Note: the enter time of the first path entity & the leave time of the last path entity is not accurate
     :param rn: the road network
     :param mm_traj: the map matched trajectory
     :param routing_weight: the attribute name to find the routing weight
+    :param cache: optional ShortestPathCache, e.g., the one already filled by the map matcher
+    :param router: optional precomputed router (e.g., UBODT, ContractionHierarchy)
+    :param landmarks: optional LandmarkHeuristic for A*
+    :param reuse_road_paths: reuse the road paths found by the map matcher (the 'road_path' of the matched points),
+    which must be computed with the same routing weight. Only the transitions without road paths are routed.
+    :param profiler: optional MatchProfiler, the time is added to the 'path' phase
     :return: a list of paths (Note: in case that the route is broken)
     """
+    columnar_paths = construct_columnar_path(rn, mm_traj, routing_weight, cache, router, landmarks, reuse_road_paths,
+                                             profiler)
+    return [columnar_path.to_path() for columnar_path in columnar_paths]
+
+
+def construct_columnar_path(rn, mm_traj, routing_weight, cache=None, router=None, landmarks=None,
+                            reuse_road_paths=True, profiler=None):
+    """
+    construct the path of the map matched trajectory as ColumnarPath, see construct_path()
+    the times are computed as epoch seconds, and the inner edges of all the routes of a path are timed by one
+    vectorized interpolation (see ColumnarPathBuilder) instead of timedelta arithmetic edge by edge
+    :return: a list of ColumnarPath
+    """
+    if profiler is not None:
+        start_time = time.perf_counter()
+    is_directed = nx.is_directed(rn)
     paths = []
-    path = []
+    builder = ColumnarPathBuilder()
     mm_pt_list = mm_traj.pt_list
     start_idx = len(mm_pt_list) - 1
     # find the first matched point
@@ -22,102 +46,197 @@ def construct_path(rn, mm_traj, routing_weight):
         if mm_pt_list[i].data['candi_pt'] is not None:
             start_idx = i
             break
-    pre_edge_enter_time = mm_pt_list[start_idx].time
+    pre_edge_enter_time = to_epoch(mm_pt_list[start_idx].time)
     for i in range(start_idx + 1, len(mm_pt_list)):
         pre_mm_pt = mm_pt_list[i-1]
         cur_mm_pt = mm_pt_list[i]
         # unmatched -> matched
         if pre_mm_pt.data['candi_pt'] is None:
-            pre_edge_enter_time = cur_mm_pt.time
+            pre_edge_enter_time = to_epoch(cur_mm_pt.time)
             continue
         # matched -> unmatched
         pre_candi_pt = pre_mm_pt.data['candi_pt']
         if cur_mm_pt.data['candi_pt'] is None:
-            path.append(PathEntity(pre_edge_enter_time, pre_mm_pt.time, pre_candi_pt.eid))
-            if len(path) > 2:
-                paths.append(Path(mm_traj.oid, get_pid(mm_traj.oid, path), path))
-            path = []
+            builder.add(pre_candi_pt.eid, pre_edge_enter_time, to_epoch(pre_mm_pt.time))
+            if len(builder) > 2:
+                paths.append(builder.build(mm_traj.oid))
+            builder = ColumnarPathBuilder()
             continue
         # matched -> matched
         cur_candi_pt = cur_mm_pt.data['candi_pt']
         # if consecutive points are on the same road, cur_mm_pt doesn't bring new information
         if pre_candi_pt.eid != cur_candi_pt.eid:
-            weight_p, p = find_shortest_path(rn, pre_candi_pt, cur_candi_pt, routing_weight)
+            pre_time = to_epoch(pre_mm_pt.time)
+            cur_time = to_epoch(cur_mm_pt.time)
+            road_path = cur_mm_pt.data.get('road_path') if reuse_road_paths else None
+            if road_path is not None:
+                weight_p, p = road_path
+                if profiler is not None:
+                    profiler.count('reused_road_paths')
+            else:
+                weight_p, p = find_shortest_path(rn, pre_candi_pt, cur_candi_pt, routing_weight, cache, router,
+                                                 landmarks, profiler)
             # cannot connect
             if p is None:
-                path.append(PathEntity(pre_edge_enter_time, pre_mm_pt.time, pre_candi_pt.eid))
-                if len(path) > 2:
-                    paths.append(Path(mm_traj.oid, get_pid(mm_traj.oid, path), path))
-                path = []
-                pre_edge_enter_time = cur_mm_pt.time
+                builder.add(pre_candi_pt.eid, pre_edge_enter_time, pre_time)
+                if len(builder) > 2:
+                    paths.append(builder.build(mm_traj.oid))
+                builder = ColumnarPathBuilder()
+                pre_edge_enter_time = cur_time
                 continue
             # can connect
-            if nx.is_directed(rn):
-                dist_to_p_entrance = rn.edges[rn.edge_idx[pre_candi_pt.eid]]['length'] - pre_candi_pt.offset
+            pre_edge_data = rn.edges[rn.edge_idx[pre_candi_pt.eid]]
+            if is_directed:
+                dist_to_p_entrance = pre_edge_data['length'] - pre_candi_pt.offset
                 dist_to_p_exit = cur_candi_pt.offset
             else:
                 entrance_vertex = p[0]
-                pre_edge_coords = rn.edges[rn.edge_idx[pre_candi_pt.eid]]['coords']
+                pre_edge_coords = pre_edge_data['coords']
                 if (pre_edge_coords[0].lng, pre_edge_coords[0].lat) == entrance_vertex:
                     dist_to_p_entrance = pre_candi_pt.offset
                 else:
-                    dist_to_p_entrance = rn.edges[rn.edge_idx[pre_candi_pt.eid]]['length'] - pre_candi_pt.offset
+                    dist_to_p_entrance = pre_edge_data['length'] - pre_candi_pt.offset
                 exit_vertex = p[-1]
-                cur_edge_coords = rn.edges[rn.edge_idx[cur_candi_pt.eid]]['coords']
+                cur_edge_data = rn.edges[rn.edge_idx[cur_candi_pt.eid]]
+                cur_edge_coords = cur_edge_data['coords']
                 if (cur_edge_coords[0].lng, cur_edge_coords[0].lat) == exit_vertex:
                     dist_to_p_exit = cur_candi_pt.offset
                 else:
-                    dist_to_p_exit = rn.edges[rn.edge_idx[cur_candi_pt.eid]]['length'] - pre_candi_pt.offset
+                    dist_to_p_exit = cur_edge_data['length'] - cur_candi_pt.offset
+            # the inner edges of the route
+            inner_edges = [rn.edges[p[j], p[j + 1]] for j in range(len(p) - 1)]
+            inner_lengths = [edge_data['length'] for edge_data in inner_edges]
             if routing_weight == 'length':
                 total_dist = weight_p
             else:
-                dist_inner = 0.0
-                for i in range(len(p) - 1):
-                    start, end = p[i], p[i + 1]
-                    dist_inner += rn[start][end]['length']
-                total_dist = dist_inner + dist_to_p_entrance + dist_to_p_exit
-            delta_time = (cur_mm_pt.time - pre_mm_pt.time).total_seconds()
+                total_dist = sum(inner_lengths) + dist_to_p_entrance + dist_to_p_exit
+            delta_time = cur_time - pre_time
             # two consecutive points matched to the same vertex
             if total_dist == 0:
-                pre_edge_leave_time = cur_mm_pt.time
-                path.append(PathEntity(pre_edge_enter_time, pre_edge_leave_time, pre_candi_pt.eid))
-                cur_edge_enter_time = cur_mm_pt.time
+                pre_edge_leave_time = cur_time
+                cur_edge_enter_time = cur_time
+                builder.add(pre_candi_pt.eid, pre_edge_enter_time, pre_edge_leave_time)
             else:
-                pre_edge_leave_time = pre_mm_pt.time + timedelta(seconds=delta_time*(dist_to_p_entrance/total_dist))
-                path.append(PathEntity(pre_edge_enter_time, pre_edge_leave_time, pre_candi_pt.eid))
-                cur_edge_enter_time = cur_mm_pt.time - timedelta(seconds=delta_time * (dist_to_p_exit / total_dist))
-                sub_path = linear_interpolate_path(p, total_dist - dist_to_p_entrance - dist_to_p_exit,
-                                                   rn, pre_edge_leave_time, cur_edge_enter_time)
-                path.extend(sub_path)
+                pre_edge_leave_time = pre_time + delta_time * (dist_to_p_entrance / total_dist)
+                cur_edge_enter_time = cur_time - delta_time * (dist_to_p_exit / total_dist)
+                builder.add(pre_candi_pt.eid, pre_edge_enter_time, pre_edge_leave_time)
+                builder.add_route([edge_data['eid'] for edge_data in inner_edges], inner_lengths,
+                                  pre_edge_leave_time, cur_edge_enter_time)
             pre_edge_enter_time = cur_edge_enter_time
     # handle last matched similar to (matched -> unmatched)
     if mm_pt_list[-1].data['candi_pt'] is not None:
-        path.append(PathEntity(pre_edge_enter_time, mm_pt_list[-1].time, mm_pt_list[-1].data['candi_pt'].eid))
-        if len(path) > 2:
-            paths.append(Path(mm_traj.oid, get_pid(mm_traj.oid, path), path))
+        builder.add(mm_pt_list[-1].data['candi_pt'].eid, pre_edge_enter_time, to_epoch(mm_pt_list[-1].time))
+        if len(builder) > 2:
+            paths.append(builder.build(mm_traj.oid))
+    if profiler is not None:
+        profiler.add_time('path', time.perf_counter() - start_time)
     return paths
 
 
+class ColumnarPathBuilder:
+    """
+    Collects the path entities of a path, the times of the inner edges of the routes are left empty and filled by
+    one vectorized interpolation of all the routes in build().
+    """
+    def __init__(self):
+        self.eids = []
+        self.enter_times = []
+        self.leave_times = []
+        # the route id of each path entity (-1 if it is not an inner edge of a route) and the lengths of the inner edges
+        self.route_ids = []
+        self.inner_lengths = []
+        # the enter/leave times of the routes
+        self.route_enter_times = []
+        self.route_leave_times = []
+
+    def __len__(self):
+        return len(self.eids)
+
+    def add(self, eid, enter_time, leave_time):
+        self.eids.append(eid)
+        self.enter_times.append(enter_time)
+        self.leave_times.append(leave_time)
+        self.route_ids.append(-1)
+
+    def add_route(self, eids, lengths, enter_time, leave_time):
+        """
+        :param eids: the eids of the edges of the route
+        :param lengths: the lengths of the edges of the route
+        :param enter_time: the time entering the first edge
+        :param leave_time: the time leaving the last edge
+        """
+        if len(eids) == 0:
+            return
+        self.eids.extend(eids)
+        self.enter_times.extend([0.0] * len(eids))
+        self.leave_times.extend([0.0] * len(eids))
+        self.route_ids.extend([len(self.route_enter_times)] * len(eids))
+        self.inner_lengths.extend(lengths)
+        self.route_enter_times.append(enter_time)
+        self.route_leave_times.append(leave_time)
+
+    def build(self, oid):
+        enter_times = np.array(self.enter_times, dtype=np.float64)
+        leave_times = np.array(self.leave_times, dtype=np.float64)
+        if len(self.inner_lengths) > 0:
+            route_ids = np.array(self.route_ids, dtype=np.int64)
+            is_inner = route_ids >= 0
+            enter_times[is_inner], leave_times[is_inner] = interpolate_route_times(
+                route_ids[is_inner], np.array(self.inner_lengths, dtype=np.float64),
+                np.array(self.route_enter_times, dtype=np.float64),
+                np.array(self.route_leave_times, dtype=np.float64))
+        return ColumnarPath(oid, get_columnar_pid(oid, self.enter_times[0], self.leave_times[-1]),
+                            np.array(self.eids, dtype=np.int64), enter_times, leave_times)
+
+
+def interpolate_route_times(route_ids, lengths, route_enter_times, route_leave_times):
+    """
+    the times of the edges of consecutive routes, each route is traveled at a constant speed
+    :param route_ids: the route id (0, 1, ...) of each edge, the edges of a route are contiguous and in order
+    :param lengths: the lengths of the edges
+    :param route_enter_times: the time entering the first edge of each route (epoch second)
+    :param route_leave_times: the time leaving the last edge of each route (epoch second)
+    :return: (enter times, leave times) of the edges
+    """
+    route_sizes = np.bincount(route_ids)
+    route_ends = np.cumsum(route_sizes) - 1
+    route_lengths = np.bincount(route_ids, weights=lengths)
+    cum_lengths = np.cumsum(lengths)
+    # the length traveled in the route when leaving each edge, over the route length
+    rates = (cum_lengths - (cum_lengths[route_ends] - route_lengths)[route_ids]) / \
+        np.maximum(route_lengths, 1e-6)[route_ids]
+    leave_times = route_enter_times[route_ids] + (route_leave_times - route_enter_times)[route_ids] * rates
+    # to make sure the last edge leave time meets the route leave time due to double calculation accuracy
+    leave_times[route_ends] = route_leave_times
+    enter_times = np.empty_like(leave_times)
+    enter_times[1:] = leave_times[:-1]
+    enter_times[route_ends - route_sizes + 1] = route_enter_times
+    return enter_times, leave_times
+
+
 def linear_interpolate_path(p, dist_inner, rn, enter_time, leave_time):
-    path = []
-    edges = []
-    for i in range(len(p)-1):
-        edges.append((p[i], p[i+1]))
-    delta_time = (leave_time - enter_time).total_seconds()
-    edge_enter_time = enter_time
-    for i in range(len(edges)):
-        edge_data = rn.edges[edges[i]]
-        if i == len(edges) - 1:
-            # to make sure the last connect edge leave time
-            # meet the path leave time due to double calculation accuracy
-            edge_leave_time = leave_time
-        else:
-            edge_leave_time = edge_enter_time + timedelta(seconds=delta_time*(edge_data['length']/dist_inner))
-        path.append(PathEntity(edge_enter_time, edge_leave_time, edge_data['eid']))
-        edge_enter_time = edge_leave_time
-    return path
+    """
+    :param dist_inner: the total length of the edges, the edge lengths are summed by interpolate_route_times() instead
+    :return: the path entities of the edges of the vertex path p, see interpolate_route_times()
+    """
+    edges = [rn.edges[p[i], p[i + 1]] for i in range(len(p) - 1)]
+    if len(edges) == 0:
+        return []
+    enter_times, leave_times = interpolate_route_times(
+        np.zeros(len(edges), dtype=np.int64), np.array([edge_data['length'] for edge_data in edges], dtype=np.float64),
+        np.array([to_epoch(enter_time)]), np.array([to_epoch(leave_time)]))
+    return [PathEntity(from_epoch(edge_enter_time), from_epoch(edge_leave_time), edge_data['eid'])
+            for edge_enter_time, edge_leave_time, edge_data in zip(enter_times.tolist(), leave_times.tolist(), edges)]
 
 
 def get_pid(oid, path):
     return oid + '_' + path[0].enter_time.strftime('%Y%m%d%H%M') + '_' + \
            path[-1].leave_time.strftime('%Y%m%d%H%M')
+
+
+def get_columnar_pid(oid, enter_time, leave_time):
+    """
+    the same as get_pid(), the times are epoch seconds
+    """
+    return oid + '_' + from_epoch(enter_time).strftime('%Y%m%d%H%M') + '_' + \
+           from_epoch(leave_time).strftime('%Y%m%d%H%M')
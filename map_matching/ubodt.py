@@ -0,0 +1,152 @@
+"""
+Upper-bounded origin-destination table (UBODT) based on
+Yang, Can, and Gyozo Gidofalvi. "Fast map matching, an algorithm integrating hidden Markov model with precomputation."
+International Journal of Geographical Information Science 32.3 (2018): 547-570.
+All the vertex pairs whose cheapest path is within delta are precomputed by bounded Dijkstra, and stored as
+(source, target, cost, next vertex, next edge) rows in a hash table laid out as flat arrays, so that the table can
+be memory-mapped from disk. The full path is unrolled by following the next vertex of each row.
+"""
+import networkx as nx
+import numpy as np
+import json
+import os
+
+HASH_PRIME_1 = 73856093
+HASH_PRIME_2 = 19349663
+
+
+class UBODT:
+    """
+    rows are grouped by hash bucket, rows of bucket b are in [bucket_offsets[b], bucket_offsets[b+1])
+    """
+    def __init__(self, nodes, src, dest, cost, next_node, next_eid, bucket_offsets, delta, weight):
+        # node id -> node key (coordinate tuple)
+        self.nodes = [tuple(node) for node in nodes.tolist()]
+        # node key -> node id
+        self.node_ids = {node: i for i, node in enumerate(self.nodes)}
+        self.src = src
+        self.dest = dest
+        self.cost = cost
+        self.next_node = next_node
+        self.next_eid = next_eid
+        self.bucket_offsets = bucket_offsets
+        self.nb_buckets = len(bucket_offsets) - 1
+        self.delta = delta
+        self.weight = weight
+
+    def __len__(self):
+        return len(self.src)
+
+    def find_row(self, s, t):
+        """
+        :param s: the source node id
+        :param t: the target node id
+        :return: the row index of (s, t), -1 if the cheapest path is longer than delta or does not exist
+        """
+        b = ((s * HASH_PRIME_1) ^ (t * HASH_PRIME_2)) % self.nb_buckets
+        for row in range(int(self.bucket_offsets[b]), int(self.bucket_offsets[b + 1])):
+            if self.src[row] == s and self.dest[row] == t:
+                return row
+        return -1
+
+    def cheapest_path(self, src, dest):
+        """
+        O(1) lookup of the cheapest path plus path unrolling
+        :param src: the source vertex
+        :param dest: the target vertex
+        :return: (cost, vertex path), None if the pair is not in the table (beyond delta)
+        """
+        if src == dest:
+            return 0.0, [src]
+        s = self.node_ids.get(src)
+        t = self.node_ids.get(dest)
+        if s is None or t is None:
+            return None
+        row = self.find_row(s, t)
+        if row < 0:
+            return None
+        cost = float(self.cost[row])
+        path = [src]
+        cur = s
+        while cur != t:
+            cur = int(self.next_node[row])
+            path.append(self.nodes[cur])
+            if cur != t:
+                row = self.find_row(cur, t)
+                # the sub path exceeds delta due to floating point errors
+                if row < 0:
+                    return None
+        return cost, path
+
+
+def bucket_of(src, dest, nb_buckets):
+    return ((src * HASH_PRIME_1) ^ (dest * HASH_PRIME_2)) % nb_buckets
+
+
+def build_ubodt(rn, delta, weight='length', load_factor=0.5):
+    """
+    run bounded Dijkstra from every vertex of the road network
+    :param rn: the road network
+    :param delta: the upper bound of the path cost (in the unit of weight)
+    :param weight: the attribute name to find the routing weight
+    :param load_factor: #rows / #buckets of the hash table
+    :return: UBODT
+    """
+    nodes = list(rn.nodes)
+    node_ids = {node: i for i, node in enumerate(nodes)}
+    src, dest, cost, next_node, next_eid = [], [], [], [], []
+    for s_node in nodes:
+        s = node_ids[s_node]
+        pred, dist = nx.dijkstra_predecessor_and_distance(rn, s_node, cutoff=delta, weight=weight)
+        # vertices are settled in the order of dist, so the next hop of a predecessor is always known
+        next_hops = {}
+        for t_node, t_cost in dist.items():
+            if t_node == s_node:
+                continue
+            p_node = pred[t_node][0]
+            next_hop = t_node if p_node == s_node else next_hops[p_node]
+            next_hops[t_node] = next_hop
+            src.append(s)
+            dest.append(node_ids[t_node])
+            cost.append(t_cost)
+            next_node.append(node_ids[next_hop])
+            next_eid.append(rn[s_node][next_hop]['eid'])
+    src = np.array(src, dtype=np.int64)
+    dest = np.array(dest, dtype=np.int64)
+    nb_buckets = max(1, int(len(src) / load_factor))
+    buckets = bucket_of(src, dest, nb_buckets)
+    order = np.argsort(buckets, kind='stable')
+    bucket_offsets = np.zeros(nb_buckets + 1, dtype=np.int64)
+    np.cumsum(np.bincount(buckets, minlength=nb_buckets), out=bucket_offsets[1:])
+    print('# of ubodt rows:{}'.format(len(src)))
+    return UBODT(np.array(nodes, dtype=np.float64), src[order].astype(np.int32), dest[order].astype(np.int32),
+                 np.array(cost, dtype=np.float64)[order], np.array(next_node, dtype=np.int32)[order],
+                 np.array(next_eid, dtype=np.int64)[order], bucket_offsets, delta, weight)
+
+
+def store_ubodt(ubodt, target_dir):
+    os.makedirs(target_dir, exist_ok=True)
+    np.save(os.path.join(target_dir, 'nodes.npy'), np.array(ubodt.nodes, dtype=np.float64))
+    np.save(os.path.join(target_dir, 'src.npy'), ubodt.src)
+    np.save(os.path.join(target_dir, 'dest.npy'), ubodt.dest)
+    np.save(os.path.join(target_dir, 'cost.npy'), ubodt.cost)
+    np.save(os.path.join(target_dir, 'next_node.npy'), ubodt.next_node)
+    np.save(os.path.join(target_dir, 'next_eid.npy'), ubodt.next_eid)
+    np.save(os.path.join(target_dir, 'bucket_offsets.npy'), ubodt.bucket_offsets)
+    with open(os.path.join(target_dir, 'meta.json'), 'w') as f:
+        json.dump({'delta': ubodt.delta, 'weight': ubodt.weight}, f)
+
+
+def load_ubodt(input_dir, mmap=True):
+    """
+    :param input_dir: the directory generated by store_ubodt
+    :param mmap: memory-map the table instead of reading it into memory
+    :return: UBODT
+    """
+    mmap_mode = 'r' if mmap else None
+    with open(os.path.join(input_dir, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    arrays = [np.load(os.path.join(input_dir, name + '.npy'), mmap_mode=mmap_mode)
+              for name in ['src', 'dest', 'cost', 'next_node', 'next_eid', 'bucket_offsets']]
+    nodes = np.load(os.path.join(input_dir, 'nodes.npy'))
+    return UBODT(nodes, *arrays, delta=meta['delta'], weight=meta['weight'])
@@ -1,16 +1,98 @@
 from ..common.spatial_func import SPoint, distance
+from collections import OrderedDict
 import networkx as nx
+import threading
 import math
 
 
-def find_shortest_path(rn, prev_candi_pt, cur_candi_pt, weight='length'):
+class LRUCache:
+    """
+    Bounded thread-safe LRU cache with hit/miss counters.
+    """
+    def __init__(self, max_size=100000):
+        """
+        :param max_size: the max number of cached entries, nothing is cached if <= 0
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :return: (True, value) if the key is cached, otherwise (False, None)
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, self.entries[key]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def hit_rate(self):
+        nb_queries = self.hits + self.misses
+        return self.hits / nb_queries if nb_queries > 0 else 0.0
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class ShortestPathCache(LRUCache):
+    """
+    Bounded LRU cache of vertex-to-vertex cheapest paths, shared across time steps and trajectories.
+    key: (src, dest, weight), value: the vertex path, or None if dest is not reachable from src
+    Note: the cache is not aware of road network updates, call clear() after modifying the road network
+    """
+    pass
+
+
+def find_shortest_path(rn, prev_candi_pt, cur_candi_pt, weight='length', cache=None, router=None, landmarks=None,
+                       profiler=None):
+    """
+    find the cheapest path between two candidate points
+    :param rn: the road network
+    :param prev_candi_pt: the source candidate point
+    :param cur_candi_pt: the target candidate point
+    :param weight: the attribute name to find the routing weight
+    :param cache: optional ShortestPathCache to reuse vertex-to-vertex paths
+    :param router: optional precomputed router (e.g., UBODT, ContractionHierarchy),
+    A* is used for the queries it cannot answer
+    :param landmarks: optional LandmarkHeuristic used as the A* heuristic if it is built with the same weight
+    :param profiler: optional MatchProfiler to count the A* calls, settled nodes, router queries and cache hits
+    :return: (total weight, vertex path), (inf, None) if cannot connect
+    """
+    astar_heuristic = heuristic
+    if landmarks is not None and landmarks.weight == weight:
+        astar_heuristic = landmarks
     if nx.is_directed(rn):
-        return find_shortest_path_directed(rn, prev_candi_pt, cur_candi_pt, weight)
+        return find_shortest_path_directed(rn, prev_candi_pt, cur_candi_pt, weight, cache, router, astar_heuristic,
+                                           profiler)
     else:
-        return find_shortest_path_undirected(rn, prev_candi_pt, cur_candi_pt, weight)
+        return find_shortest_path_undirected(rn, prev_candi_pt, cur_candi_pt, weight, cache, router, astar_heuristic,
+                                             profiler)
 
 
-def find_shortest_path_directed(rn, prev_candi_pt, cur_candi_pt, weight):
+def find_shortest_path_directed(rn, prev_candi_pt, cur_candi_pt, weight, cache=None, router=None,
+                                astar_heuristic=None, profiler=None):
+    if astar_heuristic is None:
+        astar_heuristic = heuristic
     # case 1, on the same road
     if prev_candi_pt.eid == cur_candi_pt.eid:
         if prev_candi_pt.offset < cur_candi_pt.offset:
@@ -23,13 +105,16 @@ def find_shortest_path_directed(rn, prev_candi_pt, cur_candi_pt, weight):
         cur_u, cur_v = rn.edge_idx[cur_candi_pt.eid]
         try:
             path = get_cheapest_path_with_weight(rn, pre_v, cur_u, rn[pre_u][pre_v]['length'] - prev_candi_pt.offset,
-                                                 cur_candi_pt.offset, heuristic, weight)
+                                                 cur_candi_pt.offset, astar_heuristic, weight, cache, router, profiler)
             return path
         except nx.NetworkXNoPath:
             return float('inf'), None
 
 
-def find_shortest_path_undirected(rn, prev_candi_pt, cur_candi_pt, weight):
+def find_shortest_path_undirected(rn, prev_candi_pt, cur_candi_pt, weight, cache=None, router=None,
+                                  astar_heuristic=None, profiler=None):
+    if astar_heuristic is None:
+        astar_heuristic = heuristic
     # case 1, on the same road
     if prev_candi_pt.eid == cur_candi_pt.eid:
         return math.fabs(cur_candi_pt.offset - prev_candi_pt.offset), []
@@ -43,21 +128,23 @@ def find_shortest_path_undirected(rn, prev_candi_pt, cur_candi_pt, weight):
         # prev_u -> cur_u
         try:
             paths.append(get_cheapest_path_with_weight(rn, pre_u, cur_u, prev_candi_pt.offset,
-                                                       cur_candi_pt.offset, heuristic, weight))
+                                                       cur_candi_pt.offset, astar_heuristic, weight, cache, router,
+                                                       profiler))
         except nx.NetworkXNoPath:
             pass
         # prev_u -> cur_v
         try:
             paths.append(get_cheapest_path_with_weight(rn, pre_u, cur_v, prev_candi_pt.offset,
                                                        rn[cur_u][cur_v]['length'] - cur_candi_pt.offset,
-                                                       heuristic, weight))
+                                                       astar_heuristic, weight, cache, router, profiler))
         except nx.NetworkXNoPath:
             pass
         # pre_v -> cur_u
         try:
             paths.append(get_cheapest_path_with_weight(rn, pre_v, cur_u,
                                                        rn[pre_u][pre_v]['length'] - prev_candi_pt.offset,
-                                                       cur_candi_pt.offset, heuristic, weight))
+                                                       cur_candi_pt.offset, astar_heuristic, weight, cache, router,
+                                                       profiler))
         except nx.NetworkXNoPath:
             pass
         # prev_v -> cur_v:
@@ -65,7 +152,7 @@ def find_shortest_path_undirected(rn, prev_candi_pt, cur_candi_pt, weight):
             paths.append(get_cheapest_path_with_weight(rn, pre_v, cur_v,
                                                        rn[pre_u][pre_v]['length'] - prev_candi_pt.offset,
                                                        rn[cur_u][cur_v]['length'] - cur_candi_pt.offset,
-                                                       heuristic, weight))
+                                                       astar_heuristic, weight, cache, router, profiler))
         except nx.NetworkXNoPath:
             pass
         if len(paths) > 0:
@@ -77,9 +164,48 @@ def heuristic(node1, node2):
     return distance(SPoint(node1[1], node1[0]), SPoint(node2[1], node2[0]))
 
 
-def get_cheapest_path_with_weight(rn, src, dest, dist_to_src, dist_to_dest, heuristic, weight):
+def get_vertex_path(rn, src, dest, heuristic, weight, router=None, profiler=None):
+    """
+    the router is only used if it is built with the same routing weight,
+    and falls back to A* if it cannot answer the query (returns None).
+    A router raises NetworkXNoPath if dest is not reachable from src.
+    """
+    if router is not None and router.weight == weight:
+        if profiler is not None:
+            profiler.count('router_queries')
+        result = router.cheapest_path(src, dest)
+        if result is not None:
+            return result[1]
+    if profiler is None:
+        return nx.astar_path(rn, src, dest, heuristic, weight=weight)
+
+    # A* evaluates the heuristic once for each node it reaches, an upper bound of the settled nodes
+    def counting_heuristic(node1, node2):
+        profiler.count('astar_reached_nodes')
+        return heuristic(node1, node2)
+
+    profiler.count('astar_calls')
+    return nx.astar_path(rn, src, dest, counting_heuristic, weight=weight)
+
+
+def get_cheapest_path_with_weight(rn, src, dest, dist_to_src, dist_to_dest, heuristic, weight, cache=None,
+                                  router=None, profiler=None):
+    if cache is None:
+        path = get_vertex_path(rn, src, dest, heuristic, weight, router, profiler)
+    else:
+        key = (src, dest, weight)
+        is_cached, path = cache.get(key)
+        if profiler is not None:
+            profiler.count('sp_cache_hits' if is_cached else 'sp_cache_misses')
+        if not is_cached:
+            try:
+                path = get_vertex_path(rn, src, dest, heuristic, weight, router, profiler)
+            except nx.NetworkXNoPath:
+                path = None
+            cache.put(key, path)
+        if path is None:
+            raise nx.NetworkXNoPath('No path between {} and {}.'.format(src, dest))
     tot_weight = 0.0
-    path = nx.astar_path(rn, src, dest, heuristic, weight=weight)
     tot_weight += dist_to_src
     for i in range(len(path) - 1):
         start = path[i]
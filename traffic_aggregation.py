@@ -0,0 +1,252 @@
+"""
+Edge-level traffic aggregation over the matched paths.
+Each path entity is binned by the eid and the TemporalIdx slot of its enter time, and accumulated into
+(nb_edges, ts_num) tensors: the volume (# of entities), and the sum and the count of the speeds (edge length over the
+time spent on the edge). The first and the last entities of a path only cover a part of the edge
+(see construct_path()), they are counted in the volume but not in the speed.
+The tensors are dense arrays, or sparse COO arrays (linear index row * ts_num + ts) if most (edge, slot) cells are
+empty. The partial results of different shards are merged by merge(), e.g., aggregate_path_files(nb_workers=...).
+"""
+from .common.path import parse_path_file, to_epoch
+from .map_matching.parallel import fork_map
+import numpy as np
+import json
+import os
+
+
+class TrafficAggregator:
+    def __init__(self, eids, lengths, temporal_idx, sparse=False, buffer_size=1000000):
+        """
+        :param eids: the eids of the edges, the rows of the tensors follow the sorted eids
+        :param lengths: the lengths (meter) of the edges
+        :param temporal_idx: TemporalIdx of the time slots
+        :param sparse: accumulate into sparse COO arrays instead of dense arrays
+        :param buffer_size: the sparse entries are coalesced once the buffered entries exceed buffer_size
+        """
+        order = np.argsort(eids)
+        self.eids = np.asarray(eids, dtype=np.int64)[order]
+        self.lengths = np.asarray(lengths, dtype=np.float64)[order]
+        self.temporal_idx = temporal_idx
+        self.start_time = to_epoch(temporal_idx.start_time)
+        self.slot_seconds = temporal_idx.time_interval * 60.0
+        self.ts_num = temporal_idx.ts_num
+        self.sparse = sparse
+        self.buffer_size = buffer_size
+        if sparse:
+            # coalesced entries sorted by the linear index, and the buffered entries
+            self.keys = np.zeros(0, dtype=np.int64)
+            self.values = np.zeros((0, 3), dtype=np.float64)
+            self.buffered_keys = []
+            self.buffered_values = []
+            self.nb_buffered = 0
+        else:
+            self.volume = np.zeros((len(self.eids), self.ts_num), dtype=np.int64)
+            self.speed_sum = np.zeros((len(self.eids), self.ts_num), dtype=np.float64)
+            self.speed_count = np.zeros((len(self.eids), self.ts_num), dtype=np.int64)
+        self.nb_entities = 0
+        self.nb_skipped_entities = 0
+
+    def add_entities(self, eids, enter_times, leave_times, is_partial):
+        """
+        :param eids: int array of the eids
+        :param enter_times: float array of the enter times (epoch second)
+        :param leave_times: float array of the leave times (epoch second)
+        :param is_partial: bool array, the entity only covers a part of the edge, thus has no speed
+        """
+        rows = np.searchsorted(self.eids, eids)
+        ts, ts_mask = self.temporal_idx.epochs_to_ts(enter_times)
+        durations = leave_times - enter_times
+        # unknown edges or out of the time range
+        is_valid = rows < len(self.eids)
+        is_valid[is_valid] = self.eids[rows[is_valid]] == eids[is_valid]
+        is_valid &= ts_mask
+        self.nb_entities += len(eids)
+        self.nb_skipped_entities += len(eids) - int(is_valid.sum())
+        rows, ts, durations, is_partial = rows[is_valid], ts[is_valid], durations[is_valid], is_partial[is_valid]
+        has_speed = ~is_partial & (durations > 0)
+        speeds = np.zeros(len(rows))
+        speeds[has_speed] = self.lengths[rows[has_speed]] / durations[has_speed]
+        if self.sparse:
+            self.buffered_keys.append(rows * self.ts_num + ts)
+            self.buffered_values.append(np.stack([np.ones(len(rows)), speeds, has_speed], axis=1))
+            self.nb_buffered += len(rows)
+            if self.nb_buffered > self.buffer_size:
+                self.coalesce()
+        else:
+            np.add.at(self.volume, (rows, ts), 1)
+            np.add.at(self.speed_sum, (rows, ts), speeds)
+            np.add.at(self.speed_count, (rows, ts), has_speed)
+
+    def add_path(self, path):
+        path_entities = path.path_entities
+        is_partial = np.zeros(len(path_entities), dtype=bool)
+        is_partial[[0, -1]] = True
+        self.add_entities(np.array([path_entity.eid for path_entity in path_entities], dtype=np.int64),
+                          np.array([to_epoch(path_entity.enter_time) for path_entity in path_entities]),
+                          np.array([to_epoch(path_entity.leave_time) for path_entity in path_entities]),
+                          is_partial)
+
+    def add_columnar_path(self, columnar_path):
+        is_partial = np.zeros(len(columnar_path), dtype=bool)
+        is_partial[[0, -1]] = True
+        self.add_entities(columnar_path.eids, columnar_path.enter_times, columnar_path.leave_times, is_partial)
+
+    def add_path_store(self, path_store):
+        """
+        :param path_store: PathStore, all the entities are added at once
+        """
+        is_partial = np.zeros(len(path_store.eids), dtype=bool)
+        is_partial[path_store.path_offsets[:-1]] = True
+        is_partial[path_store.path_offsets[1:] - 1] = True
+        self.add_entities(np.asarray(path_store.eids, dtype=np.int64), path_store.enter_times / 1000.0,
+                          path_store.leave_times / 1000.0, is_partial)
+
+    def add_path_file(self, input_path):
+        for path in parse_path_file(input_path):
+            self.add_path(path)
+
+    def coalesce(self):
+        if not self.sparse or self.nb_buffered == 0:
+            return
+        keys = np.concatenate([self.keys] + self.buffered_keys)
+        values = np.concatenate([self.values] + self.buffered_values)
+        self.keys, inverse = np.unique(keys, return_inverse=True)
+        self.values = np.zeros((len(self.keys), 3), dtype=np.float64)
+        np.add.at(self.values, inverse.ravel(), values)
+        self.buffered_keys = []
+        self.buffered_values = []
+        self.nb_buffered = 0
+
+    def merge(self, other):
+        """
+        add the partial result of another aggregator of the same edges and time slots
+        """
+        if not np.array_equal(self.eids, other.eids) or self.start_time != other.start_time or \
+                self.slot_seconds != other.slot_seconds or self.ts_num != other.ts_num:
+            raise Exception('cannot merge the aggregators of different edges or time slots')
+        keys, values = other.to_coo()
+        return self.merge_coo(keys, values, other.nb_entities, other.nb_skipped_entities)
+
+    def merge_coo(self, keys, values, nb_entities=0, nb_skipped_entities=0):
+        """
+        add a partial result of the same edges and time slots in the form of to_coo()
+        :param keys: the distinct linear indices
+        :param values: (volume, speed sum, speed count) of the keys
+        """
+        self.nb_entities += nb_entities
+        self.nb_skipped_entities += nb_skipped_entities
+        if self.sparse:
+            self.buffered_keys.append(keys)
+            self.buffered_values.append(np.stack(values, axis=1))
+            self.nb_buffered += len(keys)
+            self.coalesce()
+        else:
+            volume, speed_sum, speed_count = values
+            self.volume.reshape(-1)[keys] += np.round(volume).astype(np.int64)
+            self.speed_sum.reshape(-1)[keys] += speed_sum
+            self.speed_count.reshape(-1)[keys] += np.round(speed_count).astype(np.int64)
+        return self
+
+    def to_coo(self):
+        """
+        :return: linear indices (row * ts_num + ts), (volume, speed sum, speed count)
+        """
+        if self.sparse:
+            self.coalesce()
+            return self.keys, (self.values[:, 0], self.values[:, 1], self.values[:, 2])
+        keys = np.flatnonzero(self.volume)
+        return keys, (self.volume.ravel()[keys].astype(np.float64), self.speed_sum.ravel()[keys],
+                      self.speed_count.ravel()[keys].astype(np.float64))
+
+    def to_dense(self):
+        """
+        :return: (volume, speed sum, speed count) tensors of shape (nb_edges, ts_num)
+        """
+        if not self.sparse:
+            return self.volume, self.speed_sum, self.speed_count
+        self.coalesce()
+        shape = (len(self.eids), self.ts_num)
+        volume = np.zeros(shape[0] * shape[1], dtype=np.int64)
+        speed_sum = np.zeros(shape[0] * shape[1], dtype=np.float64)
+        speed_count = np.zeros(shape[0] * shape[1], dtype=np.int64)
+        volume[self.keys] = np.round(self.values[:, 0]).astype(np.int64)
+        speed_sum[self.keys] = self.values[:, 1]
+        speed_count[self.keys] = np.round(self.values[:, 2]).astype(np.int64)
+        return volume.reshape(shape), speed_sum.reshape(shape), speed_count.reshape(shape)
+
+    def get_volume(self):
+        return self.to_dense()[0]
+
+    def get_mean_speed(self):
+        """
+        :return: the mean speed (meter per second) tensor, nan if no speed
+        """
+        _, speed_sum, speed_count = self.to_dense()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(speed_count > 0, speed_sum / speed_count, np.nan)
+
+    def report(self):
+        print('# of entities:{}, # of skipped entities:{}'.format(self.nb_entities, self.nb_skipped_entities))
+
+
+def build_traffic_aggregator(rn, temporal_idx, sparse=False):
+    """
+    :param rn: the road network, the edges are the rows of the tensors
+    :param temporal_idx: TemporalIdx of the time slots
+    :param sparse: see TrafficAggregator
+    """
+    eids = list(rn.edge_idx.keys())
+    lengths = [rn[u][v]['length'] for u, v in rn.edge_idx.values()]
+    return TrafficAggregator(eids, lengths, temporal_idx, sparse)
+
+
+def store_traffic(aggregator, target_dir):
+    os.makedirs(target_dir, exist_ok=True)
+    keys, (volume, speed_sum, speed_count) = aggregator.to_coo()
+    np.save(os.path.join(target_dir, 'eids.npy'), aggregator.eids)
+    np.save(os.path.join(target_dir, 'lengths.npy'), aggregator.lengths)
+    np.save(os.path.join(target_dir, 'keys.npy'), keys)
+    np.save(os.path.join(target_dir, 'values.npy'), np.stack([volume, speed_sum, speed_count], axis=1))
+    with open(os.path.join(target_dir, 'meta.json'), 'w') as f:
+        json.dump({'nb_entities': aggregator.nb_entities, 'nb_skipped_entities': aggregator.nb_skipped_entities}, f)
+
+
+def load_traffic(input_dir, temporal_idx, sparse=False):
+    """
+    :param input_dir: the directory generated by store_traffic
+    :param temporal_idx: the TemporalIdx used by the stored aggregator
+    :return: TrafficAggregator
+    """
+    with open(os.path.join(input_dir, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    eids = np.load(os.path.join(input_dir, 'eids.npy'))
+    lengths = np.load(os.path.join(input_dir, 'lengths.npy'))
+    keys = np.load(os.path.join(input_dir, 'keys.npy'))
+    values = np.load(os.path.join(input_dir, 'values.npy'))
+    return TrafficAggregator(eids, lengths, temporal_idx, sparse).merge_coo(
+        keys, (values[:, 0], values[:, 1], values[:, 2]), meta['nb_entities'], meta['nb_skipped_entities'])
+
+
+def aggregate_worker(aggregator, input_path):
+    # the partial results are sent back as sparse arrays, which are cheaper than the dense tensors
+    partial = TrafficAggregator(aggregator.eids, aggregator.lengths, aggregator.temporal_idx, sparse=True)
+    partial.add_path_file(input_path)
+    keys, values = partial.to_coo()
+    return keys, values, partial.nb_entities, partial.nb_skipped_entities
+
+
+def aggregate_path_files(aggregator, input_paths, nb_workers=1):
+    """
+    aggregate the path files into the aggregator, each file is aggregated as a shard
+    :param aggregator: TrafficAggregator, e.g., by build_traffic_aggregator()
+    :param input_paths: the path files
+    :param nb_workers: the number of worker processes (see fork_map()), aggregate in the current process if <= 1
+    :return: the aggregator
+    """
+    if nb_workers <= 1:
+        for input_path in input_paths:
+            aggregator.add_path_file(input_path)
+        return aggregator
+    for partial in fork_map(aggregate_worker, aggregator, input_paths, nb_workers):
+        aggregator.merge_coo(*partial)
+    return aggregator